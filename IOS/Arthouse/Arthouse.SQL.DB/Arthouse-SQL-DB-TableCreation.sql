@@ -33,6 +33,7 @@ post_id INT AUTO_INCREMENT PRIMARY KEY,
 	like_count INT DEFAULT 0,
 	comment_count INT DEFAULT 0,
 	created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+	fanned_out BOOLEAN NOT NULL DEFAULT FALSE,          	-- pushed into the followers' home_timeline, otherwise pulled at read time
 	FOREIGN KEY (username) REFERENCES profile(username) ON UPDATE CASCADE ON DELETE CASCADE
 )ENGINE=InnoDB;
 
@@ -77,6 +78,18 @@ CREATE TABLE IF NOT EXISTS photo (
     FOREIGN KEY (media_id) REFERENCES media(media_id) ON DELETE CASCADE
 )ENGINE=InnoDB;
 
+-- Smaller copies of a photo for feeds (made at upload time), one row per width + format.
+-- file_name is the object in the photo folder, shared by photos with identical content
+CREATE TABLE IF NOT EXISTS photo_variant (
+    media_id INT NOT NULL,
+    width INT NOT NULL,
+    format ENUM('jpeg', 'webp') NOT NULL,
+    file_name VARCHAR(255) NOT NULL,
+    PRIMARY KEY (media_id, width, format),
+    INDEX idx_photo_variant_file (file_name),
+    FOREIGN KEY (media_id) REFERENCES media(media_id) ON DELETE CASCADE
+)ENGINE=InnoDB;
+
 CREATE TABLE IF NOT EXISTS video (
     media_id INT PRIMARY KEY,
     duration_seconds INT,
@@ -96,6 +109,23 @@ ADD CONSTRAINT fk_post_audio
 FOREIGN KEY (audio_id) REFERENCES media(media_id)
 ON DELETE SET NULL;
 
+-- keyset pagination: feeds seek on (created_at, post_id) instead of using OFFSET
+CREATE INDEX idx_post_created ON post (created_at, post_id);
+CREATE INDEX idx_post_user_created ON post (username, created_at, post_id);
+-- home timelines pull a followed account's posts that weren't fanned out
+CREATE INDEX idx_post_user_pulled ON post (username, fanned_out, created_at, post_id);
+
+-- materialized home feeds: post ids pushed to every follower when a post is made
+-- (see ArthouseDBSQLComands_TIMELINE.py). reading a page is one range scan on the key
+CREATE TABLE IF NOT EXISTS home_timeline (
+	username VARCHAR(36) NOT NULL,                      	-- whose feed this is
+	post_id INT NOT NULL,
+	created_at TIMESTAMP NOT NULL,                      	-- copy of post.created_at
+	PRIMARY KEY (username, created_at, post_id),
+	FOREIGN KEY (username) REFERENCES profile(username) ON UPDATE CASCADE ON DELETE CASCADE,
+	FOREIGN KEY (post_id) REFERENCES post(post_id) ON DELETE CASCADE
+)ENGINE=InnoDB;
+
 DROP TRIGGER IF EXISTS after_follow_insert;
 DROP TRIGGER IF EXISTS after_follow_delete;
 DROP TRIGGER IF EXISTS after_like_insert;
@@ -13,30 +13,121 @@
 #perform CRUD operations on media data in the database (create, read, update, delete)
 
 import os
+import shutil
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
 
-from queryHelper import run_cud_query, run_read_multiple, run_read_single
+from queryHelper import run_cud_query, run_read_multiple, run_read_single, run_bulk_insert, transaction, after_commit
 import ArthouseGoogleCloudInterface as agci
 import MediaManager
+from ContentCache import cache as content_cache, file_digest
 
 ################################################################################################
 # MEDIA
 ################################################################################################
 bucket_name = "arthouse-media-bucket-storage"
+INGEST_UPLOAD_THREADS = 4       # files uploaded at the same time by create_medias
 
 # ----------------------
 # CREATE   
 # ----------------------
 
+# object name of an original: <digest><ext>, so one name always holds the same
+# bytes, whatever the file was called on the phone
+def content_file_name(file_path, digest):
+    return digest + os.path.splitext(file_path)[1].lower()
+
+# uploads file_path unless the exact same bytes (same digest) are already in the
+# bucket under this media type. returns the file name the media row should use,
+# which is the earlier file's name when the upload was skipped, or None if the
+# upload failed (no row may point at it then).
+# file_name defaults to content_file_name; variants keep their own <digest>_w<width> names
+def _upload_once(file_path, media_type, digest, file_name=None):
+    stored = content_cache.get_upload(digest, bucket_name)
+    if stored and stored.startswith(f"{media_type}/"):
+        print(f"{os.path.basename(file_path)} is already uploaded as {stored}, skipping the upload")
+        return stored.split("/", 1)[1]
+    file_name = file_name or content_file_name(file_path, digest)
+    if not agci.upload_via_signed_url(bucket_name, [file_path], media_type, file_names=[file_name]):
+        return None
+    content_cache.put_upload(digest, bucket_name, f"{media_type}/{file_name}")
+    return file_name
+
+# metadata row values for the file, probed only if this content hasn't been seen before
+def _cached_metadata(file_path, media_type, digest):
+    metadata = content_cache.get_probe(digest, media_type)
+    if metadata is None:
+        metadata = MediaManager.get_metadata(file_path, media_type)
+        content_cache.put_probe(digest, media_type, metadata)
+    return metadata
+
+# smaller copies of a photo (MediaManager.make_variants) already made for this
+# content, as PhotoVariants of the cached files, or None if any are missing.
+# needs the cached probe row to know how wide the photo is
+def _cached_variants(digest, metadata):
+    if metadata is None:
+        return None
+    try:
+        width = int(str(metadata[0]).split("x")[0])
+    except ValueError:
+        return None
+    variants = []
+    for w in MediaManager.VARIANT_WIDTHS:
+        if w >= width:
+            continue
+        for format in MediaManager.VARIANT_FORMATS:
+            path = content_cache.get_derivative(digest, MediaManager.variant_suffix(w, format))
+            if path is None:
+                return None
+            variants.append(MediaManager.PhotoVariant(w, format, path))
+    return variants
+
+# starts making the variants of a photo in the probe pool (unless they're cached).
+# returns (variants or a Future of them, temp folder or None), for _store_variants
+def _start_variants(file_path, digest, metadata):
+    cached = _cached_variants(digest, metadata)
+    if cached is not None:
+        return cached, None
+    out_dir = tempfile.mkdtemp(prefix="variants_")
+    return MediaManager.get_probe_pool().submit(MediaManager.make_variants, file_path, out_dir, digest), out_dir
+
+# waits for the variants, caches them and uploads them to the photo folder.
+# the objects are named <digest>_w<width>.<ext> so identical photos share them.
+# returns [(width, format, file_name)] for photo_variant. a failure here only
+# costs the variants, never the photo
+def _store_variants(digest, variants, out_dir=None):
+    try:
+        if isinstance(variants, Future):
+            variants = variants.result()
+        stored = []
+        for variant in variants:
+            path = variant.path
+            if out_dir:
+                path = content_cache.put_derivative(digest, MediaManager.variant_suffix(variant.width, variant.format), path)
+            file_name = _upload_once(path, 'photo', file_digest(path), os.path.basename(path))
+            if file_name is not None:
+                stored.append((variant.width, variant.format, file_name))
+        return stored
+    except Exception as e:
+        print(f"Could not make the smaller versions of \"{digest}\" : {e}")
+        return []
+    finally:
+        if out_dir:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
 def create_media(post_id, file_path, media_type):
-    file_name = os.path.basename(file_path)
-    extension_name = (os.path.splitext(file_name))[1][1:]
-    file_to_upload = [file_path]
-    
     try:
-        agci.upload_via_signed_url(bucket_name, file_to_upload, media_type)
+        digest = file_digest(file_path)
+        file_name = _upload_once(file_path, media_type, digest)
+        if file_name is None:
+            raise Exception(f"could not upload \"{file_path}\".")
     except Exception as e:
         print(f"Upload to google cloud server : {e}")
+        return False
+    extension_name = (os.path.splitext(file_name))[1][1:]
     try:
+        metadata = _cached_metadata(file_path, media_type, digest)
+        variants = _store_variants(digest, *_start_variants(file_path, digest, metadata)) if media_type == 'photo' else []
         query = """
             INSERT INTO media (post_id, file_name, extension_name, media_type)
             VALUES (%s, %s, %s, %s)
@@ -44,17 +135,15 @@ def create_media(post_id, file_path, media_type):
         media_id = run_cud_query(query, (post_id, file_name, extension_name, media_type))
 
         if media_type == 'photo':
-            resolution = MediaManager.get_photo_metadata(file_path)
             # Insert into `photo` table using media_id + resolution
-            create_photo(media_id, resolution)
+            create_photo(media_id, *metadata)
+            create_photo_variants(media_id, variants)
         elif media_type == 'video':
-            duration, resolution = MediaManager.get_video_metadata(file_path)
             # Insert into `video` table using media_id, duration, resolution
-            create_video(media_id, duration, resolution)
+            create_video(media_id, *metadata)
         elif media_type == 'audio':
-            duration, bitrate = MediaManager.get_audio_metadata(repr(file_path))
             # Insert into `audio` table using media_id, duration, bitrate
-            create_audio(media_id, duration, bitrate)
+            create_audio(media_id, *metadata)
         
         print(f"Added {file_name} to the media and {media_type} database")
     except Exception as e:
@@ -63,41 +152,87 @@ def create_media(post_id, file_path, media_type):
     return True
 
 #   post_id = int, file_paths = {"file_path" : "media type"...}
+#   every file is hashed and uploaded (thread pool) and probed for metadata
+#   (MediaManager's process pool) at the same time, so the post is done in about
+#   the time of its slowest file. files whose content was seen before skip the
+#   upload and/or the probe (ContentCache). photos also get their smaller
+#   variants made in the process pool and uploaded. the database is only touched
+#   once all uploads have finished: media rows + photo/video/audio/photo_variant
+#   rows go in with one insert per table, one commit
 def create_medias(post_id, file_paths):
-    for file_path, media_type in file_paths.items():
-        file_name = os.path.basename(file_path)
-        extension_name = (os.path.splitext(file_name))[1][1:]
-        file_to_upload = [file_path]
-        
+    items = list(file_paths.items())
+    if not items:
+        return True
+
+    probe_pool = MediaManager.get_probe_pool()
+
+    def ingest(file_path, media_type):
+        digest = file_digest(file_path)
+        metadata = content_cache.get_probe(digest, media_type)
+        probe = None if metadata is not None else probe_pool.submit(MediaManager.get_metadata, file_path, media_type)
+        variants, out_dir = _start_variants(file_path, digest, metadata) if media_type == 'photo' else ([], None)
+        try:
+            file_name = _upload_once(file_path, media_type, digest)
+            if file_name is None:
+                raise Exception(f"could not upload \"{file_path}\", it is left out of the post.")
+        except Exception:
+            if probe:
+                probe.cancel()
+            if isinstance(variants, Future):
+                variants.cancel()
+            if out_dir:
+                shutil.rmtree(out_dir, ignore_errors=True)
+            raise
+        return file_name, digest, metadata, probe, _store_variants(digest, variants, out_dir)
+
+    with ThreadPoolExecutor(max_workers=min(INGEST_UPLOAD_THREADS, len(items))) as upload_pool:
+        uploads = [upload_pool.submit(ingest, file_path, media_type) for file_path, media_type in items]
+
+    uploaded = []
+    for (file_path, media_type), upload in zip(items, uploads):
         try:
-            agci.upload_via_signed_url(bucket_name, file_to_upload, media_type)
+            file_name, digest, metadata, probe, variants = upload.result()
         except Exception as e:
             print(f"Upload to google cloud server : {e}")
             continue
-        try:
-            query = """
-                INSERT INTO media (post_id, file_name, extension_name, media_type)
-                VALUES (%s, %s, %s, %s)
-            """
-            media_id = run_cud_query(query, (post_id, file_name, extension_name, media_type))
-
-            if media_type == 'photo':
-                resolution = MediaManager.get_photo_metadata(file_path)
-                # Insert into `photo` table using media_id + resolution
-                create_photo(media_id, resolution)
-            elif media_type == 'video':
-                duration, resolution = MediaManager.get_video_metadata(file_path)
-                # Insert into `video` table using media_id, duration, resolution
-                create_video(media_id, duration, resolution)
-            elif media_type == 'audio':
-                duration, bitrate = MediaManager.get_audio_metadata(repr(file_path))
-                # Insert into `audio` table using media_id, duration, bitrate
-                create_audio(media_id, duration, bitrate)
-            
-            print(f"Added {file_name} to the media and {media_type} database")
-        except Exception as e:
-            print(f"Media failed to be upload and/or be uploaded into the database. [create_media()] : {e}")
-            return False
+        uploaded.append((file_name, media_type, digest, metadata, probe, variants))
+
+    if not uploaded:
+        return False
+    try:
+        media_rows = []
+        type_rows = {'photo': [], 'video': [], 'audio': []}
+        variant_rows = []
+        for file_name, media_type, digest, metadata, probe, variants in uploaded:
+            extension_name = (os.path.splitext(file_name))[1][1:]
+            media_rows.append((post_id, file_name, extension_name, media_type))
+            if probe is not None:
+                metadata = probe.result()
+                content_cache.put_probe(digest, media_type, metadata)
+            type_rows[media_type].append(metadata)
+
+        with transaction():
+            media_ids = run_bulk_insert("media", ("post_id", "file_name", "extension_name", "media_type"), media_rows)
+            if len(media_ids) != len(media_rows):
+                raise Exception("Did not get a media_id back for every file.")
+            ids_by_type = {'photo': [], 'video': [], 'audio': []}
+            for media_id, uploaded_media in zip(media_ids, uploaded):
+                ids_by_type[uploaded_media[1]].append(media_id)
+                variant_rows += [(media_id,) + variant for variant in uploaded_media[5]]
+
+            # same columns as create_photo / create_video / create_audio
+            run_bulk_insert("photo", ("media_id", "resolution"),
+                            [(id,) + tuple(row) for id, row in zip(ids_by_type['photo'], type_rows['photo'])], return_ids=False)
+            run_bulk_insert("video", ("media_id", "duration_seconds", "resolution"),
+                            [(id,) + tuple(row) for id, row in zip(ids_by_type['video'], type_rows['video'])], return_ids=False)
+            run_bulk_insert("audio", ("media_id", "duration_seconds", "bitrate"),
+                            [(id,) + tuple(row) for id, row in zip(ids_by_type['audio'], type_rows['audio'])], return_ids=False)
+            run_bulk_insert("photo_variant", ("media_id", "width", "format", "file_name"), variant_rows, return_ids=False)
+
+        print(f"Added {len(media_rows)} files to the media database for post {post_id}")
+    except Exception as e:
+        print(f"Media failed to be upload and/or be uploaded into the database. [create_medias()] : {e}")
+        return False
     return True
 
 # ----------------------
@@ -120,23 +255,33 @@ def get_media_by_id(media_id):
         print(f"Could not get media: {e}")
         return None
     
-def get_media_url_by_media_ids(media_ids):
-    url = []
-    for id in media_ids:
-        try:
-            media_type = get_media_by_id(id)[3]
-            file_name = get_media_by_id(id)[1]
-            url = url + agci.view_via_signed_url(bucket_name, [file_name], media_type)
-        except Exception as e:
-            print(f"Could not retrieve url [get_media_url_by_media_id()] : {e}")
-            url = url + None
-    return url
+# one query for all the media rows, then the urls are signed locally in one batch.
+# returns the urls in the same order as media_ids, None for ones that couldn't be found.
+# width = how wide the image is shown; photos then get their smallest variant at
+# least that wide (webp=True prefers the WebP one), see choose_photo_variants
+def get_media_url_by_media_ids(media_ids, verify=False, width=None, webp=False):
+    if not media_ids:
+        return []
+    try:
+        placeholders = ','.join(['%s'] * len(media_ids))
+        query = f"SELECT media_id, file_name, media_type FROM media WHERE media_id IN ({placeholders})"
+        rows = {row[0]: (row[1], row[2]) for row in run_read_multiple(query, tuple(media_ids))}
+        if width:
+            for media_id, file_name in choose_photo_variants(list(rows), width, webp).items():
+                rows[media_id] = (file_name, 'photo')
+        found = [id for id in media_ids if id in rows]
+        urls = dict(zip(found, agci.generate_view_urls(bucket_name, [rows[id] for id in found], verify=verify)))
+        return [urls.get(id) for id in media_ids]
+    except Exception as e:
+        print(f"Could not retrieve url [get_media_url_by_media_ids()] : {e}")
+        return [None] * len(media_ids)
 
 def get_media_url_by_media_id(media_id):
     url = ""
     try:
-        media_type = get_media_by_id(media_id)[3]
-        file_name = get_media_by_id(media_id)[1]
+        media = get_media_by_id(media_id)
+        media_type = media[3]
+        file_name = media[1]
         url = agci.view_via_signed_url(bucket_name, [file_name], media_type)
     except Exception as e:
         print(f"Could not retrieve url [get_media_url_by_media_id()] : {e}")
@@ -152,21 +297,46 @@ def get_media_url_by_media_id(media_id):
 # DELETE
 # ----------------------
 
+# deletes the media row (its photo/video/audio/photo_variant rows cascade) in a
+# transaction. the bucket objects nobody else uses are only deleted once that has
+# committed; inside a caller's transaction() that means after the caller's commit,
+# so a rollback never leaves rows pointing at deleted objects
 def delete_media(media_id):
     try:
-        #generate deletion then delete from table
-        media_type = get_media_by_id(media_id)[3]
-        file_name = get_media_by_id(media_id)[1]
-        if agci.delete_via_signed_url(bucket_name, [file_name], media_type):
+        with transaction():
+            media = get_media_by_id(media_id)
+            if media is None:
+                raise Exception("it does not exist.")
+            media_type = media[3]
+            file_name = media[1]
+            objects = _unused_variant_objects(media_id) if media_type == 'photo' else []
+            # identical uploads are shared between media rows (see _upload_once). the
+            # object is named after its content, so rows with the same file_name have
+            # the same bytes: only delete it when this is the last row using it
+            shared = run_read_single(
+                "SELECT COUNT(*) FROM media WHERE file_name = %s AND media_type = %s AND media_id != %s",
+                (file_name, media_type, media_id))[0]
+            if not shared:
+                objects.append((file_name, media_type))
             query = "DELETE FROM media WHERE media_id = %s"
             run_cud_query(query, (media_id,))
-        else:
-            raise f"deletion unsuccessful of \"{file_name}\"."
+            after_commit(lambda: delete_media_objects(objects))
     except Exception as e:
         print(f"Failed to delete media ID: \"{media_id}\" : {e}")
         return False
     return True
 
+# objects = [(file_name, "photo"/"video"/"audio")]. a failed delete only leaves an
+# unused object behind, so it's reported and the rest carry on
+def delete_media_objects(objects):
+    success = True
+    for file_name, media_type in objects:
+        content_cache.forget_upload(bucket_name, f"{media_type}/{file_name}")
+        if not agci.delete_via_signed_url(bucket_name, [file_name], media_type):
+            print(f"Could not delete \"{media_type}/{file_name}\" from the bucket, it is left behind.")
+            success = False
+    return success
+
 
 
 ################################################################################################
@@ -187,6 +357,16 @@ def create_photo(media_id, resolution):
         print(f"[create_photo] Error: {e}")
         return False
 
+# variants = [(width, format, file_name)] from _store_variants
+def create_photo_variants(media_id, variants):
+    try:
+        run_bulk_insert("photo_variant", ("media_id", "width", "format", "file_name"),
+                        [(media_id,) + tuple(variant) for variant in variants], return_ids=False)
+        return True
+    except Exception as e:
+        print(f"[create_photo_variants] Error: {e}")
+        return False
+
 # ----------------------
 # READ 
 # ----------------------
@@ -199,6 +379,32 @@ def get_photo(media_id):
         print(f"[get_photo] Error: {e}")
         return None
 
+# {media_id: [(width, format, file_name)...]} for all the media_ids, one query
+def get_photo_variants(media_ids):
+    if not media_ids:
+        return {}
+    try:
+        placeholders = ','.join(['%s'] * len(media_ids))
+        query = f"SELECT media_id, width, format, file_name FROM photo_variant WHERE media_id IN ({placeholders})"
+        variants = {}
+        for media_id, width, format, file_name in run_read_multiple(query, tuple(media_ids)):
+            variants.setdefault(media_id, []).append((width, format, file_name))
+        return variants
+    except Exception as e:
+        print(f"[get_photo_variants] Error: {e}")
+        return {}
+
+# {media_id: file_name of the variant to show at this width}. photos that are
+# best shown as the original (or have no variants) are left out
+def choose_photo_variants(media_ids, width, webp=False):
+    formats = ("webp", "jpeg") if webp else ("jpeg",)
+    chosen = {}
+    for media_id, variants in get_photo_variants(media_ids).items():
+        variant = MediaManager.choose_variant(variants, width, formats)
+        if variant is not None:
+            chosen[media_id] = variant[2]
+    return chosen
+
 # ----------------------
 # UPDATE
 # ----------------------
@@ -209,7 +415,18 @@ def get_photo(media_id):
 # DELETE
 # ----------------------
 
-# Don't need, deleted with media's delete function
+# the photo and photo_variant rows go with the media row (ON DELETE CASCADE).
+# returns [(file_name, 'photo')] of this photo's variant objects that no other
+# photo with the same content still uses, for delete_media to remove
+def _unused_variant_objects(media_id):
+    query = """
+    SELECT v.file_name, COUNT(other.media_id)
+    FROM photo_variant v
+    LEFT JOIN photo_variant other ON other.file_name = v.file_name AND other.media_id != v.media_id
+    WHERE v.media_id = %s
+    GROUP BY v.file_name
+    """
+    return [(file_name, 'photo') for file_name, shared in run_read_multiple(query, (media_id,)) if not shared]
 
 ################################################################################################
 # VIDEO
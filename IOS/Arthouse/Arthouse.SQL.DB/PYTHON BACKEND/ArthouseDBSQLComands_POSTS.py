@@ -1,7 +1,12 @@
 #perform CRUD operations on post related items in the database (create, read, update, delete)
 
-from queryHelper import run_cud_query, run_read_multiple, run_read_single
-from ArthouseDBSQLComands_MEDIA import create_audio, delete_media, get_media_by_post, create_medias
+from queryHelper import run_cud_query, run_cud_many, run_read_multiple, run_read_single, run_bulk_insert, run_read_stream, STREAM_BATCH_SIZE, transaction
+from queryHelper import encode_page_cursor, keyset_condition
+from ArthouseDBSQLComands_MEDIA import create_audio, delete_media, get_media_by_post, create_medias, choose_photo_variants
+from ArthouseDBSQLComands_TIMELINE import fan_out_post, get_home_timeline
+from RecommendationEngine import engine as recommender
+from HashtagIndex import index as hashtag_index
+from ResponseCache import cache as response_cache, FEED
 
 ################################################################################################
 # POST
@@ -22,11 +27,15 @@ def create_post(username, audio_id=None, post_description="", hashtags=None):
         if post_id is None:
             raise Exception("Failed to retrieve post_id after insert.")
         
-        # Insert hashtags if any
+        # Insert hashtags if any, all in one statement
         if hashtags:
-            insert_hashtag_query = "INSERT INTO hashtag (hashtag, post_id) VALUES (%s, %s)"
-            for tag in hashtags:
-                run_cud_query(insert_hashtag_query, (tag, post_id))
+            insert_hashtags(post_id, hashtags)
+
+        # push it into the followers' home feeds and the recommender
+        fan_out_post(post_id)
+        recommender.add_post(post_id, username, None, hashtags)
+        hashtag_index.set_post_hashtags(post_id, hashtags)
+        response_cache.invalidate(FEED)
         
         return post_id
     except Exception as e:
@@ -51,13 +60,60 @@ def make_post_with_media(username, audio_id=None, post_description="", hashtags=
 # READ (All / By username)  POST
 # ----------------------
 
+# positions in a post row (SELECT * FROM post / p.*), used to build page cursors
+POST_ID_COL = 0
+POST_CREATED_AT_COL = 7
+
+# positions of the media columns in feed rows (p.*, media_id, file_name, extension_name, media_type)
+FEED_MEDIA_ID_COL = -4
+FEED_FILE_NAME_COL = -3
+FEED_EXTENSION_COL = -2
+
+# feed rows with the file_name / extension_name of photos swapped for their
+# smaller variant that fits width (webp=True prefers WebP). width=None -> unchanged
+def with_photo_variants(rows, width=None, webp=False):
+    if not rows or not width:
+        return rows
+    media_ids = list({row[FEED_MEDIA_ID_COL] for row in rows if row[FEED_MEDIA_ID_COL] is not None})
+    chosen = choose_photo_variants(media_ids, width, webp)
+    if not chosen:
+        return rows
+    swapped = []
+    for row in rows:
+        file_name = chosen.get(row[FEED_MEDIA_ID_COL])
+        if file_name is not None:
+            row = list(row)
+            row[FEED_FILE_NAME_COL] = file_name
+            row[FEED_EXTENSION_COL] = file_name.rsplit(".", 1)[1]
+            row = tuple(row)
+        swapped.append(row)
+    return swapped
+
+# token for the page after these rows; None when there's nothing more to get.
+# pass it back as cursor= to the paginated functions / home_feed_algo
+def next_page_cursor(rows, limit):
+    if not rows or len({row[POST_ID_COL] for row in rows}) < limit:
+        return None
+    last = rows[-1]
+    return encode_page_cursor(last[POST_CREATED_AT_COL], last[POST_ID_COL])
+
 # selects only 5 posts at a time from ALL posts
-#increment offset by 5
-def get_posts_paginated(limit=5, offset=0):
+# pass the cursor from next_page_cursor() for the next page. offset still works
+# for old callers but gets slower the deeper you go, prefer the cursor
+def get_posts_paginated(limit=5, offset=0, cursor=None):
     try:
+        if cursor:
+            condition, params = keyset_condition(cursor)
+            query = f"""
+            SELECT * FROM post
+            WHERE {condition}
+            ORDER BY created_at DESC, post_id DESC
+            LIMIT %s
+            """
+            return run_read_multiple(query, params + (limit,))
         query = """
         SELECT * FROM post
-        ORDER BY created_at DESC
+        ORDER BY created_at DESC, post_id DESC
         LIMIT %s OFFSET %s
         """
         return run_read_multiple(query, (limit, offset))
@@ -66,13 +122,22 @@ def get_posts_paginated(limit=5, offset=0):
         return None
 
 #selects only 5 posts at a time from a specific user
-#increment offset by 5
-def get_user_posts_paginated(username, limit=5, offset=0):
+#same cursor rules as get_posts_paginated
+def get_user_posts_paginated(username, limit=5, offset=0, cursor=None):
     try:
+        if cursor:
+            condition, params = keyset_condition(cursor)
+            query = f"""
+            SELECT * FROM post
+            WHERE username = %s AND {condition}
+            ORDER BY created_at DESC, post_id DESC
+            LIMIT %s
+            """
+            return run_read_multiple(query, (username,) + params + (limit,))
         query = """
         SELECT * FROM post
         WHERE username = %s
-        ORDER BY created_at DESC
+        ORDER BY created_at DESC, post_id DESC
         LIMIT %s OFFSET %s
         """
         return run_read_multiple(query, (username, limit, offset))
@@ -98,6 +163,25 @@ def get_all_posts_of_user(username):
         print(f"Failed to get all posts for {username}: {e}")
         return None
 
+# streaming versions of the two above: yield one post at a time in constant memory.
+# use these for exports / full scans. errors are printed and re-raised so a
+# partial export doesn't look like a complete one
+def stream_all_posts(batch_size=STREAM_BATCH_SIZE):
+    try:
+        query = "SELECT * FROM post ORDER BY created_at DESC"
+        yield from run_read_stream(query, batch_size=batch_size)
+    except Exception as e:
+        print(f"Failed streaming all posts: {e}")
+        raise
+
+def stream_all_posts_of_user(username, batch_size=STREAM_BATCH_SIZE):
+    try:
+        query = "SELECT * FROM post WHERE username = %s ORDER BY created_at DESC"
+        yield from run_read_stream(query, (username,), batch_size=batch_size)
+    except Exception as e:
+        print(f"Failed streaming posts for {username}: {e}")
+        raise
+
 def get_number_of_posts(username):
     try:
         query = "SELECT COUNT(*) FROM post WHERE username = %s"
@@ -107,25 +191,17 @@ def get_number_of_posts(username):
         print(f"Failed to get number of posts for {username}: {e}")
         return None
 
+# every post with at least one of the hashtags, newest first, as one list (None on failure).
+# kept for old callers, new code should page with search_by_hashtags
 def get_posts_containing_hashtags(list_of_hashtags):
-    if not list_of_hashtags:
-        return []
-    try:
-        placeholders = ','.join(['%s'] * len(list_of_hashtags))
-        query = f"""
-            SELECT DISTINCT p.*
-            FROM post p
-            JOIN hashtag h ON p.post_id = h.post_id
-            WHERE h.hashtag IN ({placeholders})
-            ORDER BY p.created_at DESC
-        """
-        return run_read_multiple(query, tuple(list_of_hashtags))
-    except Exception as e:
-        print(f"Failed to retrieve posts containing the hashtags:")
-        for tag in list_of_hashtags:
-            print(tag)     
-        print(" : {e}")
-        return None
+    posts, cursor = [], None
+    while True:
+        rows, cursor = search_by_hashtags(list_of_hashtags, cursor=cursor, limit=STREAM_BATCH_SIZE)
+        if rows is None:
+            return None
+        posts += rows
+        if cursor is None:
+            return posts
 
 
 
@@ -137,20 +213,39 @@ def get_posts_containing_hashtags(list_of_hashtags):
 
 # Home: you, your follower’s, and who you follow's post
 # Fetch posts with relations to you
-def home_feed_algo(username, offset=0):
+# served from the precomputed home_timeline. the query below (pull) is the fallback
+# for offset callers, timelines that were trimmed or never built, and the end of the feed.
+# posts are paged first and then joined with media, so a post with several media
+# rows is never split across two pages. same cursor rules as get_posts_paginated.
+# width = how wide the client shows images, photos then point at their closest
+# smaller variant instead of the original (see with_photo_variants)
+def home_feed_algo(username, offset=0, cursor=None, limit=5, width=None, webp=False):
+    if not offset:
+        rows = get_home_timeline(username, cursor, limit)
+        if rows and len({row[POST_ID_COL] for row in rows}) == limit:
+            return with_photo_variants(rows, width, webp)
     try:
-        query = """
+        page_condition, page_params = "", ()
+        if cursor:
+            condition, page_params = keyset_condition(cursor)
+            page_condition = f"AND {condition}"
+        query = f"""
         SELECT p.*, m.media_id, m.file_name, m.extension_name, m.media_type
-        FROM post p
+        FROM (
+            SELECT * FROM post
+            WHERE (username = %s
+               OR username IN (
+                    SELECT followee FROM follower_relationships WHERE follower = %s
+               ))
+            {page_condition}
+            ORDER BY created_at DESC, post_id DESC
+            LIMIT %s OFFSET %s
+        ) p
         LEFT JOIN media m ON p.post_id = m.post_id
-        WHERE p.username = %s
-           OR p.username IN (
-                SELECT followee FROM follower_relationships WHERE follower = %s
-           )
-        ORDER BY p.created_at DESC
-        LIMIT 5 OFFSET %s
+        ORDER BY p.created_at DESC, p.post_id DESC
         """
-        return run_read_multiple(query, (username, username, offset))
+        rows = run_read_multiple(query, (username, username) + page_params + (limit, 0 if cursor else offset))
+        return with_photo_variants(rows, width, webp)
     except Exception as e:
         print(f"Posts failed to load [home_feed_algo()] : {e}")
         return None
@@ -164,51 +259,28 @@ def home_feed_algo(username, offset=0):
 #      -Recommend similar posts with the similar hashtags
 # NOTE: dont just recommend ONLY post with hashtags, 
 #       maybe give a higher percentage to favor posts with those hashtags
+#
+# The ranking is done by RecommendationEngine (precomputed hashtag vectors, scored
+# with recency decay and cached per user), so this is just one primary key lookup.
+# Rows are p.*, media columns and priority (1 = hashtag match, 2 = fallback)
 
-def recommended_feed_algo(username):
+def recommended_feed_algo(username, limit=10):
     try:
-        print(f"Running recommended feed for user: {username}")
-        query = """
-        WITH liked_hashtags AS (
-            SELECT h.hashtag
-            FROM user_liked_relationships ul
-            JOIN hashtag h ON ul.post_id = h.post_id
-            WHERE ul.username = %s
-        ),
-        top_hashtags AS (
-            SELECT hashtag, COUNT(*) AS freq
-            FROM liked_hashtags
-            GROUP BY hashtag
-            ORDER BY freq DESC
-            LIMIT 5
-        ),
-        hashtag_posts AS (
-            SELECT DISTINCT p.*, m.media_id, m.file_name, m.extension_name, m.media_type, 1 AS priority
-            FROM post p
-            LEFT JOIN media m ON p.post_id = m.post_id
-            JOIN hashtag h ON p.post_id = h.post_id
-            WHERE h.hashtag IN (SELECT hashtag FROM top_hashtags)
-              AND p.username != %s
-        ),
-        fallback_posts AS (
-            SELECT p.*, m.media_id, m.file_name, m.extension_name, m.media_type, 2 AS priority
-            FROM post p
-            LEFT JOIN media m ON p.post_id = m.post_id
-            WHERE p.username != %s
-              AND p.post_id NOT IN (SELECT post_id FROM hashtag_posts)
-        ),
-        combined_posts AS (
-            SELECT * FROM hashtag_posts
-            UNION ALL
-            SELECT * FROM fallback_posts
-        )
-        SELECT * FROM combined_posts
-        ORDER BY priority, created_at DESC
-        LIMIT 10
+        ranked = recommender.recommend(username, limit)
+        if not ranked:
+            return []
+        priorities = dict(ranked)
+        position = {post_id: i for i, (post_id, _) in enumerate(ranked)}
+        placeholders = ','.join(['%s'] * len(ranked))
+        query = f"""
+        SELECT p.*, m.media_id, m.file_name, m.extension_name, m.media_type
+        FROM post p
+        LEFT JOIN media m ON p.post_id = m.post_id
+        WHERE p.post_id IN ({placeholders})
         """
-        result = run_read_multiple(query, (username, username, username))
-        print(f"Got {len(result)} recommended posts.")
-        return result
+        rows = run_read_multiple(query, tuple(position))
+        rows.sort(key=lambda row: position[row[POST_ID_COL]])
+        return [tuple(row) + (priorities[row[POST_ID_COL]],) for row in rows]
     except Exception as e:
         print(f"Posts failed to load [recommended_feed_algo()] : {e}")
         return None
@@ -218,38 +290,44 @@ def recommended_feed_algo(username):
 # UPDATE        POST
 # ----------------------
 
+# everything runs in one transaction, so a failure part way through
+# (e.g. while re-inserting hashtags) leaves the post untouched
 def update_post(post_id, new_audio_id=None, post_description="", hashtags=None, is_private=None):
     try:
-        updates = []
-        values = []
-
-        if new_audio_id is not None:
-            updates.append("audio_id = %s")
-            values.append(new_audio_id)
-            old_audio_id = get_media_by_post(post_id)
-            delete_media(old_audio_id)          # if changing the audio file, must delete the old one 
-            create_audio(new_audio_id)          # and reupload
-
-        if post_description is not None:
-            updates.append("post_description = %s")
-            values.append(post_description)
-
-        if is_private is not None:
-            updates.append("is_private = %s")
-            values.append(is_private)
-
-        if updates:
-            query = f"UPDATE post SET {', '.join(updates)} WHERE post_id = %s"
-            values.append(post_id)
-            run_cud_query(query, tuple(values))
-
-        # Handle hashtags (clear and insert new ones)
+        with transaction():
+            updates = []
+            values = []
+
+            if new_audio_id is not None:
+                updates.append("audio_id = %s")
+                values.append(new_audio_id)
+                old_audio_id = get_media_by_post(post_id)
+                delete_media(old_audio_id)          # if changing the audio file, must delete the old one 
+                create_audio(new_audio_id)          # and reupload
+
+            if post_description is not None:
+                updates.append("post_description = %s")
+                values.append(post_description)
+
+            if is_private is not None:
+                updates.append("is_private = %s")
+                values.append(is_private)
+
+            if updates:
+                query = f"UPDATE post SET {', '.join(updates)} WHERE post_id = %s"
+                values.append(post_id)
+                run_cud_query(query, tuple(values))
+
+            # Handle hashtags (clear and insert new ones)
+            if hashtags is not None:
+                delete_query = "DELETE FROM hashtag WHERE post_id = %s"
+                run_cud_query(delete_query, (post_id,))
+                insert_hashtags(post_id, hashtags)
+
         if hashtags is not None:
-            delete_query = "DELETE FROM hashtag WHERE post_id = %s"
-            run_cud_query(delete_query, (post_id,))
-            insert_query = "INSERT INTO hashtag (hashtag, post_id) VALUES (%s, %s)"
-            for tag in hashtags:
-                run_cud_query(insert_query, (tag, post_id))
+            recommender.update_post_hashtags(post_id, hashtags)
+            hashtag_index.set_post_hashtags(post_id, hashtags)
+        response_cache.invalidate(FEED)
 
         return True
 
@@ -262,13 +340,20 @@ def update_post(post_id, new_audio_id=None, post_description="", hashtags=None,
 # ----------------------
 
 def delete_post(post_id):
-    #deletes post and everything associated with it (likes, media, etc)
+    #deletes post and everything associated with it (likes, media, home_timeline entries, etc)
+    #media is looked up before the post row goes, otherwise the cascade has already removed it.
+    #delete_media only removes the bucket objects once this transaction has committed
     try:
-        query = "DELETE FROM post WHERE post_id = %s"
-        run_cud_query(query, (post_id,))
-        medias = get_media_by_post(post_id=post_id)
-        for id in medias:
-            delete_media(id)
+        with transaction():
+            medias = get_media_by_post(post_id=post_id)
+            for media in medias:
+                if not delete_media(media[0]):
+                    raise Exception(f"media \"{media[0]}\" could not be deleted.")
+            query = "DELETE FROM post WHERE post_id = %s"
+            run_cud_query(query, (post_id,))
+        recommender.remove_post(post_id)
+        hashtag_index.remove_post(post_id)
+        response_cache.invalidate(FEED)
         return True
     except Exception as e:
         print(f"The post \"{post_id}\" failed to be deleted. Verify it exists. : {e}")
@@ -284,33 +369,49 @@ def delete_post(post_id):
 # CREATE        hashtag
 # ----------------------
 
-# Not needed, is created when a post is created.
+# Created when a post is created/updated.
+# inserts every hashtag for a post in one multi-row insert (one round trip).
+# duplicates are dropped since (hashtag, post_id) is the primary key
+def insert_hashtags(post_id, hashtags):
+    unique_tags = list(dict.fromkeys(hashtags))
+    run_bulk_insert("hashtag", ("hashtag", "post_id"), [(tag, post_id) for tag in unique_tags], return_ids=False)
 
 
 # ----------------------
 # READ          hashtags
 # ----------------------
 
-#find all posts that are associated with the hashtags in the parameter.
-def search_by_hashtags(hashtags):
+#find posts that are associated with the hashtags in the parameter, newest first.
+#the matching is done on the in-memory HashtagIndex, the database only fetches one page by id.
+#   match="any" -> has at least one of the hashtags,  match="all" -> has all of them
+#   exclude     -> leave out posts with any of these hashtags
+#   cursor      -> next_cursor from the previous page
+# returns (rows, next_cursor), next_cursor is None on the last page. a page can
+# be short (posts deleted by another process), keep going until next_cursor is None
+def search_by_hashtags(hashtags, match="any", exclude=None, limit=20, cursor=None):
     if not hashtags:
-        return []
+        return [], None
     try:
-        placeholders = ','.join(['%s'] * len(hashtags))
+        post_ids, next_cursor = hashtag_index.search(hashtags, match, exclude, limit, cursor)
+        if not post_ids:
+            return [], next_cursor
+        placeholders = ','.join(['%s'] * len(post_ids))
         query = f"""
-            SELECT DISTINCT p.*
-            FROM post p
-            JOIN hashtag h ON p.post_id = h.post_id
-            WHERE h.hashtag IN ({placeholders})
-            ORDER BY p.created_at DESC
+            SELECT * FROM post
+            WHERE post_id IN ({placeholders})
+            ORDER BY post_id DESC
         """
-        return run_read_multiple(query, tuple(hashtags))
+        rows = run_read_multiple(query, tuple(post_ids))
+        # gone from the database, don't hand them out again before the next rebuild
+        for post_id in set(post_ids) - {row[POST_ID_COL] for row in rows}:
+            hashtag_index.remove_post(post_id)
+        return rows, next_cursor
     except Exception as e:
         print(f"An error occured searching for posts containing the hashtags:")
         for tag in hashtags:
             print(tag)
         print(" : ", e)
-        return None
+        return None, None
 
 
 # ----------------------
@@ -339,6 +440,8 @@ def like_post(username, post_id):
     try:
         query = "INSERT INTO user_liked_relationships (username, post_id) VALUES (%s, %s)"
         run_cud_query(query, (username, post_id))
+        recommender.record_like(username, post_id)
+        response_cache.invalidate(FEED)
         return True
     except Exception as e:
         print(f"Failed to like post \"{post_id}\". : {e}")
@@ -385,8 +488,13 @@ def unlike_post(username, post_id):
         queryUnlike = """UPDATE post
                 SET like_count = GREATEST(like_count - 1, 0)
                 WHERE post_id = %s"""
-        run_cud_query(queryDelete, (username, post_id))
-        run_cud_query(queryUnlike, (post_id,))
+        with transaction():
+            # nothing to undo if the user hadn't liked it
+            if not run_cud_many(queryDelete, [(username, post_id)]):
+                return True
+            run_cud_query(queryUnlike, (post_id,))
+        recommender.record_like(username, post_id, -1)
+        response_cache.invalidate(FEED)
         return True
     except Exception as e:
         print(f"The post \"{post_id}\" failed to be unliked. Verify that \"{post_id}\" exists. : {e}")
@@ -409,6 +517,7 @@ def create_comment(username, post_id, comment_text):
         VALUES (%s, %s, %s)
         """
         run_cud_query(query, (username, post_id, comment_text))
+        response_cache.invalidate(FEED)      # comment_count
         return True
     except Exception as e:
         print(f"Failed to create comment: {e}")
@@ -482,6 +591,7 @@ def delete_comment(comment_id):
         WHERE comment_id = %s
         """
         run_cud_query(query, (comment_id,))
+        response_cache.invalidate(FEED)
         return True
     except Exception as e:
         print(f"Failed to delete comment: {e}")
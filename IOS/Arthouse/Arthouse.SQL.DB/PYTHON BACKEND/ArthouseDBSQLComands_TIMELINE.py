@@ -0,0 +1,251 @@
+###############################################################
+#   Home feeds are pushed, not pulled.
+#   When a post is made its id is copied into the home_timeline
+#   of the author and every follower (fan-out on write), so
+#   reading a feed page is one range read on home_timeline.
+#   Accounts with a huge follower count are NOT fanned out,
+#   their posts are pulled in at read time instead. Which way
+#   a post went is stored on it (post.fanned_out), so a post
+#   is still pulled after its author drops below the limit.
+#   Timelines are trimmed back to TIMELINE_MAX_LENGTH by a
+#   background thread, never inside the request that posted.
+###############################################################
+
+#perform CRUD operations on the home_timeline table (create, read, update, delete)
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from queryHelper import run_cud_query, run_cud_many, run_read_multiple, run_read_single, keyset_condition, after_commit
+
+# accounts with at least this many followers are read at feed time instead of fanned out
+CELEBRITY_FOLLOWER_COUNT = 10000
+# how many entries a timeline keeps; older pages fall back to the pull query
+TIMELINE_MAX_LENGTH = 800
+
+################################################################################################
+# home_timeline
+################################################################################################
+
+
+# ----------------------
+# CREATE
+# ----------------------
+
+# pushes a new post into its author's timeline and, unless the author has
+# CELEBRITY_FOLLOWER_COUNT or more followers, all the followers' timelines
+# (marking the post fanned_out). the timelines that got it are queued for
+# trimming once the post is committed.
+# call after the post row exists (same transaction is fine)
+def fan_out_post(post_id):
+    try:
+        author = run_read_single("""
+        SELECT p.username, pr.follower_count
+        FROM post p
+        JOIN profile pr ON pr.username = p.username
+        WHERE p.post_id = %s
+        """, (post_id,))
+        if author is None:
+            raise Exception("the post does not exist.")
+        username, follower_count = author
+        query = """
+        INSERT IGNORE INTO home_timeline (username, post_id, created_at)
+        SELECT username, post_id, created_at FROM post WHERE post_id = %s
+        """
+        run_cud_query(query, (post_id,))
+        if (follower_count or 0) < CELEBRITY_FOLLOWER_COUNT:
+            query = """
+            INSERT IGNORE INTO home_timeline (username, post_id, created_at)
+            SELECT fr.follower, p.post_id, p.created_at
+            FROM post p
+            JOIN follower_relationships fr ON fr.followee = p.username
+            WHERE p.post_id = %s
+            """
+            run_cud_query(query, (post_id,))
+            run_cud_query("UPDATE post SET fanned_out = TRUE WHERE post_id = %s", (post_id,))
+            after_commit(lambda: schedule_trim([username], followers_of=username))
+        else:
+            after_commit(lambda: schedule_trim([username]))
+        return True
+    except Exception as e:
+        print(f"Failed to fan out post \"{post_id}\" : {e}")
+        return False
+
+# after a follow: copy the followee's most recent posts into the follower's timeline
+def backfill_timeline(follower_username, followee_username):
+    try:
+        query = """
+        INSERT IGNORE INTO home_timeline (username, post_id, created_at)
+        SELECT %s, post_id, created_at FROM post
+        WHERE username = %s
+        ORDER BY created_at DESC, post_id DESC
+        LIMIT %s
+        """
+        run_cud_query(query, (follower_username, followee_username, TIMELINE_MAX_LENGTH))
+        after_commit(lambda: schedule_trim([follower_username]))
+        return True
+    except Exception as e:
+        print(f"Failed to backfill \"{follower_username}\"'s timeline with \"{followee_username}\" : {e}")
+        return False
+
+# rebuilds one user's timeline from scratch (their posts + everyone they follow)
+def rebuild_timeline(username):
+    try:
+        run_cud_query("DELETE FROM home_timeline WHERE username = %s", (username,))
+        query = """
+        INSERT IGNORE INTO home_timeline (username, post_id, created_at)
+        SELECT %s, post_id, created_at FROM post
+        WHERE username = %s
+           OR username IN (
+                SELECT followee FROM follower_relationships WHERE follower = %s
+           )
+        ORDER BY created_at DESC, post_id DESC
+        LIMIT %s
+        """
+        run_cud_query(query, (username, username, username, TIMELINE_MAX_LENGTH))
+        return True
+    except Exception as e:
+        print(f"Failed to rebuild the timeline of \"{username}\" : {e}")
+        return False
+
+# ----------------------
+# READ
+# ----------------------
+
+# one page of "username"'s home feed, same row shape as home_feed_algo
+# (post columns + media_id, file_name, extension_name, media_type).
+# pushed entries and followed accounts' posts that weren't fanned out (made while
+# the author was a celebrity) are merged newest first
+def get_home_timeline(username, cursor=None, limit=5):
+    try:
+        pushed_condition, pushed_params = "", ()
+        pulled_condition, pulled_params = "", ()
+        if cursor:
+            condition, pushed_params = keyset_condition(cursor)
+            pushed_condition = f"AND {condition}"
+            condition, pulled_params = keyset_condition(cursor, "p.created_at", "p.post_id")
+            pulled_condition = f"AND {condition}"
+        query = f"""
+        SELECT p.*, m.media_id, m.file_name, m.extension_name, m.media_type
+        FROM (
+            SELECT post_id, created_at FROM (
+                SELECT post_id, created_at FROM home_timeline
+                WHERE username = %s {pushed_condition}
+                ORDER BY created_at DESC, post_id DESC
+                LIMIT %s
+            ) pushed
+            UNION
+            SELECT post_id, created_at FROM (
+                SELECT p.post_id, p.created_at
+                FROM post p
+                JOIN follower_relationships fr ON fr.followee = p.username
+                WHERE fr.follower = %s AND p.fanned_out = FALSE {pulled_condition}
+                ORDER BY p.created_at DESC, p.post_id DESC
+                LIMIT %s
+            ) pulled
+            ORDER BY created_at DESC, post_id DESC
+            LIMIT %s
+        ) page
+        JOIN post p ON p.post_id = page.post_id
+        LEFT JOIN media m ON p.post_id = m.post_id
+        ORDER BY p.created_at DESC, p.post_id DESC
+        """
+        params = ((username,) + pushed_params + (limit,)
+                  + (username,) + pulled_params + (limit, limit))
+        return run_read_multiple(query, params)
+    except Exception as e:
+        print(f"Failed to load the timeline of \"{username}\" : {e}")
+        return None
+
+# ----------------------
+# UPDATE
+# ----------------------
+
+# Not needed. Entries are only added or removed
+
+# ----------------------
+# DELETE
+# ----------------------
+
+# entries of a deleted post go with it (ON DELETE CASCADE on post_id)
+
+# after an unfollow: take the followee's posts back out of the follower's timeline
+def remove_from_timeline(follower_username, followee_username):
+    try:
+        query = """
+        DELETE t FROM home_timeline t
+        JOIN post p ON p.post_id = t.post_id
+        WHERE t.username = %s AND p.username = %s
+        """
+        run_cud_query(query, (follower_username, followee_username))
+        return True
+    except Exception as e:
+        print(f"Failed to remove \"{followee_username}\" from \"{follower_username}\"'s timeline : {e}")
+        return False
+
+# drops the entries past max_length from one timeline: finds the first entry to
+# go, then deletes it and everything older. both are range reads on the primary
+# key (username, created_at, post_id), at most max_length + 1 index entries.
+# returns the number of entries removed
+def trim_timeline(username, max_length=TIMELINE_MAX_LENGTH):
+    boundary = run_read_single("""
+    SELECT created_at, post_id FROM home_timeline
+    WHERE username = %s
+    ORDER BY created_at DESC, post_id DESC
+    LIMIT 1 OFFSET %s
+    """, (username, max_length))
+    if boundary is None:
+        return 0
+    created_at, post_id = boundary
+    return run_cud_many("""
+    DELETE FROM home_timeline
+    WHERE username = %s AND (created_at < %s OR (created_at = %s AND post_id <= %s))
+    """, [(username, created_at, created_at, post_id)])
+
+
+# ----------------------
+# background trimming
+# ----------------------
+# timelines that got new entries wait in a set, so a burst of posts trims each
+# one once. a single thread works through it off the request path
+
+_trim_lock = threading.Lock()
+_trim_pending = set()           # usernames whose timeline may be over the limit
+_trim_followers_of = set()      # authors whose followers' timelines got a post
+_trim_running = False
+_trim_pool = ThreadPoolExecutor(max_workers=1)
+
+def schedule_trim(usernames=(), followers_of=None):
+    global _trim_running
+    with _trim_lock:
+        _trim_pending.update(usernames)
+        if followers_of is not None:
+            _trim_followers_of.add(followers_of)
+        if _trim_running:
+            return
+        _trim_running = True
+    _trim_pool.submit(_run_trims)
+
+def _run_trims():
+    global _trim_running
+    while True:
+        with _trim_lock:
+            if _trim_followers_of:
+                author = _trim_followers_of.pop()
+                username = None
+            elif _trim_pending:
+                author = None
+                username = _trim_pending.pop()
+            else:
+                _trim_running = False
+                return
+        try:
+            if author is not None:
+                followers = run_read_multiple(
+                    "SELECT follower FROM follower_relationships WHERE followee = %s", (author,))
+                with _trim_lock:
+                    _trim_pending.update(row[0] for row in followers)
+            else:
+                trim_timeline(username)
+        except Exception as e:
+            print(f"Failed to trim the timeline of \"{author or username}\" : {e}")
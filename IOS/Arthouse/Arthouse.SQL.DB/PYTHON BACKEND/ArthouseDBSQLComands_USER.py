@@ -7,8 +7,18 @@
 #perform CRUD operations on user data in the database (create, read, update, delete)
 
 
-import bcrypt
-from queryHelper import run_cud_query, run_read_multiple, run_read_single
+from queryHelper import run_cud_query, run_read_multiple, run_read_single, run_read_stream, STREAM_BATCH_SIZE
+# after queryHelper, which loads the .env file these read their settings from
+from PasswordHasher import hasher, HasherBusy
+from SessionTokens import sessions
+from ArthouseDBSQLComands_TIMELINE import backfill_timeline, remove_from_timeline
+from ResponseCache import cache as response_cache, profile_namespace, FEED
+
+# profiles are invalidated explicitly (follow/unfollow/update_profile), the TTL only
+# bounds how stale a count can get from writes made outside these functions
+PROFILE_CACHE_SECONDS = 300
+# usernames per IN (...) query in get_profiles_by_usernames
+PROFILE_BATCH_SIZE = 500
 
 
 ################################################################################################
@@ -20,12 +30,18 @@ from queryHelper import run_cud_query, run_read_multiple, run_read_single
 # ----------------------
 # CREATE (Register) USER
 # ----------------------
-def create_user(username, email, password):
+# password_hash: pass hasher.hash_password(password) when it was already hashed
+# (e.g. before opening a transaction, so no connection is held while bcrypt runs).
+# raises HasherBusy when the password hasher is saturated
+def create_user(username, email, password, password_hash=None):
     try:
-        password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        if password_hash is None:
+            password_hash = hasher.hash_password(password)
         query = "INSERT INTO user (username, email, password_hash) VALUES (%s, %s, %s)"
         run_cud_query(query, (username, email, password_hash))
         return True
+    except HasherBusy:
+        raise
     except Exception as e:
         print(f"Could not create \"{username}\". Perhaps the user already exists? : {e}")
         return False
@@ -42,6 +58,16 @@ def get_all_users():
         print(f"Users could be loaded idk why. : {e}")
         return None
 
+# same as get_all_users but yields one user at a time in constant memory.
+# errors are re-raised so a partial scan doesn't look complete
+def stream_all_users(batch_size=STREAM_BATCH_SIZE):
+    try:
+        query = "SELECT username, email FROM user"
+        yield from run_read_stream(query, batch_size=batch_size)
+    except Exception as e:
+        print(f"Failed streaming users. : {e}")
+        raise
+
 def get_user_by_username(username):
     try:
         query = "SELECT username, email FROM user WHERE username = %s"
@@ -65,7 +91,7 @@ def update_user(username, new_username=None, email=None, password=None):
             updates.append("email = %s")
             values.append(email)
         if password:
-            hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+            hashed = hasher.hash_password(password)
             updates.append("password_hash = %s")
             values.append(hashed)
 
@@ -75,6 +101,12 @@ def update_user(username, new_username=None, email=None, password=None):
         values.append(username)
         query = f"UPDATE user SET {', '.join(updates)} WHERE username = %s"
         run_cud_query(query, tuple(values))
+        if password or new_username:
+            # log out every existing session (they carry the old name / predate the new password)
+            sessions.revoke_user(username)
+        if new_username:
+            # renames cascade into profile and post
+            response_cache.invalidate(profile_namespace(username), profile_namespace(new_username), FEED)
         return True
     except Exception as e:
         print(f"Updating to \"{username}\" failed. : {e}")
@@ -87,51 +119,43 @@ def delete_user(username):
     try:
         query = "DELETE FROM user WHERE username = %s"
         run_cud_query(query, (username,))
+        # their tokens must not carry over to whoever registers the name next
+        sessions.revoke_user(username)
+        # their posts go with them (cascade)
+        response_cache.invalidate(profile_namespace(username), FEED)
         return True
     except Exception as e:
         print(f"\"{username}\" could not be deleted. Verify that \"{username}\" exists. : {e}")
         return False
 
 # ----------------------
-# LOGIN / VERIFY PASSWORD - FIXED VERSION
+# LOGIN / VERIFY PASSWORD
 # ----------------------
+# bcrypt runs in PasswordHasher's process pool; raises HasherBusy when it's saturated.
+# a hash made with a lower cost than BCRYPT_ROUNDS is replaced after a successful login
 def verify_user_login(username, password_attempt):
+    if not username or not password_attempt:
+        return False
     query = "SELECT password_hash FROM user WHERE username = %s"
     result = run_read_single(query, (username,))
-    
-    print(f"🔍 Debug: username = '{username}'")
-    print(f"🔍 Debug: result = {result}")
-    print(f"🔍 Debug: result type = {type(result)}")
-    
-    if result:
-        # Extract the password hash from the tuple
-        if isinstance(result, tuple):
-            stored_hash = result[0]  # Get first element from tuple
-        else:
-            stored_hash = result
-            
-        print(f"🔍 Debug: stored_hash = '{stored_hash}'")
-        print(f"🔍 Debug: stored_hash type = {type(stored_hash)}")
-        
-        # Make sure stored_hash is a string
-        if stored_hash:
-            try:
-                if bcrypt.checkpw(password_attempt.encode('utf-8'), stored_hash.encode('utf-8')):
-                    print("✅ Password verification successful!")
-                    return True
-                else:
-                    print("❌ Password verification failed - wrong password")
-                    return False
-            except Exception as e:
-                print(f"❌ Bcrypt error: {e}")
-                return False
-        else:
-            print("❌ No stored hash found")
-            return False
-    else:
-        print("❌ User not found in database")
+    if not result or not result[0]:
         return False
 
+    try:
+        matches, new_hash = hasher.check_password(password_attempt, result[0])
+    except HasherBusy:
+        raise
+    except Exception as e:
+        print(f"Password check for \"{username}\" failed : {e}")
+        return False
+
+    if matches and new_hash:
+        try:
+            run_cud_query("UPDATE user SET password_hash = %s WHERE username = %s", (new_hash, username))
+        except Exception as e:
+            print(f"Could not upgrade the password hash of \"{username}\" : {e}")
+    return matches
+
 
 
 ################################################################################################
@@ -164,6 +188,14 @@ def get_all_profiles():
         print(f"Could not fetch all profiles. : {e}")
         return None
 
+def stream_all_profiles(batch_size=STREAM_BATCH_SIZE):
+    try:
+        query = "SELECT name, username, profile_picture_url, bio FROM profile"
+        yield from run_read_stream(query, batch_size=batch_size)
+    except Exception as e:
+        print(f"Failed streaming profiles. : {e}")
+        raise
+
 def get_profile_by_username(username):
     try:
         query = "SELECT name, username, profile_picture_url, bio FROM profile WHERE username = %s"
@@ -173,6 +205,60 @@ def get_profile_by_username(username):
         print(f"An error occured. {username} was not found. : {e}")
         return None
 
+# profile with its follower/following counts as a dict, one row read. the counts are
+# the columns kept up to date by the follow triggers, nobody's followers get loaded.
+# cached until the profile changes or someone (un)follows it. None if not found
+def get_profile_summary(username):
+    return response_cache.get_or_load(profile_namespace(username), "summary",
+                                      lambda: _load_profile_summary(username), ttl=PROFILE_CACHE_SECONDS)
+
+PROFILE_SUMMARY_COLUMNS = "name, username, profile_picture_url, bio, follower_count, following_count"
+
+def _profile_summary(profile):
+    return {
+        "name": profile[0],
+        "username": profile[1],
+        "profile_picture_url": profile[2],
+        "bio": profile[3],
+        "follower_count": profile[4] or 0,
+        "following_count": profile[5] or 0,
+    }
+
+def _load_profile_summary(username):
+    try:
+        query = f"SELECT {PROFILE_SUMMARY_COLUMNS} FROM profile WHERE username = %s"
+        profile = run_read_single(query, (username,))
+        if profile is None:
+            return None
+        return _profile_summary(profile)
+    except Exception as e:
+        print(f"An error occured. {username}'s profile could not be loaded. : {e}")
+        return None
+
+# {username: profile summary (same dict as get_profile_summary)} for many users.
+# cached ones come from the cache, the rest are read with one IN query per
+# PROFILE_BATCH_SIZE usernames. usernames that don't exist are left out
+def get_profiles_by_usernames(usernames):
+    usernames = list(dict.fromkeys(username for username in usernames if username))
+    if not usernames:
+        return {}
+    return response_cache.get_many_or_load(
+        {username: (profile_namespace(username), "summary") for username in usernames},
+        _load_profile_summaries, ttl=PROFILE_CACHE_SECONDS)
+
+def _load_profile_summaries(usernames):
+    profiles = {}
+    try:
+        for start in range(0, len(usernames), PROFILE_BATCH_SIZE):
+            chunk = usernames[start:start + PROFILE_BATCH_SIZE]
+            placeholders = ','.join(['%s'] * len(chunk))
+            query = f"SELECT {PROFILE_SUMMARY_COLUMNS} FROM profile WHERE username IN ({placeholders})"
+            for profile in run_read_multiple(query, tuple(chunk)):
+                profiles[profile[1]] = _profile_summary(profile)
+    except Exception as e:
+        print(f"Could not load the profiles of {len(usernames)} users. : {e}")
+    return profiles
+
 # ----------------------
 # UPDATE PROFILE
 # ----------------------
@@ -199,6 +285,12 @@ def update_profile(username, new_username=None, name=None, profile_picture_url=N
         values.append(username)
         query = f"UPDATE profile SET {', '.join(updates)} WHERE username = %s"
         run_cud_query(query, tuple(values))
+        response_cache.invalidate(profile_namespace(username))
+        if new_username or name or profile_picture_url:
+            # feed pages carry the author's name and picture
+            response_cache.invalidate(FEED)
+        if new_username:
+            response_cache.invalidate(profile_namespace(new_username))
         return True
     except Exception as e:
         print(f"An error occured. Verify that {username} exists in user. : {e}")
@@ -232,6 +324,8 @@ def follow(follower_username, followee_username):
             raise ValueError("Follower or followee does not exist.")
         query = "INSERT INTO follower_relationships (follower, followee) VALUES (%s, %s)"
         run_cud_query(query, (follower_username, followee_username))
+        backfill_timeline(follower_username, followee_username)
+        response_cache.invalidate(profile_namespace(follower_username), profile_namespace(followee_username))
         return True
     except Exception as e:
         print(f"Failed to follow from \"{follower_username}\" to \"{followee_username}\" : {e}")
@@ -250,6 +344,14 @@ def view_all_relationships():
         print(f"Failed to find follower to followee relationships : {e}")
         return None
 
+def stream_all_relationships(batch_size=STREAM_BATCH_SIZE):
+    try:
+        query = "SELECT * FROM follower_relationships"
+        yield from run_read_stream(query, batch_size=batch_size)
+    except Exception as e:
+        print(f"Failed streaming follower to followee relationships : {e}")
+        raise
+
 # view who follows "username"
 def view_followers(username):
     try:
@@ -299,6 +401,8 @@ def unfollow(follower_username, followee_username):
 
         query = "DELETE FROM follower_relationships WHERE follower = %s AND followee = %s"
         run_cud_query(query, (follower_username, followee_username,))
+        remove_from_timeline(follower_username, followee_username)
+        response_cache.invalidate(profile_namespace(follower_username), profile_namespace(followee_username))
         return True
     except Exception as e:
         print(f"Failed to unfollow from \"{follower_username}\" to \"{followee_username}\". : {e}")
@@ -1,11 +1,45 @@
 from flask import Flask, request, jsonify
 from google.cloud import storage
 from datetime import timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import requests
+import threading
+import random
+import hashlib
+import json
+import time
 import os
 
 app = Flask(__name__)
-client = storage.Client.from_service_account_json("caramel-feat-466118-i4-f6cde017fca1.json")
+# one client for the whole process; parsing the key file is the slow part.
+# made on first use so importing this module doesn't need the credentials
+SERVICE_ACCOUNT_FILE = "caramel-feat-466118-i4-f6cde017fca1.json"
+_client = None
+_client_lock = threading.Lock()
+
+# signed urls are reused until they get close to expiring, so a feed page with
+# 20 photos doesn't sign 20 urls every time it's loaded
+SIGNED_URL_REFRESH_SECONDS = 5 * 60     # sign a new one when less than this is left
+SIGNED_URL_CACHE_SIZE = 10000           # most urls kept, least recently used go first
+_url_cache = OrderedDict()              # (bucket, folder, file, method, minutes) -> (url, expires_at)
+_url_cache_lock = threading.Lock()
+
+# results of "does this object exist" lookups. these only read object metadata
+# (no bytes) and are remembered for a while; uploads/deletes update them directly
+EXISTS_CACHE_SECONDS = 10 * 60
+EXISTS_LOOKUP_THREADS = 8
+_exists_cache = {}                      # (bucket, "folder/file") -> (exists, checked_at)
+_exists_cache_lock = threading.Lock()
+
+def get_storage_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = storage.Client.from_service_account_json(SERVICE_ACCOUNT_FILE)
+    return _client
+
 @app.route("/generate-signed-url", methods=["POST"])
 
 
@@ -13,51 +47,315 @@ def generate_url(bucket_name, file_name, destination_blob_folder, request_method
     if destination_blob_folder not in ["photo", "video", "audio"]:
         print("folder for [generate_url()]")
         return ""
-    else:
-        storage_client = storage.Client.from_service_account_json("caramel-feat-466118-i4-f6cde017fca1.json")
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(f"{destination_blob_folder}/{file_name}")
-        ext_name = (os.path.splitext(file_name))[1][1:]
-
-        url = blob.generate_signed_url(
-            version="v4",
-            expiration=timedelta(minutes=expiration_minutes),
-            method=request_method,
-            content_type=f"{destination_blob_folder}/{ext_name}",
-        )
 
+    key = (bucket_name, destination_blob_folder, file_name, request_method, expiration_minutes)
+    # never hand out a url with less than a third of its life left
+    refresh = min(SIGNED_URL_REFRESH_SECONDS, expiration_minutes * 60 / 3)
+    now = time.time()
+    with _url_cache_lock:
+        cached = _url_cache.get(key)
+        if cached and cached[1] - now > refresh:
+            _url_cache.move_to_end(key)
+            return cached[0]
+
+    bucket = get_storage_client().bucket(bucket_name)
+    blob = bucket.blob(f"{destination_blob_folder}/{file_name}")
+    ext_name = (os.path.splitext(file_name))[1][1:]
+
+    url = blob.generate_signed_url(
+        version="v4",
+        expiration=timedelta(minutes=expiration_minutes),
+        method=request_method,
+        content_type=f"{destination_blob_folder}/{ext_name}",
+    )
+
+    with _url_cache_lock:
+        _url_cache[key] = (url, now + expiration_minutes * 60)
+        _url_cache.move_to_end(key)
+        while len(_url_cache) > SIGNED_URL_CACHE_SIZE:
+            _url_cache.popitem(last=False)
     return url
 
+# drop cached urls for a file (e.g. after it was deleted)
+def forget_signed_urls(bucket_name, file_name, destination_blob_folder):
+    with _url_cache_lock:
+        for key in [k for k in _url_cache if k[:3] == (bucket_name, destination_blob_folder, file_name)]:
+            del _url_cache[key]
+
+def _remember_exists(bucket_name, blob_path, exists):
+    with _exists_cache_lock:
+        _exists_cache[(bucket_name, blob_path)] = (exists, time.time())
+
+# metadata-only existence check, cached for EXISTS_CACHE_SECONDS
+def blob_exists(bucket_name, file_name, destination_blob_folder):
+    blob_path = f"{destination_blob_folder}/{os.path.basename(file_name)}"
+    with _exists_cache_lock:
+        cached = _exists_cache.get((bucket_name, blob_path))
+    if cached and time.time() - cached[1] < EXISTS_CACHE_SECONDS:
+        return cached[0]
+    exists = get_storage_client().bucket(bucket_name).get_blob(blob_path) is not None
+    _remember_exists(bucket_name, blob_path, exists)
+    return exists
+
+# signs view (GET) urls for a whole list of media at once without downloading anything.
+#   media_list = [(file_name, "photo"/"video"/"audio"), ...]
+# returns the urls in the same order. signing happens locally with the service account
+# key. with verify=True missing objects get None; the lookups only fetch metadata,
+# are cached, and the ones not in the cache run in parallel
+def generate_view_urls(bucket_name, media_list, verify=False, expiration_minutes=15):
+    media_list = [(os.path.basename(file_name), folder) for file_name, folder in media_list]
+    exists = [True] * len(media_list)
+    if verify and media_list:
+        with ThreadPoolExecutor(max_workers=min(EXISTS_LOOKUP_THREADS, len(media_list))) as pool:
+            exists = list(pool.map(lambda media: blob_exists(bucket_name, *media), media_list))
+
+    urls = []
+    for (file_name, folder), found in zip(media_list, exists):
+        if not found:
+            urls.append(None)
+            continue
+        url = generate_url(bucket_name, file_name, folder, "GET", expiration_minutes)
+        urls.append(url or None)
+    return urls
+
 
 ###############################################################################
 
-#take in multiple file_paths for upload, view/download, and deletion from the google cloud storage
+UPLOAD_THREADS = 4                      # files uploaded at the same time
+UPLOAD_RETRIES = 3                      # extra attempts per file after the first one
+UPLOAD_BACKOFF_SECONDS = 0.5            # first retry waits this long, then doubles
+UPLOAD_READ_SIZE = 1024 * 1024          # bytes read from disk at a time
+# (connect, read) seconds. read is the longest gap between bytes, not the whole
+# upload, so a stalled connection is given up on and retried
+UPLOAD_TIMEOUT_SECONDS = (10, 60)
 
-def upload_via_signed_url(bucket_name, file_paths, destination_blob_folder):
-    success = True
-    for file_path in file_paths:
-        try:
-            with open(file_path, "rb") as f:
-                file_data = f.read()
+# one keep-alive session shared by every upload thread
+_http = requests.Session()
+_http.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=UPLOAD_THREADS * 2))
+
+
+# file object handed to requests so the body is read off disk a chunk at a time
+# instead of being loaded into memory, and so we can report progress
+class _UploadBody:
+    def __init__(self, f, total, on_read):
+        self._f = f
+        self._total = total
+        self._sent = 0
+        self._on_read = on_read
+
+    def __len__(self):
+        return self._total
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > UPLOAD_READ_SIZE:
+            size = UPLOAD_READ_SIZE
+        data = self._f.read(size)
+        if data:
+            self._sent += len(data)
+            if self._on_read:
+                self._on_read(self._sent, self._total)
+        return data
 
-            base_file_name = os.path.basename(file_path)
-            ext_name = (os.path.splitext(base_file_name))[1][1:]
-            signed_url = generate_url(bucket_name, base_file_name, destination_blob_folder, "PUT")
-            headers = {"Content-Type": f"{destination_blob_folder}/{ext_name}"}
-            response = requests.put(signed_url, data=file_data, headers=headers)
 
+# uploads one file, retrying network errors, 429 and 5xx with exponential backoff.
+# the object is called file_name (default: the file's own name).
+# progress(file_path, bytes_sent, total_bytes) is called as the file goes out
+def _upload_one(bucket_name, file_path, destination_blob_folder, progress=None, file_name=None):
+    base_file_name = file_name or os.path.basename(file_path)
+    ext_name = (os.path.splitext(base_file_name))[1][1:]
+    headers = {"Content-Type": f"{destination_blob_folder}/{ext_name}"}
+    total = os.path.getsize(file_path)
+    on_read = (lambda sent, size: progress(file_path, sent, size)) if progress else None
+
+    for attempt in range(UPLOAD_RETRIES + 1):
+        retry = False
+        try:
+            signed_url = generate_url(bucket_name, base_file_name, destination_blob_folder, "PUT")
+            with open(file_path, "rb") as f:
+                response = _http.put(signed_url, data=_UploadBody(f, total, on_read), headers=headers,
+                                     timeout=UPLOAD_TIMEOUT_SECONDS)
             if response.status_code == 200:
+                _remember_exists(bucket_name, f"{destination_blob_folder}/{base_file_name}", True)
                 print(f"{response} Successfully uploaded {base_file_name}.")
-            else:
-                print(f"{response} upload failed {base_file_name}.")
-                success = False
+                return True
+            retry = response.status_code == 429 or response.status_code >= 500
+            print(f"{response} upload failed {base_file_name}.")
+        except requests.exceptions.RequestException as e:
+            # includes requests.Timeout
+            retry = True
+            print(f"Upload of {base_file_name} hit a network error: {e}")
+        if not retry or attempt == UPLOAD_RETRIES:
+            return False
+        time.sleep(UPLOAD_BACKOFF_SECONDS * (2 ** attempt) * (1 + random.random()))
+    return False
+
+
+###############################################################################
+# RESUMABLE UPLOADS
+###############################################################################
+
+# big files (videos) go up in chunks through a GCS resumable upload session.
+# after every chunk the confirmed offset is written to a small checkpoint file,
+# so if the upload (or the whole server) dies it picks up where it stopped
+# instead of sending the whole file again.
+RESUMABLE_UPLOAD_THRESHOLD = 32 * 1024 * 1024      # files this big or bigger use it
+RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024             # must be a multiple of 256 KiB
+RESUMABLE_CHECKPOINT_DIR = ".upload_checkpoints"
+_CHUNK_ALIGNMENT = 256 * 1024
+
+
+def _checkpoint_path(checkpoint_dir, bucket_name, blob_path, file_path):
+    stat = os.stat(file_path)
+    key = f"{bucket_name}|{blob_path}|{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return os.path.join(checkpoint_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+def _load_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+# written to a temp file and renamed so a crash can't leave half a checkpoint
+def _save_checkpoint(path, checkpoint):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(temp_path, path)
+
+def _delete_checkpoint(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# signed POST url that opens a resumable session (x-goog-resumable is part of the signature)
+def _resumable_start_url(bucket_name, blob_path, content_type, expiration_minutes=15):
+    blob = get_storage_client().bucket(bucket_name).blob(blob_path)
+    return blob.generate_signed_url(
+        version="v4",
+        expiration=timedelta(minutes=expiration_minutes),
+        method="POST",
+        content_type=content_type,
+        headers={"x-goog-resumable": "start"},
+    )
+
+# asks the session how many bytes it has. returns (offset, finished)
+def _resumable_status(session_url, total):
+    response = _http.put(session_url, headers={"Content-Range": f"bytes */{total}"}, timeout=UPLOAD_TIMEOUT_SECONDS)
+    if response.status_code in (200, 201):
+        return total, True
+    if response.status_code == 308:
+        committed = response.headers.get("Range")
+        return (int(committed.split("-")[1]) + 1 if committed else 0), False
+    raise requests.exceptions.HTTPError(f"session status returned {response.status_code}", response=response)
+
+# uploads file_path to bucket/destination_blob_folder/<file_name or the file's name> in chunks.
+# start_url lets tests point it at a fake storage server instead of signing one.
+# progress(file_path, bytes_sent, total_bytes) is called after each chunk
+def resumable_upload(bucket_name, file_path, destination_blob_folder, chunk_size=RESUMABLE_CHUNK_SIZE,
+                     checkpoint_dir=RESUMABLE_CHECKPOINT_DIR, start_url=None, progress=None, file_name=None):
+    if chunk_size % _CHUNK_ALIGNMENT:
+        raise ValueError(f"chunk_size must be a multiple of {_CHUNK_ALIGNMENT} bytes")
+    base_file_name = file_name or os.path.basename(file_path)
+    ext_name = (os.path.splitext(base_file_name))[1][1:]
+    content_type = f"{destination_blob_folder}/{ext_name}"
+    blob_path = f"{destination_blob_folder}/{base_file_name}"
+    total = os.path.getsize(file_path)
+    checkpoint_file = _checkpoint_path(checkpoint_dir, bucket_name, blob_path, file_path)
+
+    checkpoint = _load_checkpoint(checkpoint_file)
+    offset, finished = 0, False
+    if checkpoint:
+        try:
+            offset, finished = _resumable_status(checkpoint["session_url"], total)
+            print(f"Resuming {base_file_name} at {offset}/{total} bytes.")
+        except requests.exceptions.RequestException as e:
+            # session expired (404/410) or unusable, start a new one
+            print(f"Could not resume {base_file_name}, starting over : {e}")
+            checkpoint = None
+    if not checkpoint:
+        url = start_url or _resumable_start_url(bucket_name, blob_path, content_type)
+        response = _http.post(url, headers={"x-goog-resumable": "start", "Content-Type": content_type},
+                              timeout=UPLOAD_TIMEOUT_SECONDS)
+        if response.status_code not in (200, 201) or "Location" not in response.headers:
+            print(f"{response} could not start a resumable upload for {base_file_name}.")
+            return False
+        checkpoint = {"session_url": response.headers["Location"], "total": total, "offset": 0}
+        _save_checkpoint(checkpoint_file, checkpoint)
+
+    session_url = checkpoint["session_url"]
+    failures = 0
+    with open(file_path, "rb") as f:
+        while not finished:
+            end = min(offset + chunk_size, total)
+            try:
+                f.seek(offset)
+                chunk = f.read(end - offset)
+                headers = {"Content-Range": f"bytes {offset}-{end - 1}/{total}" if total else f"bytes */{total}"}
+                response = _http.put(session_url, data=chunk, headers=headers, timeout=UPLOAD_TIMEOUT_SECONDS)
+                if response.status_code in (200, 201):
+                    offset, finished = total, True
+                elif response.status_code == 308:
+                    committed = response.headers.get("Range")
+                    offset = int(committed.split("-")[1]) + 1 if committed else 0
+                elif response.status_code == 429 or response.status_code >= 500:
+                    raise requests.exceptions.HTTPError(f"chunk upload returned {response.status_code}", response=response)
+                else:
+                    print(f"{response} resumable upload failed {base_file_name}.")
+                    if response.status_code in (404, 410):
+                        _delete_checkpoint(checkpoint_file)
+                    return False
+                failures = 0
+                checkpoint["offset"] = offset
+                _save_checkpoint(checkpoint_file, checkpoint)
+                if progress:
+                    progress(file_path, offset, total)
+            except requests.exceptions.RequestException as e:
+                failures += 1
+                if failures > UPLOAD_RETRIES:
+                    print(f"Giving up on {base_file_name} at {offset}/{total} bytes, run it again to resume : {e}")
+                    return False
+                time.sleep(UPLOAD_BACKOFF_SECONDS * (2 ** (failures - 1)) * (1 + random.random()))
+                try:
+                    offset, finished = _resumable_status(session_url, total)
+                except requests.exceptions.RequestException:
+                    pass
+
+    _delete_checkpoint(checkpoint_file)
+    _remember_exists(bucket_name, blob_path, True)
+    print(f"Successfully uploaded {base_file_name} (resumable).")
+    return True
+
+
+#take in multiple file_paths for upload, view/download, and deletion from the google cloud storage
+
+# files go up in parallel (UPLOAD_THREADS at a time) and are streamed from disk, so a
+# multi photo post takes about as long as its biggest file and memory stays flat.
+# file_names = the object names, same order as file_paths (default: the files' own names)
+def upload_via_signed_url(bucket_name, file_paths, destination_blob_folder, progress=None, max_workers=UPLOAD_THREADS,
+                          file_names=None):
+    file_paths = list(file_paths)
+    names = dict(zip(file_paths, file_names)) if file_names else {}
+
+    def upload(file_path):
+        try:
+            if os.path.getsize(file_path) >= RESUMABLE_UPLOAD_THRESHOLD:
+                return resumable_upload(bucket_name, file_path, destination_blob_folder, progress=progress,
+                                        file_name=names.get(file_path))
+            return _upload_one(bucket_name, file_path, destination_blob_folder, progress, names.get(file_path))
         except FileNotFoundError:
             print("File could not be located. Check your pathing again.")
-            success = False
-        except: 
-            print(f"Upload failed for an unknown reason.")
-            success = False
-    return success
+            return False
+        except Exception as e:
+            print(f"Upload failed for an unknown reason. : {e}")
+            return False
+
+    if len(file_paths) <= 1:
+        return all(upload(file_path) for file_path in file_paths)
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(file_paths))) as pool:
+        return all(list(pool.map(upload, file_paths)))
 
 
 def delete_via_signed_url(bucket_name, file_paths, destination_blob_folder):
@@ -68,9 +366,11 @@ def delete_via_signed_url(bucket_name, file_paths, destination_blob_folder):
             ext_name = (os.path.splitext(base_file_name))[1][1:]
             url = generate_url(bucket_name, base_file_name, destination_blob_folder, "DELETE")
             headers = {"Content-Type": f"{destination_blob_folder}/{ext_name}"}
-            response = requests.delete(url, headers=headers)
+            response = requests.delete(url, headers=headers, timeout=UPLOAD_TIMEOUT_SECONDS)
 
             if response.status_code == 204:
+                forget_signed_urls(bucket_name, base_file_name, destination_blob_folder)
+                _remember_exists(bucket_name, f"{destination_blob_folder}/{base_file_name}", False)
                 print(f"Successfully deleted {base_file_name}.")
             else:
                 print(f"The deletion of {base_file_name} was unsuccessful.")
@@ -84,26 +384,19 @@ def delete_via_signed_url(bucket_name, file_paths, destination_blob_folder):
     return success
 
 
+# returns view urls for the files that exist. nothing is downloaded: existence is a
+# cached metadata lookup (see generate_view_urls)
 def view_via_signed_url(bucket_name, file_paths, destination_blob_folder):
     url_list = []
-    for file_path in file_paths:
-        try:
-            base_file_name = os.path.basename(file_path)
-            ext_name = (os.path.splitext(base_file_name))[1][1:]
-            url = generate_url(bucket_name, base_file_name, destination_blob_folder, "GET")
-            headers = {"Content-Type": f"{destination_blob_folder}/{ext_name}"}
-            url = generate_url(bucket_name, base_file_name, destination_blob_folder, "GET")
-            response = requests.get(url, headers=headers)
-            
-            if(response.status_code == 200):
-                print(f"Successfully downloaded {base_file_name}")
+    try:
+        urls = generate_view_urls(bucket_name, [(file_path, destination_blob_folder) for file_path in file_paths], verify=True)
+        for file_path, url in zip(file_paths, urls):
+            if url:
                 url_list.append(url)
             else:
-                print(f"Could not retrieve the download link for {base_file_name}")
-        except FileNotFoundError:
-            print(f"The file: {base_file_name} does not exist")
-        except:
-            print("Something went wrong while trying to fetch the content.")
+                print(f"Could not retrieve the download link for {os.path.basename(file_path)}")
+    except:
+        print("Something went wrong while trying to fetch the content.")
 
     return url_list
         
@@ -0,0 +1,194 @@
+###############################################################
+#   Content-addressed local file store (used for uploads/).
+#   A file is saved as  <root>/ab/cd/<sha256>.<ext>  so the same
+#   image uploaded twice is stored once, and no folder ends up
+#   with millions of entries. Files are written to a temp file
+#   and renamed into place, so a half-written file is never
+#   served. Every stored file has a reference count (kept in a
+#   small SQLite file); when the last post using it is deleted,
+#   release() removes the file.
+###############################################################
+
+import glob
+import hashlib
+import os
+import posixpath
+import sqlite3
+import tempfile
+import threading
+
+UPLOADS_ROOT = "uploads"
+INDEX_PATH = ".blobstore/refs.sqlite3"
+
+
+class BlobTooLarge(Exception):
+    pass
+
+
+# file-like object that writes to a temp file in the store while hashing what
+# goes through it, so a streamed upload never has to be held in memory or
+# re-read to get its digest. raises BlobTooLarge past max_bytes
+class BlobWriter:
+    def __init__(self, f, temp_path, max_bytes=None):
+        self._f = f
+        self.temp_path = temp_path
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._sha = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            raise BlobTooLarge(f"Upload is larger than {self.max_bytes} bytes.")
+        self._sha.update(data)
+        return self._f.write(data)
+
+    @property
+    def digest(self):
+        return self._sha.hexdigest()
+
+    # werkzeug seeks/reads the stream after writing a multipart part
+    def seek(self, *args):
+        return self._f.seek(*args)
+
+    def tell(self):
+        return self._f.tell()
+
+    def read(self, *args):
+        return self._f.read(*args)
+
+    def flush(self):
+        return self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+    # throws the temp file away (upload rejected / failed)
+    def discard(self):
+        self.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+class BlobStore:
+    def __init__(self, root=UPLOADS_ROOT, index_path=INDEX_PATH):
+        self.root = root
+        self.index_path = index_path
+        self.temp_dir = os.path.join(root, ".tmp")    # same disk as root so rename is atomic
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _conn(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+            # autocommit mode, transactions are opened explicitly with BEGIN IMMEDIATE
+            self._db = sqlite3.connect(self.index_path, check_same_thread=False, isolation_level=None, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS blob (
+                    path TEXT PRIMARY KEY,
+                    refs INTEGER NOT NULL
+                )
+            """)
+        return self._db
+
+    # "ab/cd/<digest>.<ext>", relative to root
+    def relative_path(self, digest, ext):
+        ext = ext.lstrip(".").lower()
+        name = f"{digest}.{ext}" if ext else digest
+        return f"{digest[:2]}/{digest[2:4]}/{name}"
+
+    def full_path(self, relative_path):
+        return os.path.join(self.root, *relative_path.split("/"))
+
+    # smaller copies (MediaManager.make_variants) live next to the file they were
+    # made from: "ab/cd/<digest>_w320.webp". they go when the file is released
+    def variant_path(self, relative_path, suffix):
+        return f"{posixpath.splitext(relative_path)[0]}_{suffix}"
+
+    def new_temp_file(self):
+        os.makedirs(self.temp_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.temp_dir)
+        return os.fdopen(fd, "w+b"), temp_path
+
+    # a BlobWriter for streaming into the store; finish with put_writer()
+    def open_writer(self, max_bytes=None):
+        f, temp_path = self.new_temp_file()
+        return BlobWriter(f, temp_path, max_bytes)
+
+    # ----------------------
+    # CREATE
+    # ----------------------
+
+    # stores bytes, returns the relative path. adds one reference
+    def put(self, data, ext):
+        digest = hashlib.sha256(data).hexdigest()
+        f, temp_path = self.new_temp_file()
+        with f:
+            f.write(data)
+        return self.put_file(temp_path, digest, ext)
+
+    # moves an already written temp file (from new_temp_file) into the store.
+    # digest is the sha256 of its contents. returns the relative path, adds one reference
+    def put_file(self, temp_path, digest, ext):
+        relative_path = self.relative_path(digest, ext)
+        path = self.full_path(relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                if os.path.exists(path):
+                    os.remove(temp_path)                # already stored, keep the one we have
+                else:
+                    os.replace(temp_path, path)
+                db.execute("INSERT INTO blob (path, refs) VALUES (?, 1) "
+                           "ON CONFLICT(path) DO UPDATE SET refs = refs + 1", (relative_path,))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return relative_path
+
+    # stores what was streamed into writer, returns the relative path
+    def put_writer(self, writer, ext):
+        writer.close()
+        return self.put_file(writer.temp_path, writer.digest, ext)
+
+    # ----------------------
+    # DELETE
+    # ----------------------
+
+    # drops one reference; deletes the file when nothing uses it anymore.
+    # returns True if the file was removed
+    def release(self, relative_path):
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT refs FROM blob WHERE path = ?", (relative_path,)).fetchone()
+                if row is None:
+                    db.execute("ROLLBACK")
+                    return False
+                removed = row[0] <= 1
+                if removed:
+                    db.execute("DELETE FROM blob WHERE path = ?", (relative_path,))
+                    full_path = self.full_path(relative_path)
+                    variants = glob.glob(glob.escape(os.path.splitext(full_path)[0]) + "_w*")
+                    for path in [full_path] + variants:
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                else:
+                    db.execute("UPDATE blob SET refs = refs - 1 WHERE path = ?", (relative_path,))
+                db.execute("COMMIT")
+                return removed
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+
+store = BlobStore()
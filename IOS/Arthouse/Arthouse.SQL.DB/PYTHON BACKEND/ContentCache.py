@@ -0,0 +1,193 @@
+###############################################################
+#   Content-addressed cache for media.
+#   Files are identified by the SHA-256 of their bytes, so a
+#   repost / retried upload of the same file is recognised no
+#   matter what it's called. For every digest we remember:
+#     - the probe result (MediaManager metadata row)
+#     - where it was already uploaded (bucket + folder/file)
+#     - generated derivatives (thumbnails etc.), stored on disk
+#   The index is a local SQLite file; least recently used
+#   entries are evicted once the limits are hit.
+###############################################################
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+CACHE_DIR = ".content_cache"
+MAX_ENTRIES = 100000                    # probe + upload entries kept
+MAX_DERIVATIVE_BYTES = 2 * 1024 ** 3    # disk used by cached derivatives
+HASH_READ_SIZE = 1024 * 1024
+
+
+# streaming SHA-256, never holds more than HASH_READ_SIZE of the file in memory
+def file_digest(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_READ_SIZE), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class ContentCache:
+    def __init__(self, cache_dir=CACHE_DIR, max_entries=MAX_ENTRIES, max_derivative_bytes=MAX_DERIVATIVE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_derivative_bytes = max_derivative_bytes
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _conn(self):
+        if self._db is None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(self.cache_dir, "index.sqlite3"), check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS probe (
+                    digest TEXT PRIMARY KEY,
+                    media_type TEXT NOT NULL,
+                    metadata TEXT NOT NULL,
+                    last_used REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS upload (
+                    digest TEXT NOT NULL,
+                    bucket TEXT NOT NULL,
+                    blob_path TEXT NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (digest, bucket)
+                );
+                CREATE INDEX IF NOT EXISTS upload_blob ON upload (bucket, blob_path);
+                CREATE TABLE IF NOT EXISTS derivative (
+                    digest TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (digest, name)
+                );
+                CREATE INDEX IF NOT EXISTS probe_lru ON probe (last_used);
+                CREATE INDEX IF NOT EXISTS upload_lru ON upload (last_used);
+                CREATE INDEX IF NOT EXISTS derivative_lru ON derivative (last_used);
+            """)
+        return self._db
+
+    # ----------------------
+    # probe results
+    # ----------------------
+
+    # the metadata row (tuple) for this digest, or None
+    def get_probe(self, digest, media_type):
+        with self._lock:
+            db = self._conn()
+            row = db.execute("SELECT metadata FROM probe WHERE digest = ? AND media_type = ?",
+                             (digest, media_type)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE probe SET last_used = ? WHERE digest = ?", (time.time(), digest))
+            db.commit()
+            return tuple(json.loads(row[0]))
+
+    def put_probe(self, digest, media_type, metadata):
+        with self._lock:
+            db = self._conn()
+            db.execute("INSERT OR REPLACE INTO probe (digest, media_type, metadata, last_used) VALUES (?, ?, ?, ?)",
+                       (digest, media_type, json.dumps(list(metadata)), time.time()))
+            self._evict_rows(db, "probe")
+            db.commit()
+
+    # ----------------------
+    # uploads
+    # ----------------------
+
+    # "folder/file" this content was already uploaded to in bucket, or None
+    def get_upload(self, digest, bucket):
+        with self._lock:
+            db = self._conn()
+            row = db.execute("SELECT blob_path FROM upload WHERE digest = ? AND bucket = ?", (digest, bucket)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE upload SET last_used = ? WHERE digest = ? AND bucket = ?", (time.time(), digest, bucket))
+            db.commit()
+            return row[0]
+
+    def put_upload(self, digest, bucket, blob_path):
+        with self._lock:
+            db = self._conn()
+            db.execute("INSERT OR REPLACE INTO upload (digest, bucket, blob_path, last_used) VALUES (?, ?, ?, ?)",
+                       (digest, bucket, blob_path, time.time()))
+            self._evict_rows(db, "upload")
+            db.commit()
+
+    # call when an object is deleted from the bucket
+    def forget_upload(self, bucket, blob_path):
+        with self._lock:
+            db = self._conn()
+            db.execute("DELETE FROM upload WHERE bucket = ? AND blob_path = ?", (bucket, blob_path))
+            db.commit()
+
+    # ----------------------
+    # derivatives
+    # ----------------------
+
+    # local path of a cached derivative (e.g. name="w320.webp"), or None
+    def get_derivative(self, digest, name):
+        with self._lock:
+            db = self._conn()
+            row = db.execute("SELECT path FROM derivative WHERE digest = ? AND name = ?", (digest, name)).fetchone()
+            if row is None:
+                return None
+            if not os.path.exists(row[0]):
+                db.execute("DELETE FROM derivative WHERE digest = ? AND name = ?", (digest, name))
+                db.commit()
+                return None
+            db.execute("UPDATE derivative SET last_used = ? WHERE digest = ? AND name = ?", (time.time(), digest, name))
+            db.commit()
+            return row[0]
+
+    # copies source_path into the cache and returns the cached path
+    def put_derivative(self, digest, name, source_path):
+        folder = os.path.join(self.cache_dir, "derivatives", digest[:2])
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{digest}_{name}")
+        temp_path = path + ".tmp"
+        shutil.copyfile(source_path, temp_path)
+        os.replace(temp_path, path)
+        with self._lock:
+            db = self._conn()
+            db.execute("INSERT OR REPLACE INTO derivative (digest, name, path, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                       (digest, name, path, os.path.getsize(path), time.time()))
+            self._evict_derivatives(db)
+            db.commit()
+        return path
+
+    # ----------------------
+    # eviction (least recently used first)
+    # ----------------------
+
+    def _evict_rows(self, db, table):
+        count = db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        if count > self.max_entries:
+            db.execute(f"DELETE FROM {table} WHERE rowid IN "
+                       f"(SELECT rowid FROM {table} ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+
+    def _evict_derivatives(self, db):
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM derivative").fetchone()[0]
+        if total <= self.max_derivative_bytes:
+            return
+        for digest, name, path, size in db.execute(
+                "SELECT digest, name, path, size FROM derivative ORDER BY last_used").fetchall():
+            if total <= self.max_derivative_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            db.execute("DELETE FROM derivative WHERE digest = ? AND name = ?", (digest, name))
+            total -= size
+
+
+cache = ContentCache()
@@ -0,0 +1,45 @@
+###############################################################
+#   Request scoped batching of lookups.
+#   While a response is being built, ask for everything it will
+#   need with want(key) and then read it back with load(key):
+#   the first load() fetches every key asked for so far in one
+#   call to batch_load, and every key is fetched at most once
+#   per loader. Make a new loader per request (see
+#   api_server.profile_loader), never share one between them.
+###############################################################
+
+
+class DataLoader:
+    # batch_load(keys) -> {key: value}; keys missing from the result load as None
+    def __init__(self, batch_load):
+        self._batch_load = batch_load
+        self._values = {}
+        self._pending = {}          # keys asked for but not fetched yet, in order
+
+    def want(self, key):
+        if key is not None and key not in self._values:
+            self._pending[key] = None
+
+    def want_many(self, keys):
+        for key in keys:
+            self.want(key)
+
+    def load(self, key):
+        self.want(key)
+        self._dispatch()
+        return self._values.get(key)
+
+    def load_many(self, keys):
+        keys = list(keys)
+        self.want_many(keys)
+        self._dispatch()
+        return [self._values.get(key) for key in keys]
+
+    def _dispatch(self):
+        if not self._pending:
+            return
+        keys = list(self._pending)
+        self._pending.clear()
+        results = self._batch_load(keys) or {}
+        for key in keys:
+            self._values[key] = results.get(key)
@@ -0,0 +1,185 @@
+###############################################################
+#   In-memory inverted index: hashtag -> post ids.
+#   Each hashtag keeps a sorted array of post ids (post ids are
+#   auto-increment, so higher id = newer post). OR / AND / NOT
+#   searches are set operations on those arrays and only one
+#   page of ids is handed back, instead of an unbounded
+#   JOIN hashtag ... IN (...) with DISTINCT.
+#   Built from the hashtag table on first use and kept up to
+#   date by create_post / update_post / delete_post. Writes
+#   made by other processes are picked up by a full rebuild
+#   every REBUILD_SECONDS; searches keep using the old index
+#   while it runs.
+###############################################################
+
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+import numpy as np
+
+from queryHelper import run_read_stream
+
+REBUILD_SECONDS = 300           # full rebuild from the database this often
+
+
+class HashtagIndex:
+    def __init__(self, rebuild_seconds=REBUILD_SECONDS):
+        self.rebuild_seconds = rebuild_seconds
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()     # one build at a time
+        self._built_at = None
+        self._changes = None        # writes made while a build runs, replayed on top of it
+        self._postings = {}         # hashtag -> array('q') of post ids, ascending
+        self._post_tags = {}        # post_id -> tuple of hashtags (needed to remove a post)
+
+    # ----------------------
+    # BUILD
+    # ----------------------
+
+    # streams the hashtag table so building doesn't hold it all in memory twice.
+    # the lock is only held to swap the new index in, so searches carry on meanwhile
+    def build(self):
+        with self._lock:
+            self._changes = []
+        try:
+            postings = {}
+            post_tags = {}
+            for hashtag, post_id in run_read_stream("SELECT hashtag, post_id FROM hashtag ORDER BY post_id"):
+                postings.setdefault(hashtag, array('q')).append(post_id)
+                post_tags.setdefault(post_id, []).append(hashtag)
+            with self._lock:
+                changes = self._changes
+                self._postings = postings
+                self._post_tags = {post_id: tuple(tags) for post_id, tags in post_tags.items()}
+                self._built_at = time.monotonic()
+                # the stream may have been read before these landed
+                for post_id, hashtags in changes:
+                    self._remove(post_id)
+                    if hashtags:
+                        self._add(post_id, hashtags)
+        finally:
+            with self._lock:
+                self._changes = None
+
+    def _stale(self):
+        return self._built_at is None or time.monotonic() - self._built_at > self.rebuild_seconds
+
+    # the first build is waited for. after that one caller rebuilds and the
+    # others keep searching the old index instead of queueing behind it
+    def _ensure_built(self):
+        if not self._stale():
+            return
+        if not self._build_lock.acquire(blocking=self._built_at is None):
+            return
+        try:
+            if self._stale():
+                self.build()
+        finally:
+            self._build_lock.release()
+
+    # ----------------------
+    # UPDATE
+    # ----------------------
+    # no-ops until the index has been built (the build will pick the change up)
+
+    # sets a post's hashtags, replacing whatever it had (create and update)
+    def set_post_hashtags(self, post_id, hashtags):
+        tags = tuple(dict.fromkeys(hashtags or []))
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((post_id, tags))
+            if self._built_at is None:
+                return
+            self._remove(post_id)
+            if tags:
+                self._add(post_id, tags)
+
+    def remove_post(self, post_id):
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((post_id, ()))
+            if self._built_at is not None:
+                self._remove(post_id)
+
+    def _add(self, post_id, tags):
+        for tag in tags:
+            ids = self._postings.setdefault(tag, array('q'))
+            if not ids or ids[-1] < post_id:
+                ids.append(post_id)          # the usual case, a new post
+            else:
+                position = bisect_left(ids, post_id)
+                if position == len(ids) or ids[position] != post_id:
+                    ids.insert(position, post_id)
+        self._post_tags[post_id] = tags
+
+    def _remove(self, post_id):
+        for tag in self._post_tags.pop(post_id, ()):
+            ids = self._postings.get(tag)
+            if ids is None:
+                continue
+            position = bisect_left(ids, post_id)
+            if position < len(ids) and ids[position] == post_id:
+                del ids[position]
+            if not ids:
+                del self._postings[tag]
+
+    # ----------------------
+    # READ
+    # ----------------------
+
+    # a view straight onto the posting list, no copy. the array can't be resized
+    # while a view of it is alive, so views must never outlive self._lock
+    def _ids(self, tag):
+        ids = self._postings.get(tag)
+        if not ids:
+            return np.zeros(0, dtype=np.int64)
+        return np.frombuffer(ids, dtype=np.int64)
+
+    # returns (post_ids newest first, next_cursor).
+    #   match="any" -> posts with at least one of the hashtags (OR)
+    #   match="all" -> posts with every hashtag (AND)
+    #   exclude     -> drop posts with any of these hashtags (NOT)
+    #   cursor      -> the next_cursor from the previous page (a post id)
+    # next_cursor is None on the last page
+    def search(self, hashtags, match="any", exclude=None, limit=20, cursor=None):
+        if match not in ("any", "all"):
+            raise ValueError(f"match must be 'any' or 'all', not {match!r}")
+        tags = list(dict.fromkeys(hashtags or []))
+        if not tags:
+            return [], None
+        self._ensure_built()
+        with self._lock:
+            # _page turns the result into plain ints, so no view escapes the lock
+            return self._page(self._match(tags, match, exclude or []), limit, cursor)
+
+    def _match(self, tags, match, exclude):
+        if match == "all":
+            # smallest list first keeps every intersection small
+            lists = sorted((self._ids(tag) for tag in tags), key=len)
+            result = lists[0]
+            for ids in lists[1:]:
+                if not len(result):
+                    break
+                result = np.intersect1d(result, ids, assume_unique=True)
+        elif len(tags) == 1:
+            result = self._ids(tags[0])
+        else:
+            result = np.unique(np.concatenate([self._ids(tag) for tag in tags]))
+        for tag in exclude:
+            if not len(result):
+                break
+            result = np.setdiff1d(result, self._ids(tag), assume_unique=True)
+        return result
+
+    @staticmethod
+    def _page(result, limit, cursor):
+        if cursor is not None:
+            result = result[:np.searchsorted(result, int(cursor))]
+        page = result[::-1][:limit]
+        next_cursor = int(page[-1]) if len(page) == limit and len(result) > limit else None
+        return [int(post_id) for post_id in page], next_cursor
+
+
+index = HashtagIndex()
@@ -1,50 +1,251 @@
 from mutagen import File
 from pathlib import Path
-from PIL import Image
+from PIL import Image, ImageOps
 import os
 import subprocess, json
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple, Optional
 
-import ArthouseGoogleCloudInterface as agci
 #from queryHelper import run_cud_query, run_read_multiple, run_read_single
 
-def get_photo_metadata(photo_path):
+# worker processes for metadata probing (ffprobe runs, image decoding), shared by
+# everything in this process and only started the first time it's needed
+PROBE_PROCESSES = os.cpu_count() or 2
+_probe_pool = None
+_probe_pool_lock = threading.Lock()
+
+def get_probe_pool():
+    global _probe_pool
+    with _probe_pool_lock:
+        if _probe_pool is None:
+            _probe_pool = ProcessPoolExecutor(max_workers=PROBE_PROCESSES)
+        return _probe_pool
+
+# how media types are guessed from the extension when probe_many isn't told
+PHOTO_EXTENSIONS = {"jpg", "jpeg", "png", "gif", "webp", "heic", "heif", "bmp", "tif", "tiff"}
+VIDEO_EXTENSIONS = {"mp4", "mov", "m4v", "avi", "mkv", "webm"}
+AUDIO_EXTENSIONS = {"mp3", "m4a", "aac", "wav", "flac", "ogg", "opus"}
+
+
+# ----------------------
+# metadata records
+# ----------------------
+# row() gives the values of the photo / video / audio table row (after media_id)
+
+class PhotoMetadata(NamedTuple):
+    path: str
+    width: int
+    height: int
+    format: Optional[str]
+
+    @property
+    def resolution(self):
+        return f"{self.width}x{self.height}"
+
+    def row(self):
+        return (self.resolution,)
+
+class VideoMetadata(NamedTuple):
+    path: str
+    duration: float
+    width: Optional[int]
+    height: Optional[int]
+
+    @property
+    def resolution(self):
+        if self.width is None or self.height is None:
+            return "Unknown"
+        return f"{self.width}x{self.height}"
+
+    def row(self):
+        return (self.duration, self.resolution)
+
+class AudioMetadata(NamedTuple):
+    path: str
+    duration: float
+    bitrate: int        # kbps
+
+    def row(self):
+        return (self.duration, self.bitrate)
+
+class ProbeFailure(NamedTuple):
+    path: str
+    media_type: Optional[str]
+    error: str
+
+
+# ----------------------
+# probing (headers only)
+# ----------------------
+
+# PIL only parses the header on open; the pixels are never decoded here
+def probe_photo(photo_path):
     with Image.open(photo_path) as img:
         width, height = img.size
-        return f"{width}x{height}"
+        return PhotoMetadata(photo_path, width, height, img.format)
 
-def get_video_metadata(video_path):
+# asks ffprobe for just the container duration and the first video stream's size
+def probe_video(video_path):
     if not os.path.exists(video_path):
-        print(f"File not found: {video_path}")
-        return
+        raise FileNotFoundError(f"File not found: {video_path}")
     cmd = [
         'ffprobe', '-v', 'error',
-        '-show_entries', 'format=duration',
-        '-show_streams',
+        '-select_streams', 'v:0',
+        '-show_entries', 'format=duration:stream=width,height',
         '-of', 'json',
         video_path
     ]
     result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise Exception(f"ffprobe failed for {video_path}: {result.stderr.strip()}")
     info = json.loads(result.stdout)
 
     duration = float(info['format']['duration'])
-    streams = info['streams']
-    # Usually the first video stream has resolution
-    for stream in streams:
-        if stream['codec_type'] == 'video':
-            width = stream.get('width')
-            height = stream.get('height')
-            resolution = f"{width}x{height}"
-            break
-    else:
-        resolution = "Unknown"
-
-    return duration, resolution
+    streams = info.get('streams') or [{}]
+    return VideoMetadata(video_path, duration, streams[0].get('width'), streams[0].get('height'))
 
-def get_audio_metadata(audio_path):
+# mutagen reads the tags/frame headers, not the audio data
+def probe_audio(audio_path):
     audio = File(audio_path)
-    duration = audio.info.length  # in seconds
-    bitrate = audio.info.bitrate // 1000  # convert to kbps
-    return duration, bitrate
+    if audio is None:
+        raise Exception(f"Unrecognised audio file: {audio_path}")
+    return AudioMetadata(audio_path, audio.info.length, audio.info.bitrate // 1000)
+
+def guess_media_type(file_path):
+    ext = os.path.splitext(file_path)[1][1:].lower()
+    if ext in PHOTO_EXTENSIONS:
+        return 'photo'
+    if ext in VIDEO_EXTENSIONS:
+        return 'video'
+    if ext in AUDIO_EXTENSIONS:
+        return 'audio'
+    return None
+
+# probes one file, returning a ProbeFailure instead of raising (used by probe_many)
+def probe(file_path, media_type=None):
+    media_type = media_type or guess_media_type(file_path)
+    try:
+        if media_type == 'photo':
+            return probe_photo(file_path)
+        elif media_type == 'video':
+            return probe_video(file_path)
+        elif media_type == 'audio':
+            return probe_audio(file_path)
+        return ProbeFailure(file_path, media_type, "Unknown media type")
+    except Exception as e:
+        return ProbeFailure(file_path, media_type, str(e))
+
+def _probe_args(args):
+    return probe(*args)
+
+# probes a whole batch in the probe process pool and returns the records in the
+# same order as paths. media_types is an optional list matching paths
+def probe_many(paths, media_types=None):
+    paths = list(paths)
+    if media_types is None:
+        media_types = [None] * len(paths)
+    if not paths:
+        return []
+    chunksize = max(1, len(paths) // (PROBE_PROCESSES * 4))
+    return list(get_probe_pool().map(_probe_args, zip(paths, media_types), chunksize=chunksize))
+
+
+# ----------------------
+# derivatives (smaller copies for feeds)
+# ----------------------
+
+VARIANT_WIDTHS = (320, 640, 1080)       # only the ones narrower than the original are made
+VARIANT_FORMATS = ("jpeg", "webp")
+VARIANT_QUALITY = 80
+VARIANT_EXTENSIONS = {"jpeg": "jpg", "webp": "webp"}
+EXIF_ORIENTATION = 0x0112
+
+class PhotoVariant(NamedTuple):
+    width: int
+    format: str         # "jpeg" / "webp"
+    path: str
+
+# "w320.webp", also the name the variant is cached under in ContentCache
+def variant_suffix(width, format):
+    return f"w{width}.{VARIANT_EXTENSIONS[format]}"
+
+def variant_file_name(stem, width, format):
+    return f"{stem}_{variant_suffix(width, format)}"
+
+# writes <stem>_w<width>.<jpg/webp> for every width in widths narrower than the
+# photo into out_dir and returns them as PhotoVariants. outputs that already exist
+# are kept. each file is written to a temp name and renamed, so a half written
+# variant is never picked up. top level function so it can run in the probe pool
+def make_variants(photo_path, out_dir, stem=None, widths=VARIANT_WIDTHS, formats=VARIANT_FORMATS):
+    stem = stem or Path(photo_path).stem
+    with Image.open(photo_path) as img:
+        width, height = img.size
+        if img.getexif().get(EXIF_ORIENTATION) in (5, 6, 7, 8):
+            width, height = height, width   # stored rotated, shown the other way round
+        targets = sorted({w for w in widths if w < width}, reverse=True)
+        variants = [PhotoVariant(w, f, os.path.join(out_dir, variant_file_name(stem, w, f)))
+                    for w in targets for f in formats]
+        if all(os.path.exists(variant.path) for variant in variants):
+            return variants
+
+        os.makedirs(out_dir, exist_ok=True)
+        # JPEGs get decoded at a fraction of their size when that's still big enough
+        img.draft("RGB", (targets[0], targets[0]))
+        frame = ImageOps.exif_transpose(img)
+        if frame.mode not in ("RGB", "RGBA"):
+            frame = frame.convert("RGBA" if "transparency" in frame.info else "RGB")
+        # biggest first, each smaller size is resized from the one before it
+        for w in targets:
+            frame = frame.resize((w, max(1, round(frame.height * w / frame.width))),
+                                 Image.LANCZOS, reducing_gap=3.0)
+            for variant in variants:
+                if variant.width != w or os.path.exists(variant.path):
+                    continue
+                temp_path = variant.path + ".tmp"
+                if variant.format == "jpeg":
+                    frame.convert("RGB").save(temp_path, "JPEG", quality=VARIANT_QUALITY, optimize=True, progressive=True)
+                else:
+                    frame.save(temp_path, "WEBP", quality=VARIANT_QUALITY, method=4)
+                os.replace(temp_path, variant.path)
+    return variants
+
+# the variant to hand out for a display width: the smallest one at least that wide,
+# in the first of formats it exists in. variants = [(width, format, anything)...].
+# None means the original is the best fit (it's wider than every variant)
+def choose_variant(variants, width, formats=("jpeg",)):
+    for format in formats:
+        fits = [v for v in variants if v[1] == format and v[0] >= width]
+        if fits:
+            return min(fits, key=lambda v: v[0])
+    return None
+
+
+# the old single file helpers, same return values as before
+
+def get_photo_metadata(photo_path):
+    return probe_photo(photo_path).resolution
+
+def get_video_metadata(video_path):
+    try:
+        return probe_video(video_path).row()
+    except FileNotFoundError as e:
+        print(e)
+        return
+
+def get_audio_metadata(audio_path):
+    return probe_audio(audio_path).row()
+
+# metadata for one file as the values of its photo / video / audio row (after media_id):
+#   photo -> (resolution,)   video -> (duration, resolution)   audio -> (duration, bitrate)
+# top level function so it can run in the probe pool
+def get_metadata(file_path, media_type):
+    if media_type not in ('photo', 'video', 'audio'):
+        raise ValueError(f"Unknown media type: {media_type}")
+    record = probe(file_path, media_type)
+    if isinstance(record, ProbeFailure):
+        raise Exception(record.error)
+    return record.row()
 
 
 # if media_type == 'photo':
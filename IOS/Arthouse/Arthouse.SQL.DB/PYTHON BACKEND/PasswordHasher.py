@@ -0,0 +1,143 @@
+###############################################################
+#   bcrypt off the request threads.
+#   Hashing / checking a password is hundreds of ms of CPU, so
+#   it runs in its own process pool (one process per core).
+#   At most HASH_QUEUE_LIMIT jobs are queued or running; past
+#   that HasherBusy is raised straight away so the API can
+#   answer 503 instead of letting a login storm pile up and
+#   starve every other endpoint.
+#   A job keeps its slot until it has actually finished in the
+#   pool, even if the caller gave up waiting for it, so the
+#   limit always counts the real backlog. A caller that waits
+#   longer than HASH_TIMEOUT_SECONDS gets HasherBusy too.
+#   Hashes made with fewer rounds than BCRYPT_ROUNDS are
+#   upgraded the next time their password is checked.
+###############################################################
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+
+import bcrypt
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+HASH_PROCESSES = int(os.getenv("HASH_PROCESSES", os.cpu_count() or 2))
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", HASH_PROCESSES * 4))  # queued + running jobs
+HASH_TIMEOUT_SECONDS = 10
+TIMING_SAMPLES = 1000           # recent timings kept for the percentiles in stats()
+
+
+class HasherBusy(Exception):
+    pass
+
+
+# run in the pool processes
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def _check(password, stored_hash):
+    return bcrypt.checkpw(password.encode('utf-8'), stored_hash.encode('utf-8'))
+
+# the cost a hash was made with ("$2b$12$..." -> 12)
+def hash_rounds(stored_hash):
+    try:
+        return int(stored_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    def __init__(self, processes=HASH_PROCESSES, queue_limit=HASH_QUEUE_LIMIT, rounds=BCRYPT_ROUNDS):
+        self.processes = processes
+        self.queue_limit = queue_limit
+        self.rounds = rounds
+        self._pool = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._rejected = 0
+        self._timeouts = 0
+        self._timings = {"hash": deque(maxlen=TIMING_SAMPLES), "check": deque(maxlen=TIMING_SAMPLES)}
+        self._counts = {"hash": 0, "check": 0}
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.processes)
+        return self._pool
+
+    def _run(self, operation, fn, *args):
+        with self._lock:
+            if self._in_flight >= self.queue_limit:
+                self._rejected += 1
+                raise HasherBusy("Too many password operations in progress, try again shortly.")
+            self._in_flight += 1
+            pool = self._get_pool()
+        started = time.perf_counter()
+        try:
+            future = pool.submit(fn, *args)
+        except BaseException:
+            self._finished(operation, None)
+            raise
+        # the slot is given back when the job is done, not when we stop waiting
+        future.add_done_callback(
+            lambda done: self._finished(operation, None if done.cancelled() else time.perf_counter() - started))
+        try:
+            return future.result(timeout=HASH_TIMEOUT_SECONDS)
+        except FutureTimeout:
+            future.cancel()         # only works if it hasn't started yet
+            with self._lock:
+                self._timeouts += 1
+            raise HasherBusy("Password check took too long, try again shortly.")
+
+    # elapsed is None for jobs that never ran
+    def _finished(self, operation, elapsed):
+        with self._lock:
+            self._in_flight -= 1
+            if elapsed is not None:
+                self._counts[operation] += 1
+                self._timings[operation].append(elapsed)
+
+    # ----------------------
+    # API
+    # ----------------------
+    # both raise HasherBusy when the pool is saturated or the job times out
+
+    def hash_password(self, password):
+        return self._run("hash", _hash, password, self.rounds)
+
+    # returns (matches, new_hash). new_hash is set when the password matched but
+    # the stored hash is weaker than BCRYPT_ROUNDS; save it in place of the old one
+    def check_password(self, password, stored_hash):
+        if not self._run("check", _check, password, stored_hash):
+            return False, None
+        rounds = hash_rounds(stored_hash)
+        if rounds is not None and rounds < self.rounds:
+            try:
+                return True, self.hash_password(password)
+            except HasherBusy:
+                return True, None       # upgrade next time
+        return True, None
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "in_flight": self._in_flight,
+                "queue_limit": self.queue_limit,
+                "rejected": self._rejected,
+                "timeouts": self._timeouts,
+                "rounds": self.rounds,
+            }
+            for operation, timings in self._timings.items():
+                ordered = sorted(timings)
+                stats[operation] = {
+                    "count": self._counts[operation],
+                    "p50_ms": round(ordered[len(ordered) // 2] * 1000, 1) if ordered else None,
+                    "p95_ms": round(ordered[int(len(ordered) * 0.95)] * 1000, 1) if ordered else None,
+                    "max_ms": round(ordered[-1] * 1000, 1) if ordered else None,
+                }
+            return stats
+
+
+hasher = PasswordHasher()
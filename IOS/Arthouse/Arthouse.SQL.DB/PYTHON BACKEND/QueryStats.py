@@ -0,0 +1,187 @@
+###############################################################
+#   Per-statement metrics for the run_* helpers in queryHelper.
+#   Every statement is reduced to a fingerprint (values, %s
+#   placeholders and IN / VALUES lists collapsed), so all the
+#   calls of e.g. get_profile_by_username land on one entry
+#   holding: calls, errors, rows, a latency histogram and the
+#   time spent waiting for a pooled connection.
+#   Statements slower than SLOW_QUERY_MS go to the slow query
+#   log (JSON lines, parameters are never written). With
+#   SLOW_QUERY_EXPLAIN=1 a SELECT's EXPLAIN plan is captured
+#   too, in the background, at most once per fingerprint per
+#   EXPLAIN_INTERVAL_SECONDS.
+###############################################################
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 200))
+SLOW_QUERY_LOG = os.getenv("SLOW_QUERY_LOG", "slow_queries.log")
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "0") == "1"
+EXPLAIN_INTERVAL_SECONDS = 300
+# upper bounds of the latency histogram buckets, in ms (the last bucket is everything above)
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+# ----------------------
+# fingerprints
+# ----------------------
+
+_COMMENTS = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+_STRINGS = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_NUMBERS = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDERS = re.compile(r"%s|%\(\w+\)s")
+_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_ROW_LISTS = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+_SPACES = re.compile(r"\s+")
+
+# "SELECT * FROM post WHERE post_id IN (%s, %s, %s)" -> "SELECT * FROM post WHERE post_id IN (...)"
+@lru_cache(maxsize=4096)
+def fingerprint(query):
+    text = _COMMENTS.sub(" ", query)
+    text = _STRINGS.sub("?", text)
+    text = _PLACEHOLDERS.sub("?", text)
+    text = _NUMBERS.sub("?", text)
+    text = _LISTS.sub("(...)", text)
+    text = _ROW_LISTS.sub("(...)", text)
+    return _SPACES.sub(" ", text).strip()
+
+
+class _Entry:
+    __slots__ = ("calls", "errors", "rows", "total_ms", "max_ms", "acquire_ms", "buckets", "last_explain")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.acquire_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.last_explain = 0.0
+
+    # upper bound of the bucket the q-th fraction of calls falls in
+    def percentile(self, q):
+        target = q * self.calls
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self.buckets):
+            seen += count
+            if seen >= target and seen:
+                return bound
+        return self.max_ms
+
+
+class QueryStats:
+    def __init__(self, slow_ms=SLOW_QUERY_MS, log_path=SLOW_QUERY_LOG, explain=SLOW_QUERY_EXPLAIN):
+        self.slow_ms = slow_ms
+        self._explainer = None          # set by queryHelper: (query, params) -> plan rows
+        # made up front, not on the first slow query, so concurrent ones can't each make one
+        self._explain_pool = ThreadPoolExecutor(max_workers=1) if explain else None
+        self._entries = {}
+        self._lock = threading.Lock()
+        # a logger of its own (not from getLogger), so each instance writes to its own log_path.
+        # the file is only created once there's a slow query to write
+        self._log = logging.Logger("arthouse.slow_queries", logging.INFO)
+        handler = logging.FileHandler(log_path, delay=True)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self._log.addHandler(handler)
+
+    def set_explainer(self, explainer):
+        self._explainer = explainer
+
+    def _write_slow(self, record):
+        self._log.info(json.dumps(record, default=str))
+
+    # ----------------------
+    # recording
+    # ----------------------
+
+    # seconds for elapsed/acquire. params are only used for EXPLAIN, never stored
+    def record(self, query, elapsed, rows=0, acquire=0.0, error=False, params=None):
+        key = fingerprint(query)
+        elapsed_ms = elapsed * 1000
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry()
+            entry.calls += 1
+            entry.errors += bool(error)
+            entry.rows += rows or 0
+            entry.total_ms += elapsed_ms
+            entry.max_ms = max(entry.max_ms, elapsed_ms)
+            entry.acquire_ms += acquire * 1000
+            bucket = 0
+            while bucket < len(LATENCY_BUCKETS_MS) and elapsed_ms > LATENCY_BUCKETS_MS[bucket]:
+                bucket += 1
+            entry.buckets[bucket] += 1
+
+            slow = elapsed_ms >= self.slow_ms
+            explain = (slow and self._explain_pool is not None and self._explainer is not None and not error
+                       and key.upper().startswith("SELECT")
+                       and time.monotonic() - entry.last_explain >= EXPLAIN_INTERVAL_SECONDS)
+            if explain:
+                entry.last_explain = time.monotonic()
+
+        if slow:
+            record = {
+                "at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "fingerprint": key,
+                "ms": round(elapsed_ms, 1),
+                "acquire_ms": round(acquire * 1000, 1),
+                "rows": rows,
+                "error": bool(error),
+            }
+            try:
+                self._write_slow(record)
+            except Exception as e:
+                print(f"Could not write the slow query log : {e}")
+            if explain:
+                # on its own thread and connection, the caller is already slow enough
+                self._explain_pool.submit(self._capture_explain, key, query, params)
+
+    def _capture_explain(self, key, query, params):
+        try:
+            plan = self._explainer(query, params)
+            self._write_slow({"at": time.strftime("%Y-%m-%dT%H:%M:%S"), "fingerprint": key, "explain": plan})
+        except Exception as e:
+            print(f"EXPLAIN failed for \"{key}\" : {e}")
+
+    # ----------------------
+    # reading
+    # ----------------------
+
+    # the top statements, sorted by "total_ms" (where the time goes), "p95_ms",
+    # "max_ms", "calls", "rows" or "errors"
+    def report(self, top=20, sort="total_ms"):
+        with self._lock:
+            rows = []
+            for key, entry in self._entries.items():
+                rows.append({
+                    "fingerprint": key,
+                    "calls": entry.calls,
+                    "errors": entry.errors,
+                    "rows": entry.rows,
+                    "total_ms": round(entry.total_ms, 1),
+                    "mean_ms": round(entry.total_ms / entry.calls, 2),
+                    "p50_ms": entry.percentile(0.5),
+                    "p95_ms": entry.percentile(0.95),
+                    "p99_ms": entry.percentile(0.99),
+                    "max_ms": round(entry.max_ms, 1),
+                    "mean_acquire_ms": round(entry.acquire_ms / entry.calls, 2),
+                    "histogram": dict(zip([f"<={bound}" for bound in LATENCY_BUCKETS_MS] + ["more"], entry.buckets)),
+                })
+        rows.sort(key=lambda row: row[sort], reverse=True)
+        return rows[:top]
+
+    def reset(self):
+        with self._lock:
+            self._entries.clear()
+
+
+stats = QueryStats()
@@ -0,0 +1,273 @@
+###############################################################
+#   Recommended feed, precomputed.
+#   Keeps a hashtag vector for every recent post and a hashtag
+#   affinity vector (hashtags of liked posts) for every user in
+#   NumPy arrays. A recommendation is one matrix-vector product
+#   times a recency decay, and the result is cached per user.
+#   The arrays are built from the database once and then kept
+#   up to date by the post/like functions in
+#   ArthouseDBSQLComands_POSTS.py.
+###############################################################
+
+import math
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from queryHelper import run_read_multiple
+
+CANDIDATE_POSTS = 5000          # newest posts considered for recommendations
+RECENCY_HALF_LIFE_HOURS = 72    # a post's score halves every this many hours
+CACHE_SECONDS = 300             # how long a user's recommendations are reused
+CACHE_DEPTH = 50                # recommendations computed (and cached) per user
+REBUILD_SECONDS = 3600          # full rebuild from the database this often
+
+
+def _timestamp(created_at):
+    if isinstance(created_at, datetime):
+        return created_at.timestamp()
+    if created_at is None:
+        return time.time()
+    return float(created_at)
+
+
+class RecommendationEngine:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()     # one build at a time
+        self._built_at = None
+        self._changes = None        # post writes made while a build runs, replayed on top of it
+        self._reset()
+
+    def _reset(self):
+        self._tag_column = {}                                   # hashtag -> column
+        self._post_row = {}                                     # post_id -> row
+        self._post_ids = np.zeros(0, dtype=np.int64)
+        self._post_times = np.zeros(0, dtype=np.float64)
+        self._post_authors = np.zeros(0, dtype=object)
+        self._post_alive = np.zeros(0, dtype=bool)
+        self._post_vectors = np.zeros((0, 64), dtype=np.float32)  # rows = posts, columns = hashtags
+        self._post_count = 0
+        self._user_vectors = {}                                 # username -> hashtag counts of liked posts
+        self._cache = {}                                        # username -> (expires_at, [(post_id, priority)])
+
+    # ----------------------
+    # BUILD
+    # ----------------------
+
+    # loads the newest CANDIDATE_POSTS posts and their hashtags in two queries.
+    # the arrays are filled in a separate engine and swapped in at the end, so
+    # readers keep using the old ones while the queries run
+    def build(self):
+        with self._lock:
+            self._changes = []
+        try:
+            posts = run_read_multiple("""
+                SELECT post_id, username, created_at FROM post
+                ORDER BY created_at DESC, post_id DESC
+                LIMIT %s
+            """, (CANDIDATE_POSTS,))
+            tags = run_read_multiple("""
+                SELECT h.post_id, h.hashtag
+                FROM hashtag h
+                JOIN (SELECT post_id FROM post ORDER BY created_at DESC, post_id DESC LIMIT %s) recent
+                  ON recent.post_id = h.post_id
+            """, (CANDIDATE_POSTS,))
+
+            tags_by_post = {}
+            for post_id, hashtag in tags or []:
+                tags_by_post.setdefault(post_id, []).append(hashtag)
+
+            fresh = RecommendationEngine()
+            # oldest first so rows are in time order
+            for post_id, username, created_at in reversed(posts or []):
+                fresh._add_post(post_id, username, created_at, tags_by_post.get(post_id, []))
+
+            with self._lock:
+                changes = self._changes
+                self._reset()
+                for name in ("_tag_column", "_post_row", "_post_ids", "_post_times", "_post_authors",
+                             "_post_alive", "_post_vectors", "_post_count"):
+                    setattr(self, name, getattr(fresh, name))
+                self._built_at = time.monotonic()
+                # the queries may have been read before these landed
+                for change in changes:
+                    self._apply(*change)
+        finally:
+            with self._lock:
+                self._changes = None
+
+    def _stale(self):
+        return self._built_at is None or time.monotonic() - self._built_at > REBUILD_SECONDS
+
+    # the first build is waited for. after that one caller rebuilds and the
+    # others keep ranking with the old arrays instead of queueing behind it
+    def _ensure_built(self):
+        if not self._stale():
+            return
+        if not self._build_lock.acquire(blocking=self._built_at is None):
+            return
+        try:
+            if self._stale():
+                self.build()
+        finally:
+            self._build_lock.release()
+
+    def _column(self, hashtag):
+        column = self._tag_column.get(hashtag)
+        if column is None:
+            column = len(self._tag_column)
+            self._tag_column[hashtag] = column
+            if column >= self._post_vectors.shape[1]:
+                extra = self._post_vectors.shape[1]
+                self._post_vectors = np.pad(self._post_vectors, ((0, 0), (0, extra)))
+        return column
+
+    def _add_post(self, post_id, username, created_at, hashtags):
+        if post_id in self._post_row:
+            return
+        row = self._post_count
+        if row >= len(self._post_ids):
+            extra = max(len(self._post_ids), 256)
+            self._post_ids = np.pad(self._post_ids, (0, extra))
+            self._post_times = np.pad(self._post_times, (0, extra))
+            self._post_authors = np.concatenate([self._post_authors, np.full(extra, None, dtype=object)])
+            self._post_alive = np.pad(self._post_alive, (0, extra))
+            self._post_vectors = np.pad(self._post_vectors, ((0, extra), (0, 0)))
+        self._post_ids[row] = post_id
+        self._post_times[row] = _timestamp(created_at)
+        self._post_authors[row] = username
+        self._post_alive[row] = True
+        self._set_tags(row, hashtags)
+        self._post_row[post_id] = row
+        self._post_count += 1
+
+    def _set_tags(self, row, hashtags):
+        columns = [self._column(tag) for tag in set(hashtags)]
+        self._post_vectors[row, :] = 0
+        if columns:
+            # unit length so posts with lots of hashtags don't win by default
+            self._post_vectors[row, columns] = 1.0 / math.sqrt(len(columns))
+
+    def _load_user(self, username):
+        vector = self._user_vectors.get(username)
+        if vector is not None:
+            return vector
+        rows = run_read_multiple("""
+            SELECT h.hashtag, COUNT(*)
+            FROM user_liked_relationships ul
+            JOIN hashtag h ON ul.post_id = h.post_id
+            WHERE ul.username = %s
+            GROUP BY h.hashtag
+        """, (username,))
+        with self._lock:
+            vector = np.zeros(self._post_vectors.shape[1], dtype=np.float32)
+            for hashtag, count in rows or []:
+                column = self._column(hashtag)
+                if column >= len(vector):
+                    vector = np.pad(vector, (0, self._post_vectors.shape[1] - len(vector)))
+                vector[column] += count
+            self._user_vectors[username] = vector
+        return vector
+
+    # ----------------------
+    # INCREMENTAL UPDATES
+    # ----------------------
+    # all of these are no-ops until the engine has been built (a build that is
+    # running replays them). new/edited posts show up once a user's cached list
+    # expires (CACHE_SECONDS), deleted posts are filtered out of cached lists straight away
+
+    def add_post(self, post_id, username, created_at, hashtags):
+        self._change("add", post_id, username, created_at, hashtags or [])
+
+    def update_post_hashtags(self, post_id, hashtags):
+        self._change("tags", post_id, hashtags or [])
+
+    def remove_post(self, post_id):
+        self._change("remove", post_id)
+
+    def _change(self, *change):
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append(change)
+            if self._built_at is not None:
+                self._apply(*change)
+
+    def _apply(self, kind, post_id, *args):
+        if kind == "add":
+            self._add_post(post_id, *args)
+            return
+        row = self._post_row.get(post_id)
+        if row is None:
+            return
+        if kind == "tags":
+            self._set_tags(row, *args)
+        else:
+            self._post_alive[row] = False
+
+    # direction = 1 for a like, -1 for an unlike
+    def record_like(self, username, post_id, direction=1):
+        with self._lock:
+            vector = self._user_vectors.get(username)
+            row = self._post_row.get(post_id)
+            if vector is not None and row is not None:
+                if len(vector) < self._post_vectors.shape[1]:
+                    vector = np.pad(vector, (0, self._post_vectors.shape[1] - len(vector)))
+                    self._user_vectors[username] = vector
+                columns = np.flatnonzero(self._post_vectors[row])
+                vector[columns] = np.maximum(vector[columns] + direction, 0)
+            elif vector is not None:
+                # liked something older than the candidate window, reload next time
+                del self._user_vectors[username]
+            self._cache.pop(username, None)
+
+    # ----------------------
+    # READ
+    # ----------------------
+
+    # returns [(post_id, priority)] best first. priority 1 = matches the user's
+    # hashtags, 2 = newest posts used to fill up the rest (same as the old SQL)
+    def recommend(self, username, limit=10):
+        with self._lock:
+            cached = self._cache.get(username)
+            if cached and cached[0] > time.monotonic() and limit <= CACHE_DEPTH:
+                alive = [(post_id, priority) for post_id, priority in cached[1]
+                         if post_id in self._post_row and self._post_alive[self._post_row[post_id]]]
+                return alive[:limit]
+        self._ensure_built()
+        depth = max(limit, CACHE_DEPTH)
+        user_vector = self._load_user(username)
+
+        with self._lock:
+            n = self._post_count
+            ranked = []
+            if n:
+                user_vector = user_vector[:self._post_vectors.shape[1]]
+                norm = np.linalg.norm(user_vector)
+                if norm > 0:
+                    affinity = self._post_vectors[:n, :len(user_vector)] @ (user_vector / norm)
+                else:
+                    affinity = np.zeros(n, dtype=np.float32)
+                age_hours = (time.time() - self._post_times[:n]) / 3600.0
+                decay = np.exp2(-np.maximum(age_hours, 0) / RECENCY_HALF_LIFE_HOURS)
+                eligible = self._post_alive[:n] & (self._post_authors[:n] != username)
+
+                scores = np.where(eligible, affinity * decay, -1.0)
+                matched = np.flatnonzero(scores > 0)
+                if len(matched) > depth:
+                    matched = matched[np.argpartition(-scores[matched], depth)[:depth]]
+                matched = matched[np.argsort(-scores[matched], kind="stable")]
+                ranked = [(int(self._post_ids[row]), 1) for row in matched]
+
+                if len(ranked) < depth:
+                    # rows are in time order, newest last
+                    fallback = np.flatnonzero(eligible & (scores <= 0))[::-1][:depth - len(ranked)]
+                    ranked += [(int(self._post_ids[row]), 2) for row in fallback]
+
+            self._cache[username] = (time.monotonic() + CACHE_SECONDS, ranked)
+            return ranked[:limit]
+
+
+engine = RecommendationEngine()
@@ -0,0 +1,234 @@
+###############################################################
+#   Read-through cache for API responses (feed pages, profiles).
+#   Entries are cached under a namespace ("posts",
+#   "profile:<username>"). A write doesn't go looking for the
+#   keys it made stale, it bumps the namespace's generation
+#   number: every key includes the generation it was read at,
+#   so the old entries can't be found anymore and age out.
+#   Entries live in a store:
+#     MemoryStore  - LRU dict inside this process (default)
+#     SqliteStore  - file shared by all worker processes on
+#                    the machine (RESPONSE_CACHE_STORE=sqlite)
+###############################################################
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+RESPONSE_CACHE_STORE = os.getenv("RESPONSE_CACHE_STORE", "memory")     # "memory" or "sqlite"
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", ".response_cache/cache.sqlite3")
+MAX_ENTRIES = 5000              # entries kept before the least recently used go
+DEFAULT_TTL_SECONDS = 30        # upper bound on staleness for writes without a hook
+
+# namespaces
+FEED = "posts"
+
+def profile_namespace(username):
+    return f"profile:{username}"
+
+
+# ----------------------
+# stores
+# ----------------------
+# get(key) -> value or None, set(key, value, ttl), generation(name), bump(name).
+# generations are kept apart from the entries so LRU eviction can never reset one
+
+class MemoryStore:
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()       # key -> (expires_at, value)
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def generation(self, name):
+        return self._generations.get(name, 0)
+
+    def bump(self, name):
+        with self._lock:
+            self._generations[name] = self._generations.get(name, 0) + 1
+
+    def __len__(self):
+        return len(self._entries)
+
+class SqliteStore:
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()     # one connection per thread
+
+    def _conn(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.path, isolation_level=None, timeout=5)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=OFF")    # it's a cache, losing it is fine
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS entry (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS entry_lru ON entry (last_used);
+                CREATE TABLE IF NOT EXISTS generation (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                );
+            """)
+            self._local.db = db
+        return db
+
+    def get(self, key):
+        db = self._conn()
+        row = db.execute("SELECT value, expires_at FROM entry WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        # wall clock here, the file is shared between processes
+        if row[1] <= time.time():
+            db.execute("DELETE FROM entry WHERE key = ?", (key,))
+            return None
+        db.execute("UPDATE entry SET last_used = ? WHERE key = ?", (time.time(), key))
+        return pickle.loads(row[0])
+
+    def set(self, key, value, ttl):
+        db = self._conn()
+        now = time.time()
+        db.execute("INSERT OR REPLACE INTO entry (key, value, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                   (key, pickle.dumps(value), now + ttl, now))
+        count = db.execute("SELECT COUNT(*) FROM entry").fetchone()[0]
+        if count > self.max_entries:
+            db.execute("DELETE FROM entry WHERE key IN (SELECT key FROM entry ORDER BY last_used LIMIT ?)",
+                       (count - self.max_entries,))
+
+    def generation(self, name):
+        row = self._conn().execute("SELECT value FROM generation WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, name):
+        self._conn().execute("INSERT INTO generation (name, value) VALUES (?, 1) "
+                             "ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM entry").fetchone()[0]
+
+
+# ----------------------
+# cache
+# ----------------------
+
+class ResponseCache:
+    def __init__(self, store=None, ttl=DEFAULT_TTL_SECONDS):
+        if store is None:
+            store = SqliteStore() if RESPONSE_CACHE_STORE == "sqlite" else MemoryStore()
+        self.store = store
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    # the cached value for key in namespace, or load() (which is then cached).
+    # load() returning None (an error) isn't cached. the generation is read before
+    # load() runs, so a write that lands during the load makes the result unreachable
+    def get_or_load(self, namespace, key, load, ttl=None):
+        full_key = f"{namespace}:{self.store.generation(namespace)}:{key}"
+        try:
+            value = self.store.get(full_key)
+        except Exception as e:
+            print(f"Response cache read failed : {e}")
+            value = None
+        with self._lock:
+            if value is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+        if value is not None:
+            return value
+
+        value = load()
+        if value is not None:
+            try:
+                self.store.set(full_key, value, ttl or self.ttl)
+            except Exception as e:
+                print(f"Response cache write failed : {e}")
+        return value
+
+    # batch version of get_or_load. keys = {id: (namespace, key)}; load_many(ids)
+    # gets only the ids that weren't cached and returns {id: value}.
+    # returns {id: value} for every id that has a value
+    def get_many_or_load(self, keys, load_many, ttl=None):
+        full_keys = {id: f"{namespace}:{self.store.generation(namespace)}:{key}" for id, (namespace, key) in keys.items()}
+        values = {}
+        for id, full_key in full_keys.items():
+            try:
+                value = self.store.get(full_key)
+            except Exception as e:
+                print(f"Response cache read failed : {e}")
+                value = None
+            if value is not None:
+                values[id] = value
+        missing = [id for id in full_keys if id not in values]
+        with self._lock:
+            self._hits += len(values)
+            self._misses += len(missing)
+        if not missing:
+            return values
+
+        loaded = load_many(missing) or {}
+        for id in missing:
+            value = loaded.get(id)
+            if value is None:
+                continue
+            values[id] = value
+            try:
+                self.store.set(full_keys[id], value, ttl or self.ttl)
+            except Exception as e:
+                print(f"Response cache write failed : {e}")
+        return values
+
+    # call after a write that changes what these namespaces return
+    def invalidate(self, *namespaces):
+        for namespace in namespaces:
+            try:
+                self.store.bump(namespace)
+            except Exception as e:
+                print(f"Response cache invalidation of \"{namespace}\" failed : {e}")
+        with self._lock:
+            self._invalidations += len(namespaces)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "invalidations": self._invalidations,
+                "entries": len(self.store),
+                "store": type(self.store).__name__,
+            }
+
+
+cache = ResponseCache()
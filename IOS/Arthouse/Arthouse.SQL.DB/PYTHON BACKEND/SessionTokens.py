@@ -0,0 +1,126 @@
+###############################################################
+#   Stateless session tokens.
+#   A token is  <payload>.<signature>  (both base64url), where
+#   payload = {"u": username, "exp": expiry, "iat": issued at,
+#              "id": random} (unix times)
+#   and signature = HMAC-SHA256(SESSION_SECRET, payload).
+#   Checking one is an HMAC and a couple of dict lookups: no
+#   bcrypt, no database. Logged out tokens are remembered in
+#   an in-memory revocation set until they would have expired
+#   anyway, and revoke_user() cuts off every token a user was
+#   given before now (password change, "log out everywhere").
+#   Set SESSION_SECRET in .env; without it a random secret is
+#   made at startup and tokens don't survive a restart (or work
+#   across workers). api_server refuses that outside debug mode.
+###############################################################
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", 7 * 24 * 60 * 60))
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+class SessionTokens:
+    def __init__(self, secret=None, ttl=SESSION_TTL_SECONDS):
+        secret = secret or os.getenv("SESSION_SECRET")
+        self.random_secret = not secret
+        if self.random_secret:
+            print("################################################################")
+            print("# WARNING: SESSION_SECRET is not set, using a random one.")
+            print("# Sessions end when the server restarts and tokens from one")
+            print("# worker are rejected by the others. Set it in .env.")
+            print("################################################################")
+            secret = secrets.token_hex(32)
+        self._secret = secret.encode("utf-8")
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._revoked = {}          # token id -> expiry, dropped once expired
+        self._not_before = {}       # username -> tokens issued before this are invalid
+
+    def _sign(self, payload):
+        return _b64encode(hmac.new(self._secret, payload.encode("ascii"), hashlib.sha256).digest())
+
+    # ----------------------
+    # CREATE
+    # ----------------------
+
+    # returns (token, expires_at)
+    def issue(self, username, ttl=None):
+        now = time.time()
+        expires_at = int(now + (ttl or self.ttl))
+        claims = {"u": username, "exp": expires_at, "iat": now, "id": secrets.token_hex(8)}
+        payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+        return f"{payload}.{self._sign(payload)}", expires_at
+
+    # ----------------------
+    # READ
+    # ----------------------
+
+    # the token's claims if it's genuine, unexpired and not revoked, otherwise None
+    def claims(self, token):
+        if not token or token.count(".") != 1:
+            return None
+        payload, signature = token.split(".")
+        try:
+            if not hmac.compare_digest(signature.encode("utf-8"), self._sign(payload).encode("utf-8")):
+                return None
+            claims = json.loads(_b64decode(payload))
+        except ValueError:
+            return None
+        if claims.get("exp", 0) <= time.time():
+            return None
+        with self._lock:
+            if claims.get("id") in self._revoked:
+                return None
+            if claims.get("iat", 0) < self._not_before.get(claims.get("u"), 0):
+                return None
+        return claims
+
+    # the username a token was issued to, or None if it isn't valid
+    def verify(self, token):
+        claims = self.claims(token)
+        return claims["u"] if claims else None
+
+    # ----------------------
+    # DELETE (revocation)
+    # ----------------------
+
+    # logs one token out. returns False if it wasn't valid to begin with
+    def revoke(self, token):
+        claims = self.claims(token)
+        if claims is None:
+            return False
+        with self._lock:
+            self._revoked[claims["id"]] = claims["exp"]
+            self._prune()
+        return True
+
+    # every token issued to username before now stops working
+    def revoke_user(self, username):
+        with self._lock:
+            self._not_before[username] = time.time()
+            self._prune()
+
+    def _prune(self):
+        now = time.time()
+        for token_id in [token_id for token_id, expires_at in self._revoked.items() if expires_at <= now]:
+            del self._revoked[token_id]
+        # past ttl every token issued before the cut off has expired by itself
+        for username in [username for username, since in self._not_before.items() if since + self.ttl <= now]:
+            del self._not_before[username]
+
+
+sessions = SessionTokens()
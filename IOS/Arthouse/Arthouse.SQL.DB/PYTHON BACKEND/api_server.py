@@ -1,44 +1,168 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Request, request, g, jsonify, send_from_directory
 from flask_cors import CORS
 import ArthouseDBSQLComands_USER as user_db
-from queryHelper import run_cud_query, run_read_multiple, run_read_single
+import ArthouseDBSQLComands_TIMELINE as timeline_db
+from BlobStore import store as blob_store, BlobTooLarge
+import MediaManager
+import ResponseCache
+from ResponseCache import cache as response_cache
+from DataLoader import DataLoader
+from PasswordHasher import hasher, HasherBusy
+from SessionTokens import sessions
+from RecommendationEngine import engine as recommender
+from queryHelper import run_cud_query, run_read_multiple, run_read_single, transaction
+from queryHelper import encode_page_cursor, keyset_condition
+from queryHelper import get_query_stats, get_pool_stats
 import os
-import uuid
+import re
+import hmac
+import io
 import base64
+import functools
+from PIL import Image
+
+try:
+    # HEIC photos straight from iPhones; without the plugin they are refused like any unknown format
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+except ImportError:
+    pass
+
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024       # biggest image accepted by /api/posts/upload
+UPLOAD_READ_SIZE = 64 * 1024
+
+# multipart file parts are written straight into the blob store (hashing as they
+# go) instead of werkzeug's temp files, so they're never held in memory
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        writer = blob_store.open_writer(MAX_UPLOAD_BYTES)
+        self.upload_writers.append(writer)
+        return writer
+
+    @property
+    def upload_writers(self):
+        # every temp file opened for this request, so unused / rejected ones get cleaned up
+        if "_upload_writers" not in self.__dict__:
+            self.__dict__["_upload_writers"] = []
+        return self.__dict__["_upload_writers"]
 
 app = Flask(__name__)
+app.request_class = UploadRequest
+# let a front end server (nginx/Apache) send /uploads files itself
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE') == '1'
 CORS(app)
 
-def upload_image_locally(image_data, filename):
-    """Save base64 image locally for testing"""
+# a random session secret (SESSION_SECRET unset) is only good enough for development:
+# python api_server.py or FLASK_DEBUG=1. anything else (gunicorn, ...) won't start
+if sessions.random_secret and not (app.debug or __name__ == '__main__'):
+    raise RuntimeError("SESSION_SECRET must be set when not running in debug mode")
+
+UPLOADS_URL = "http://localhost:5001/uploads/"
+
+# the extension an upload is stored (and later served) under comes from the format
+# PIL finds in its bytes, never from the client's file name or content type.
+# anything else is refused with a 415
+UPLOAD_IMAGE_FORMATS = {"JPEG": ".jpg", "PNG": ".png", "GIF": ".gif", "WEBP": ".webp", "HEIF": ".heic"}
+
+class UnsupportedImage(Exception):
+    pass
+
+# source = a path or a file object. PIL only parses the header here
+def image_extension(source):
+    try:
+        with Image.open(source) as img:
+            image_format = img.format
+    except Exception:
+        image_format = None
+    ext_name = UPLOAD_IMAGE_FORMATS.get(image_format)
+    if ext_name is None:
+        raise UnsupportedImage("Only JPEG, PNG, GIF, WebP and HEIC images can be uploaded")
+    return ext_name
+
+def upload_image_locally(image_data):
+    """Save base64 image locally for testing (deduplicated by content, see BlobStore)"""
     try:
-        # Create uploads directory if it doesn't exist
-        uploads_dir = "uploads"
-        if not os.path.exists(uploads_dir):
-            os.makedirs(uploads_dir)
-        
         # Decode base64 image
         image_bytes = base64.b64decode(image_data)
         
-        # Create unique filename
-        unique_filename = f"{uuid.uuid4()}_{filename}"
-        file_path = os.path.join(uploads_dir, unique_filename)
-        
-        # Save to local file
-        with open(file_path, 'wb') as f:
-            f.write(image_bytes)
+        # Stored under its content hash; the same image uploaded twice is kept once
+        ext_name = image_extension(io.BytesIO(image_bytes))
+        relative_path = blob_store.put(image_bytes, ext_name)
         
         # Return local URL (for testing)
-        return f"http://localhost:5001/uploads/{unique_filename}"
+        return UPLOADS_URL + relative_path
         
+    except UnsupportedImage:
+        raise
     except Exception as e:
         print(f"Error saving image locally: {e}")
         return None
 
+# drops the post's reference to its local image, the file goes when nobody uses it
+def release_local_image(image_url):
+    if image_url and image_url.startswith(UPLOADS_URL):
+        try:
+            blob_store.release(image_url[len(UPLOADS_URL):])
+        except Exception as e:
+            print(f"Error releasing local image {image_url}: {e}")
+
 @app.route('/')
 def home():
     return {"message": "Arthouse API running"}
 
+# bcrypt is saturated (see PasswordHasher), shed the request instead of queueing it
+@app.errorhandler(HasherBusy)
+def password_hasher_busy(e):
+    return {"error": "Server busy, try again shortly"}, 503, {"Retry-After": "1"}
+
+# ----------------------
+# sessions
+# ----------------------
+# login/register hand out a session token (SessionTokens). clients send it back as
+# "Authorization: Bearer <token>" and the endpoints take the username from it.
+# clients without a token still work (username in the body) unless REQUIRE_SESSION_TOKEN=1
+REQUIRE_SESSION_TOKEN = os.getenv('REQUIRE_SESSION_TOKEN') == '1'
+
+class AuthError(Exception):
+    def __init__(self, message, status=401):
+        super().__init__(message)
+        self.status = status
+
+@app.errorhandler(AuthError)
+def auth_error(e):
+    return {"error": str(e)}, e.status
+
+def bearer_token():
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return token.strip() if scheme.lower() == 'bearer' else None
+
+# username of this request's session token, None without one.
+# a token that's there but not valid (forged, expired, logged out) is a 401
+def session_user():
+    if 'session_user' not in g:
+        token = bearer_token()
+        username = sessions.verify(token) if token else None
+        if token and username is None:
+            raise AuthError("Invalid or expired session")
+        g.session_user = username
+    return g.session_user
+
+# who this request acts as. with a token that's its user, and claiming to be
+# someone else is refused; without one the claimed username is used (old clients)
+def acting_user(claimed):
+    username = session_user()
+    if username is None:
+        if REQUIRE_SESSION_TOKEN:
+            raise AuthError("Login required")
+        return claimed
+    if claimed and claimed != username:
+        raise AuthError("Session belongs to another user", 403)
+    return username
+
+def session_response(username):
+    token, expires_at = sessions.issue(username)
+    return {"token": token, "expires_at": expires_at}
+
 @app.route('/api/register', methods=['POST'])
 def register():
     data = request.json
@@ -47,22 +171,36 @@ def register():
     password = data.get('password')
     name = data.get('name', username)
     
-    if user_db.create_user(username, email, password):
-        if user_db.create_profile(name, username, "", ""):
+    if not password:
+        return {"error": "Password required"}, 400
+    # hashed before the transaction so no connection is held while bcrypt runs
+    password_hash = hasher.hash_password(password)
+
+    # user + profile are written in one transaction; if the profile fails the
+    # user row is rolled back instead of being deleted afterwards
+    error = None
+    try:
+        with transaction():
+            if not user_db.create_user(username, email, password, password_hash):
+                error = "User creation failed"
+            elif not user_db.create_profile(name, username, "", ""):
+                error = "Profile creation failed"
+            if error:
+                raise Exception(error)
             profile = user_db.get_profile_by_username(username)
-            return {
-                "success": True,
-                "user": {
-                    "username": username,
-                    "email": email,
-                    "name": profile[0] if profile else name
-                }
-            }
-        else:
-            user_db.delete_user(username)
-            return {"error": "Profile creation failed"}, 400
-    else:
-        return {"error": "User creation failed"}, 400
+    except Exception as e:
+        print(f"Registration of {username} rolled back: {e}")
+        return {"error": error or "User creation failed"}, 400
+
+    return {
+        "success": True,
+        "user": {
+            "username": username,
+            "email": email,
+            "name": profile[0] if profile else name
+        },
+        "session": session_response(username)
+    }
 
 @app.route('/api/login', methods=['POST'])
 def login():
@@ -72,7 +210,7 @@ def login():
     
     if user_db.verify_user_login(username, password):
         user = user_db.get_user_by_username(username)
-        profile = user_db.get_profile_by_username(username)
+        profile = user_db.get_profile_summary(username)
         
         if user and profile:
             return {
@@ -80,47 +218,153 @@ def login():
                 "user": {
                     "username": user[0],
                     "email": user[1],
-                    "name": profile[0]
-                }
+                    "name": profile["name"]
+                },
+                "session": session_response(user[0])
             }
     
     return {"error": "Invalid login"}, 401
 
+# ends the session of the token in the Authorization header
+@app.route('/api/logout', methods=['POST'])
+def logout():
+    token = bearer_token()
+    if not token or not sessions.revoke(token):
+        return {"error": "Invalid or expired session"}, 401
+    return {"success": True}
+
+USERS_BATCH_MAX = 100      # usernames per /api/users request
+
+# every profile lookup made while building one response goes through this
+# request's loader, so they end up as one get_profiles_by_usernames call
+def profile_loader():
+    if 'profile_loader' not in g:
+        g.profile_loader = DataLoader(user_db.get_profiles_by_usernames)
+    return g.profile_loader
+
+def public_profile(profile):
+    return {
+        "username": profile["username"],
+        "name": profile["name"],
+        "bio": profile["bio"],
+        "profile_picture_url": profile["profile_picture_url"],
+        "follower_count": profile["follower_count"],
+        "following_count": profile["following_count"]
+    }
+
+# counts come from the profile row, cached (see user_db.get_profile_summary)
 @app.route('/api/user/<username>')
 def get_user(username):
-    profile = user_db.get_profile_by_username(username)
+    profile = user_db.get_profile_summary(username)
     if profile:
-        followers = user_db.view_followers(username) or []
-        following = user_db.view_following(username) or []
-        
-        return {
-            "username": profile[1],
-            "name": profile[0],
-            "bio": profile[3],
-            "follower_count": len(followers),
-            "following_count": len(following)
-        }
+        return public_profile(profile)
     return {"error": "User not found"}, 404
 
+# many profiles at once: GET /api/users?usernames=a,b,c (or ?username=a&username=b)
+# users that don't exist are left out
+@app.route('/api/users')
+def get_users():
+    usernames = request.args.getlist('username')
+    for value in request.args.getlist('usernames'):
+        usernames += [username.strip() for username in value.split(',') if username.strip()]
+    usernames = list(dict.fromkeys(usernames))
+    if not usernames:
+        return {"error": "usernames required"}, 400
+    if len(usernames) > USERS_BATCH_MAX:
+        return {"error": f"At most {USERS_BATCH_MAX} usernames per request"}, 400
+
+    profiles = profile_loader().load_many(usernames)
+    return {
+        "success": True,
+        "users": [public_profile(profile) for profile in profiles if profile]
+    }
+
 @app.route('/api/follow', methods=['POST'])
 def follow():
     data = request.json
-    if user_db.follow(data.get('follower'), data.get('followee')):
+    if user_db.follow(acting_user(data.get('follower')), data.get('followee')):
         return {"success": True}
     return {"error": "Follow failed"}, 400
 
 @app.route('/api/unfollow', methods=['POST'])
 def unfollow():
     data = request.json
-    if user_db.unfollow(data.get('follower'), data.get('followee')):
+    if user_db.unfollow(acting_user(data.get('follower')), data.get('followee')):
         return {"success": True}
     return {"error": "Unfollow failed"}, 400
 
+# smaller copies of a local image (320/640/1080 wide, JPEG + WebP) are made in
+# MediaManager's worker pool after the post is saved and stored next to it.
+# until they exist the feed hands out the original, so cached feed pages are
+# dropped again once they're done (pages cached in between have the original urls)
+def make_local_variants(image_url):
+    if not image_url or not image_url.startswith(UPLOADS_URL):
+        return
+    full_path = blob_store.full_path(image_url[len(UPLOADS_URL):])
+    job = MediaManager.get_probe_pool().submit(MediaManager.make_variants, full_path, os.path.dirname(full_path))
+
+    def variants_done(done):
+        if done.exception():
+            print(f"Error making variants of {image_url}: {done.exception()}")
+            return
+        response_cache.invalidate(ResponseCache.FEED)
+
+    job.add_done_callback(variants_done)
+
+# url of the smallest variant at least width wide (WebP first if webp), or the
+# original when it's the best fit / the variants aren't there yet
+def local_variant_url(image_url, width, webp=False):
+    if not width or not image_url or not image_url.startswith(UPLOADS_URL):
+        return image_url
+    relative_path = image_url[len(UPLOADS_URL):]
+    formats = ("webp", "jpeg") if webp else ("jpeg",)
+    available = []
+    for variant_width in MediaManager.VARIANT_WIDTHS:
+        for format in formats:
+            path = blob_store.variant_path(relative_path, MediaManager.variant_suffix(variant_width, format))
+            if os.path.exists(blob_store.full_path(path)):
+                available.append((variant_width, format, path))
+    variant = MediaManager.choose_variant(available, width, formats)
+    return UPLOADS_URL + variant[2] if variant else image_url
+
+# inserts the post row and builds the response, shared by both create endpoints
+def save_post(username, caption, image_url, media_type):
+    # Save post to database with image URL
+    query = "INSERT INTO post (username, post_description, image_url, is_private, like_count, comment_count) VALUES (%s, %s, %s, %s, %s, %s)"
+    post_id = run_cud_query(query, (username, caption, image_url, False, 0, 0))
+    
+    if post_id:
+        timeline_db.fan_out_post(post_id)
+        recommender.add_post(post_id, username, None, [])
+        make_local_variants(image_url)
+        response_cache.invalidate(ResponseCache.FEED)
+        print(f"✅ Post saved to database:")
+        print(f"   Post ID: {post_id}")
+        print(f"   User: {username}")
+        print(f"   Caption: {caption}")
+        print(f"   Image URL: {image_url}")
+        
+        return {
+            "success": True,
+            "message": "Post created successfully",
+            "post": {
+                "post_id": post_id,
+                "username": username,
+                "caption": caption,
+                "image_url": image_url,
+                "media_type": media_type
+            }
+        }
+    else:
+        release_local_image(image_url)
+        return {"error": "Failed to save post to database"}, 400
+
+# JSON + base64 version, kept for older clients. prefer /api/posts/upload
 @app.route('/api/posts', methods=['POST'])
 def create_post():
     try:
         data = request.json
-        username = data.get('username')
+        username = acting_user(data.get('username'))
         caption = data.get('caption', '')
         media_type = data.get('media_type', 'photo')
         image_data = data.get('image_data')  # Base64 encoded image
@@ -128,86 +372,160 @@ def create_post():
         image_url = None
         if image_data:
             # Use local storage for now
-            filename = f"{username}_{uuid.uuid4()}.jpg"
-            image_url = upload_image_locally(image_data, filename)
+            image_url = upload_image_locally(image_data)
             
             if not image_url:
                 return {"error": "Failed to save image"}, 400
         
-        # Save post to database with image URL
-        query = "INSERT INTO post (username, post_description, image_url, is_private, like_count, comment_count) VALUES (%s, %s, %s, %s, %s, %s)"
-        post_id = run_cud_query(query, (username, caption, image_url, False, 0, 0))
-        
-        if post_id:
-            print(f"✅ Post saved to database:")
-            print(f"   Post ID: {post_id}")
-            print(f"   User: {username}")
-            print(f"   Caption: {caption}")
-            print(f"   Image URL: {image_url}")
+        return save_post(username, caption, image_url, media_type)
             
-            return {
-                "success": True,
-                "message": "Post created successfully",
-                "post": {
-                    "post_id": post_id,
-                    "username": username,
-                    "caption": caption,
-                    "image_url": image_url,
-                    "media_type": media_type
-                }
-            }
+    except UnsupportedImage as e:
+        return {"error": str(e)}, 415
+    except AuthError:
+        raise
+    except Exception as e:
+        print(f"Error creating post: {e}")
+        return {"error": f"Failed to create post: {str(e)}"}, 500
+
+# Streaming upload, the image is written to disk as it arrives:
+#   multipart/form-data  -> fields username, caption, media_type + file field "image"
+#   raw body (image/jpeg, application/octet-stream, ...) -> the image bytes,
+#                           username/caption/media_type in the query string
+@app.route('/api/posts/upload', methods=['POST'])
+def upload_post():
+    session_user()      # a bad token is refused before the body is read
+    try:
+        if request.content_length and request.content_length > MAX_UPLOAD_BYTES + UPLOAD_READ_SIZE:
+            return {"error": f"Image is larger than {MAX_UPLOAD_BYTES} bytes"}, 413
+
+        if request.mimetype == 'multipart/form-data':
+            fields = request.form
+            image = request.files.get('image')
+            writer = None
+            if image is not None:
+                writer = image.stream
         else:
-            return {"error": "Failed to save post to database"}, 400
-            
+            fields = request.args
+            writer = blob_store.open_writer(MAX_UPLOAD_BYTES)
+            request.upload_writers.append(writer)
+            while True:
+                chunk = request.stream.read(UPLOAD_READ_SIZE)
+                if not chunk:
+                    break
+                writer.write(chunk)
+            if writer.size == 0:
+                writer = None
+
+        username = acting_user(fields.get('username'))
+        if not username:
+            return {"error": "Username required"}, 400
+
+        image_url = None
+        if writer is not None:
+            writer.flush()
+            ext_name = image_extension(writer.temp_path)
+            image_url = UPLOADS_URL + blob_store.put_writer(writer, ext_name)
+        return save_post(username, fields.get('caption', ''), image_url, fields.get('media_type', 'photo'))
+
+    except BlobTooLarge as e:
+        return {"error": str(e)}, 413
+    except UnsupportedImage as e:
+        return {"error": str(e)}, 415
+    except AuthError:
+        raise
     except Exception as e:
         print(f"Error creating post: {e}")
         return {"error": f"Failed to create post: {str(e)}"}, 500
+    finally:
+        # the stored one was already moved into place, this only removes leftovers
+        for leftover in request.upload_writers:
+            leftover.discard()
+
+POSTS_PAGE_SIZE = 20
+POSTS_MAX_PAGE_SIZE = 50
 
+# GET /api/posts?limit=20&cursor=<next_cursor from the previous page>
+#   &width=<display width in pixels>  image_url is then the closest smaller copy
+#   &format=webp                      ...preferring the WebP one
+# original_url is always the full size image.
+# pages are cached (ResponseCache), new/deleted posts, likes and comments invalidate them
 @app.route('/api/posts', methods=['GET'])
 def get_posts():
     try:
-        # Get posts from database including image URLs
-        query = "SELECT post_id, username, post_description, image_url, like_count, created_at FROM post ORDER BY created_at DESC LIMIT 20"
-        posts_data = run_read_multiple(query)
-        
-        if posts_data:
-            posts = []
-            for post_row in posts_data:
-                posts.append({
-                    "post_id": post_row[0],
-                    "username": post_row[1],
-                    "caption": post_row[2] or "",
-                    "image_url": post_row[3] or "",
-                    "like_count": post_row[4] or 0,
-                    "created_at": str(post_row[5]) if post_row[5] else ""
-                })
-            
-            print(f"📊 Returning {len(posts)} posts from database")
-            return {
-                "success": True,
-                "posts": posts
-            }
-        else:
-            print("📊 No posts found in database")
-            return {
-                "success": True,
-                "posts": []
-            }
+        limit = min(max(request.args.get('limit', POSTS_PAGE_SIZE, type=int), 1), POSTS_MAX_PAGE_SIZE)
+        cursor = request.args.get('cursor')
+        width = request.args.get('width', type=int)
+        webp = request.args.get('format') == 'webp'
+        where, params = "", ()
+        if cursor:
+            try:
+                condition, params = keyset_condition(cursor)
+            except ValueError:
+                return {"error": "Invalid cursor"}, 400
+            where = f"WHERE {condition}"
+
+        key = f"{limit}:{cursor}:{width}:{webp}"
+        return response_cache.get_or_load(ResponseCache.FEED, key,
+                                          lambda: load_posts_page(where, params, limit, width, webp))
     except Exception as e:
         print(f"Error getting posts: {e}")
         return {"error": f"Failed to get posts: {str(e)}"}, 500
 
+def load_posts_page(where, params, limit, width, webp):
+    # Get posts from database including image URLs
+    query = f"SELECT post_id, username, post_description, image_url, like_count, created_at FROM post {where} ORDER BY created_at DESC, post_id DESC LIMIT %s"
+    posts_data = run_read_multiple(query, params + (limit,))
+    
+    next_cursor = None
+    if posts_data and len(posts_data) == limit:
+        last = posts_data[-1]
+        next_cursor = encode_page_cursor(last[5], last[0])
+
+    if posts_data:
+        authors = profile_loader()
+        authors.want_many(post_row[1] for post_row in posts_data)
+        posts = []
+        for post_row in posts_data:
+            author = authors.load(post_row[1])
+            posts.append({
+                "post_id": post_row[0],
+                "username": post_row[1],
+                "author": {
+                    "name": author["name"],
+                    "profile_picture_url": author["profile_picture_url"]
+                } if author else None,
+                "caption": post_row[2] or "",
+                "image_url": local_variant_url(post_row[3], width, webp) or "",
+                "original_url": post_row[3] or "",
+                "like_count": post_row[4] or 0,
+                "created_at": str(post_row[5]) if post_row[5] else ""
+            })
+        
+        print(f"📊 Returning {len(posts)} posts from database")
+        return {
+            "success": True,
+            "posts": posts,
+            "next_cursor": next_cursor
+        }
+    else:
+        print("📊 No posts found in database")
+        return {
+            "success": True,
+            "posts": [],
+            "next_cursor": None
+        }
+
 @app.route('/api/posts/<int:post_id>', methods=['DELETE'])
 def delete_post(post_id):
     try:
-        data = request.json
-        username = data.get('username')
+        data = request.get_json(silent=True) or {}
+        username = acting_user(data.get('username'))
         
         if not username:
             return {"error": "Username required"}, 400
         
         # First, verify the post belongs to the user
-        verify_query = "SELECT username FROM post WHERE post_id = %s"
+        verify_query = "SELECT username, image_url FROM post WHERE post_id = %s"
         result = run_read_single(verify_query, (post_id,))
         
         if not result:
@@ -220,6 +538,8 @@ def delete_post(post_id):
         # Delete the post
         delete_query = "DELETE FROM post WHERE post_id = %s"
         run_cud_query(delete_query, (post_id,))
+        release_local_image(result[1])
+        response_cache.invalidate(ResponseCache.FEED)
         
         print(f"✅ Post deleted:")
         print(f"   Post ID: {post_id}")
@@ -231,14 +551,79 @@ def delete_post(post_id):
             "post_id": post_id
         }
         
+    except AuthError:
+        raise
     except Exception as e:
         print(f"Error deleting post: {e}")
         return {"error": f"Failed to delete post: {str(e)}"}, 500
 
+# ----------------------
+# stats
+# ----------------------
+# internal numbers (query fingerprints give the schema away), so they're only
+# served with "Authorization: Bearer <METRICS_TOKEN>". without METRICS_TOKEN set
+# the endpoints don't exist
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+def metrics_endpoint(view):
+    @functools.wraps(view)
+    def checked(*args, **kwargs):
+        if not METRICS_TOKEN:
+            return {"error": "Not found"}, 404
+        if not hmac.compare_digest((bearer_token() or '').encode('utf-8'), METRICS_TOKEN.encode('utf-8')):
+            raise AuthError("Metrics token required")
+        return view(*args, **kwargs)
+    return checked
+
+# hit/miss counters of the response cache
+@app.route('/api/stats/cache')
+@metrics_endpoint
+def cache_stats():
+    return response_cache.stats()
+
+# queue depth, rejections and timings of the password hasher
+@app.route('/api/stats/passwords')
+@metrics_endpoint
+def password_stats():
+    return hasher.stats()
+
+# per-statement latency, rows and errors (?top=20&sort=total_ms) plus the connection pool
+@app.route('/api/stats/queries')
+@metrics_endpoint
+def query_stats():
+    sort = request.args.get('sort', 'total_ms')
+    if sort not in ('total_ms', 'p95_ms', 'max_ms', 'calls', 'rows', 'errors'):
+        return jsonify({"error": "sort must be total_ms, p95_ms, max_ms, calls, rows or errors"}), 400
+    return {"statements": get_query_stats(request.args.get('top', 20, type=int), sort), "pool": get_pool_stats()}
+
+# content addressed upload (ab/cd/<hash>.jpg) or one of its variants (ab/cd/<hash>_w320.webp);
+# group 1 never changes for the same bytes, so it's the ETag
+CONTENT_ADDRESSED_UPLOAD = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64}(?:_w\d+)?)\.[A-Za-z0-9]+$")
+UPLOAD_CACHE_SECONDS = 365 * 24 * 60 * 60   # content addressed files never change
+LEGACY_UPLOAD_CACHE_SECONDS = 60 * 60       # old flat uploads can be overwritten
+# what uploads are stored as, plus ".jpeg" from before the extension was detected
+SERVED_UPLOAD_EXTENSIONS = set(UPLOAD_IMAGE_FORMATS.values()) | {".jpeg"}
+
 # Route to serve uploaded images
-@app.route('/uploads/<filename>')
+# content addressed files live in sub folders (ab/cd/<hash>.jpg), old uploads are flat.
+# send_file answers If-None-Match with 304 and Range with 206 (video seeking), and
+# streams the file through the server's wsgi.file_wrapper (sendfile) or X-Sendfile
+# only image files are served, always with nosniff so a browser never renders one as a page
+@app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory('uploads', filename)
+    if any(part.startswith('.') for part in filename.split('/')):
+        return {"error": "Not found"}, 404
+    if os.path.splitext(filename)[1].lower() not in SERVED_UPLOAD_EXTENSIONS:
+        return {"error": "Not found"}, 404
+    match = CONTENT_ADDRESSED_UPLOAD.match(filename)
+    if not match:
+        response = send_from_directory(blob_store.root, filename, max_age=LEGACY_UPLOAD_CACHE_SECONDS)
+    else:
+        response = send_from_directory(blob_store.root, filename, etag=match.group(1), max_age=UPLOAD_CACHE_SECONDS)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
 
 if __name__ == '__main__':
     print("Starting Arthouse API...")
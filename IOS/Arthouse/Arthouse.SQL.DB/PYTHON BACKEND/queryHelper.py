@@ -3,7 +3,10 @@
 #################################################
 
 from flask import Flask, request, jsonify
-import os, mysql.connector
+import os, time, json, base64, threading, mysql.connector
+from datetime import datetime
+from collections import deque
+from contextlib import contextmanager
 from dotenv import load_dotenv, dotenv_values
 
 
@@ -11,8 +14,18 @@ from dotenv import load_dotenv, dotenv_values
 load_dotenv("db.env")      #old test sql database
 #load_dotenv("googleCloudSQLDB.env")
 
+# after load_dotenv, it reads SLOW_QUERY_* from there
+from QueryStats import stats as query_stats
 
-def get_connection():
+# pool settings, can be overridden in db.env
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))                   # connections kept open
+POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", 10))  # extra connections allowed under load
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))          # seconds to wait for a free connection
+POOL_RECYCLE = float(os.getenv("DB_POOL_RECYCLE", 1800))        # seconds idle before a connection is thrown out
+POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"       # ping connections when they are checked out
+
+
+def _open_connection():
     return mysql.connector.connect(
         host=os.getenv("DB_HOST"),
         user=os.getenv("DB_USER"),
@@ -24,39 +37,546 @@ def get_connection():
 #        ssl_key=os.getenv("ssl_key")
 )
 
-#runs queries for creation, updating, and deleting operations.
 
-def run_cud_query(query, attributesTuple):
+class PoolExhaustedError(Exception):
+    pass
+
+
+# Wraps a real connection so that close() hands it back to the pool instead of
+# tearing down the socket. Everything else is passed through to the connection.
+class PooledConnection:
+    def __init__(self, pool, raw_conn):
+        self._pool = pool
+        self._raw_conn = raw_conn
+
+    def close(self):
+        if self._raw_conn is not None:
+            self._pool.release(self._raw_conn)
+            self._raw_conn = None
+
+    # closes the real connection instead of reusing it (e.g. it still has
+    # unread rows on the wire)
+    def invalidate(self):
+        if self._raw_conn is not None:
+            self._pool.discard(self._raw_conn)
+            self._raw_conn = None
+
+    def __getattr__(self, name):
+        if self._raw_conn is None:
+            raise Exception("Connection was already returned to the pool.")
+        return getattr(self._raw_conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class ConnectionPool:
+    def __init__(self, connect, size=POOL_SIZE, max_overflow=POOL_MAX_OVERFLOW,
+                 timeout=POOL_TIMEOUT, recycle=POOL_RECYCLE, pre_ping=POOL_PRE_PING):
+        self._connect = connect
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.pre_ping = pre_ping
+        self._idle = deque()            # (connection, time it was returned)
+        self._total = 0                 # open connections, idle + checked out
+        self._checked_out = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            "checkouts": 0,
+            "connects": 0,
+            "recycled": 0,
+            "failed_pings": 0,
+            "exhausted": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+            "peak_checked_out": 0,
+        }
+
+    def get(self):
+        start = time.monotonic()
+        waited = False
+        conn = None
+        with self._cond:
+            while True:
+                conn = self._pop_idle()
+                if conn is not None:
+                    break
+                if self._total < self.size + self.max_overflow:
+                    self._total += 1            # reserve the slot, connect outside the lock
+                    break
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self._stats["exhausted"] += 1
+                    raise PoolExhaustedError(
+                        f"No database connection free after {self.timeout}s "
+                        f"({self._total} open, {self._checked_out} in use).")
+                waited = True
+                self._cond.wait(remaining)
+
+        if conn is not None and self.pre_ping and not self._ping(conn):
+            self._close_quietly(conn)
+            conn = None
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._total -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._stats["connects"] += 1
+
+        wait = time.monotonic() - start
+        with self._cond:
+            self._checked_out += 1
+            self._stats["checkouts"] += 1
+            self._stats["peak_checked_out"] = max(self._stats["peak_checked_out"], self._checked_out)
+            if waited:
+                self._stats["waits"] += 1
+            self._stats["wait_seconds"] += wait
+            self._stats["max_wait_seconds"] = max(self._stats["max_wait_seconds"], wait)
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        # never hand a connection with an open transaction to the next caller
+        healthy = True
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except Exception:
+            healthy = False
+
+        with self._cond:
+            self._checked_out -= 1
+            if healthy and len(self._idle) < self.size:
+                self._idle.append((conn, time.monotonic()))
+                conn = None
+            else:
+                self._total -= 1            # overflow connection or broken, let it go
+            self._cond.notify()
+        if conn is not None:
+            self._close_quietly(conn)
+
+    def discard(self, conn):
+        with self._cond:
+            self._checked_out -= 1
+            self._total -= 1
+            self._cond.notify()
+        self._close_quietly(conn)
+
+    # newest idle connection first so rarely used ones age out and get recycled.
+    # must be called with the lock held
+    def _pop_idle(self):
+        now = time.monotonic()
+        while self._idle:
+            conn, returned_at = self._idle.pop()
+            if now - returned_at > self.recycle:
+                self._total -= 1
+                self._stats["recycled"] += 1
+                self._close_quietly(conn)
+                continue
+            return conn
+        return None
+
+    def _ping(self, conn):
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception:
+            with self._cond:
+                self._stats["failed_pings"] += 1
+            return False
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["size"] = self.size
+            stats["max_overflow"] = self.max_overflow
+            stats["open"] = self._total
+            stats["idle"] = len(self._idle)
+            stats["checked_out"] = self._checked_out
+            stats["overflow_in_use"] = max(self._total - self.size, 0)
+            return stats
+
+    def dispose(self):
+        with self._cond:
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._total -= len(idle)
+        for conn in idle:
+            self._close_quietly(conn)
+
+
+_pool = ConnectionPool(_open_connection)
+
+
+# hands out a pooled connection, call close() on it to give it back
+def get_connection():
+    return _pool.get()
+
+def get_pool_stats():
+    return _pool.stats()
+
+def close_pool():
+    _pool.dispose()
+
+################################################################################################
+# TRANSACTIONS
+################################################################################################
+
+# the connection of the transaction running on this thread (if any).
+# while a transaction is open every run_* helper on the same thread uses its
+# connection and skips its own commit, so the CRUD functions can be grouped
+# without changing their signatures:
+#
+#   with transaction():
+#       create_user(...)
+#       create_profile(...)
+_local = threading.local()
+
+def _active_connection():
+    return getattr(_local, "conn", None)
+
+# runs everything inside the block on one connection with one commit.
+# any exception rolls the whole thing back and is re-raised.
+# nesting transaction() turns the inner one into a savepoint
+@contextmanager
+def transaction():
+    if _active_connection() is not None:
+        with savepoint():
+            yield _active_connection()
+        return
+
     conn = get_connection()
+    callbacks = []
+    try:
+        conn.start_transaction()
+        _local.conn = conn
+        _local.savepoint_count = 0
+        _local.after_commit = callbacks
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    finally:
+        _local.conn = None
+        _local.after_commit = None
+        conn.close()
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            print(f"after_commit callback failed : {e}")
+
+# runs callback once the data it depends on is committed: straight away outside
+# a transaction, otherwise after the outermost transaction() commits. dropped if
+# the transaction (or the savepoint it was registered in) rolls back.
+# for side effects that can't be undone, e.g. deleting bucket objects
+def after_commit(callback):
+    if _active_connection() is None:
+        callback()
+    else:
+        _local.after_commit.append(callback)
+
+# partial rollback inside a transaction: if the block raises, only the work
+# done inside the block is undone and the exception is re-raised
+@contextmanager
+def savepoint():
+    conn = _active_connection()
+    if conn is None:
+        raise Exception("savepoint() can only be used inside transaction().")
+    _local.savepoint_count += 1
+    name = f"sp_{_local.savepoint_count}"
+    registered = len(_local.after_commit)
     cursor = conn.cursor()
-    cursor.execute(query, attributesTuple)
-    conn.commit()
-    last_id = cursor.lastrowid
-    cursor.close()
-    conn.close()
+    try:
+        cursor.execute(f"SAVEPOINT {name}")
+        try:
+            yield name
+        except BaseException:
+            cursor.execute(f"ROLLBACK TO SAVEPOINT {name}")
+            del _local.after_commit[registered:]
+            raise
+        cursor.execute(f"RELEASE SAVEPOINT {name}")
+    finally:
+        cursor.close()
+
+# yields (connection, owns_it). owns_it is False inside a transaction, meaning
+# the caller must not commit, roll back or close
+@contextmanager
+def _query_connection():
+    conn = _active_connection()
+    if conn is not None:
+        yield conn, False
+        return
+    conn = get_connection()
+    try:
+        yield conn, True
+    finally:
+        conn.close()
+
+
+################################################################################################
+# INSTRUMENTATION
+################################################################################################
+
+# what _measured_query hands the caller; set rows before leaving the block
+class _Measurement:
+    __slots__ = ("rows",)
+
+    def __init__(self):
+        self.rows = 0
+
+# _query_connection plus metrics: the time spent getting the connection, the time
+# the statement took (including its commit), rows and errors go to QueryStats
+# under query's fingerprint. yields (connection, owns_it, measurement)
+@contextmanager
+def _measured_query(query, attributesTuple=None):
+    started = time.perf_counter()
+    measurement = _Measurement()
+    acquired = None
+    error = True
+    try:
+        with _query_connection() as (conn, owned):
+            acquired = time.perf_counter()
+            yield conn, owned, measurement
+            error = False
+    finally:
+        finished = time.perf_counter()
+        if acquired is None:
+            acquired = finished     # never got a connection
+        query_stats.record(query, finished - acquired, measurement.rows, acquired - started, error, attributesTuple)
+
+# EXPLAIN for the slow query log (SLOW_QUERY_EXPLAIN=1), on a connection of its own
+def _explain(query, attributesTuple):
+    conn = get_connection()
+    try:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("EXPLAIN " + query, attributesTuple)
+        plan = cursor.fetchall()
+        cursor.close()
+        return plan
+    finally:
+        conn.close()
+
+query_stats.set_explainer(_explain)
+
+# the slowest statements so far, see QueryStats.report
+def get_query_stats(top=20, sort="total_ms"):
+    return query_stats.report(top, sort)
+
+
+################################################################################################
+# QUERIES
+################################################################################################
+
+#runs queries for creation, updating, and deleting operations.
+# connections always go back to the pool, even if the query blows up
+
+def run_cud_query(query, attributesTuple):
+    with _measured_query(query, attributesTuple) as (conn, owned, measurement):
+        cursor = conn.cursor()
+        cursor.execute(query, attributesTuple)
+        if owned:
+            conn.commit()
+        last_id = cursor.lastrowid
+        measurement.rows = cursor.rowcount
+        cursor.close()
     return last_id
 
 # runs queries to read singular items
 def run_read_single(query, attributesTuple=None):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute(query, attributesTuple)
-    result = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    with _measured_query(query, attributesTuple) as (conn, owned, measurement):
+        cursor = conn.cursor()
+        cursor.execute(query, attributesTuple)
+        result = cursor.fetchone()
+        measurement.rows = 0 if result is None else 1
+        cursor.close()
     return result
 
 # runs queries to read multiple items
 def run_read_multiple(query, attributesTuple=None):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute(query, attributesTuple)
-    result = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    with _measured_query(query, attributesTuple) as (conn, owned, measurement):
+        cursor = conn.cursor()
+        cursor.execute(query, attributesTuple)
+        result = cursor.fetchall()
+        measurement.rows = len(result)
+        cursor.close()
     return result
 
 
+# rows pulled from the server per round trip by run_read_stream
+STREAM_BATCH_SIZE = int(os.getenv("DB_STREAM_BATCH_SIZE", 1000))
+
+# reads a big result set a batch at a time with an unbuffered (server side)
+# cursor, yielding one row at a time, so memory stays flat no matter how many
+# rows there are. always uses its own connection, even inside transaction(),
+# because nothing else can run on a connection until its stream is read out.
+# if the caller stops early the connection is dropped rather than drained.
+# its QueryStats latency is the time until the last row was read (or the caller stopped).
+def run_read_stream(query, attributesTuple=None, batch_size=STREAM_BATCH_SIZE):
+    started = time.perf_counter()
+    conn = get_connection()
+    acquired = time.perf_counter()
+    finished = False
+    count = 0
+    try:
+        cursor = conn.cursor(buffered=False)
+        cursor.execute(query, attributesTuple)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            count += len(rows)
+            for row in rows:
+                yield row
+        cursor.close()
+        finished = True
+    finally:
+        if finished:
+            conn.close()
+        else:
+            conn.invalidate()
+        # a caller that stops early isn't an error
+        query_stats.record(query, time.perf_counter() - acquired, count, acquired - started, params=attributesTuple)
+
+
+# rows per statement for the bulk helpers; keeps packets under max_allowed_packet
+BULK_CHUNK_SIZE = int(os.getenv("DB_BULK_CHUNK_SIZE", 500))
+
+# runs one cud query for many attribute tuples (executemany) on a single
+# connection with a single commit. returns the total number of affected rows
+def run_cud_many(query, listOfAttributeTuples, chunk_size=BULK_CHUNK_SIZE):
+    rows = list(listOfAttributeTuples)
+    if not rows:
+        return 0
+    with _measured_query(query) as (conn, owned, measurement):
+        cursor = conn.cursor()
+        affected = 0
+        try:
+            for i in range(0, len(rows), chunk_size):
+                cursor.executemany(query, rows[i:i + chunk_size])
+                affected += cursor.rowcount
+            if owned:
+                conn.commit()
+        except Exception:
+            if owned:
+                conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        measurement.rows = affected
+    return affected
+
+# (innodb_autoinc_lock_mode, auto_increment_increment) of the server, read once
+_autoinc_settings = None
+
+# distance between the ids of one multi-row INSERT, or None when the server
+# doesn't promise they are evenly spaced. InnoDB only guarantees that for
+# innodb_autoinc_lock_mode 0 (traditional) and 1 (consecutive); the MySQL 8
+# default is 2 (interleaved), where rows of concurrent inserts can be mixed
+def _autoinc_step(cursor):
+    global _autoinc_settings
+    if _autoinc_settings is None:
+        cursor.execute("SELECT @@innodb_autoinc_lock_mode, @@auto_increment_increment")
+        lock_mode, increment = cursor.fetchone()
+        _autoinc_settings = (int(lock_mode), int(increment))
+    lock_mode, increment = _autoinc_settings
+    return increment if lock_mode in (0, 1) else None
+
+# inserts many rows with multi-row INSERT statements, chunked, in one commit.
+# returns the generated ids in the same order as rows (return_ids=False skips
+# that and returns []). a chunk's ids are lastrowid, lastrowid + step, ... which
+# only holds with innodb_autoinc_lock_mode 0 or 1 (see _autoinc_step); under
+# mode 2 the rows that need ids go in one INSERT each, still in one commit.
+# if any chunk gives no id back (no auto-increment column) the result is [],
+# never a list that doesn't line up with rows.
+# with ignore=True skipped rows make the ids meaningless, so none are returned.
+def run_bulk_insert(table, columns, rows, chunk_size=BULK_CHUNK_SIZE, ignore=False, return_ids=True):
+    rows = [tuple(row) for row in rows]
+    if not rows:
+        return []
+    row_placeholder = "(" + ", ".join(["%s"] * len(columns)) + ")"
+    insert = "INSERT IGNORE INTO" if ignore else "INSERT INTO"
+    return_ids = return_ids and not ignore
+    ids = []
+    all_ids = True
+    # measured as one statement, whatever the number of chunks
+    with _measured_query(f"{insert} {table} ({', '.join(columns)}) VALUES {row_placeholder}") as (conn, owned, measurement):
+        cursor = conn.cursor()
+        try:
+            step = _autoinc_step(cursor) if return_ids else 1
+            if step is None:
+                chunk_size = 1          # a single row's lastrowid is always right
+            for i in range(0, len(rows), chunk_size):
+                chunk = rows[i:i + chunk_size]
+                query = f"{insert} {table} ({', '.join(columns)}) VALUES " + ", ".join([row_placeholder] * len(chunk))
+                cursor.execute(query, tuple(value for row in chunk for value in row))
+                measurement.rows += cursor.rowcount
+                if not return_ids:
+                    continue
+                first_id = cursor.lastrowid
+                if first_id:
+                    ids.extend(range(first_id, first_id + len(chunk) * (step or 1), step or 1))
+                else:
+                    all_ids = False
+            if owned:
+                conn.commit()
+        except Exception:
+            if owned:
+                conn.rollback()
+            raise
+        finally:
+            cursor.close()
+    return ids if return_ids and all_ids else []
+
+
+################################################################################################
+# KEYSET PAGINATION
+################################################################################################
+
+# Feeds page on (created_at, post_id) instead of LIMIT/OFFSET: the next page is
+# "everything older than the last row I saw", which is one index range read no
+# matter how deep the client has scrolled, and new posts can't shift the pages.
+# The client gets an opaque token and sends it back for the next page.
+
+def encode_page_cursor(created_at, post_id):
+    if isinstance(created_at, datetime):
+        created_at = created_at.isoformat()
+    raw = json.dumps([str(created_at), int(post_id)]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+# returns (created_at, post_id). raises ValueError for tokens we didn't make
+def decode_page_cursor(token):
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        created_at, post_id = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        return datetime.fromisoformat(created_at), int(post_id)
+    except Exception:
+        raise ValueError(f"Invalid page cursor: {token!r}")
+
+# WHERE fragment + params for "rows after the cursor" in newest first order.
+# written out long hand because MySQL won't use the index for (a, b) < (x, y)
+def keyset_condition(token, created_col="created_at", id_col="post_id"):
+    created_at, post_id = decode_page_cursor(token)
+    condition = f"({created_col} < %s OR ({created_col} = %s AND {id_col} < %s))"
+    return condition, (created_at, created_at, post_id)
+
 
 #TEST CONNECTION
 from mysql.connector import Error
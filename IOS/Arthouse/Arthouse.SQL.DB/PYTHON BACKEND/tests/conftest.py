@@ -0,0 +1,14 @@
+# the backend modules import each other by name (from queryHelper import ...)
+# and read db.env from the working directory, so the tests run from PYTHON
+# BACKEND wherever pytest was started. nothing here talks to MySQL or Google
+# Cloud: the database reads are swapped out per test with monkeypatch
+
+import os
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.chdir(BACKEND_DIR)
+
+# api_server won't start with a random session secret outside debug mode
+os.environ.setdefault("SESSION_SECRET", "test-session-secret")
@@ -0,0 +1,56 @@
+import hashlib
+import os
+
+import pytest
+
+from BlobStore import BlobStore, BlobTooLarge
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BlobStore(str(tmp_path / "uploads"), str(tmp_path / "refs.sqlite3"))
+
+
+def test_same_bytes_are_stored_once(store):
+    first = store.put(b"photo", "JPG")
+    second = store.put(b"photo", "jpg")
+    digest = hashlib.sha256(b"photo").hexdigest()
+    assert first == second == f"{digest[:2]}/{digest[2:4]}/{digest}.jpg"
+    with open(store.full_path(first), "rb") as f:
+        assert f.read() == b"photo"
+    assert os.listdir(store.temp_dir) == []
+
+
+def test_file_goes_with_its_last_reference(store):
+    path = store.put(b"photo", "jpg")
+    store.put(b"photo", "jpg")
+    assert store.release(path) is False
+    assert os.path.exists(store.full_path(path))
+    assert store.release(path) is True
+    assert not os.path.exists(store.full_path(path))
+    assert store.release(path) is False         # unknown paths are ignored
+
+
+def test_release_removes_variants(store):
+    path = store.put(b"photo", "jpg")
+    variant = store.full_path(store.variant_path(path, "w320.webp"))
+    with open(variant, "wb") as f:
+        f.write(b"small")
+    store.release(path)
+    assert not os.path.exists(variant)
+
+
+def test_writer_hashes_while_streaming(store):
+    writer = store.open_writer()
+    writer.write(b"pho")
+    writer.write(b"to")
+    assert store.put_writer(writer, "png") == store.relative_path(hashlib.sha256(b"photo").hexdigest(), "png")
+
+
+def test_writer_rejects_oversized_uploads(store):
+    writer = store.open_writer(max_bytes=4)
+    writer.write(b"1234")
+    with pytest.raises(BlobTooLarge):
+        writer.write(b"5")
+    writer.discard()
+    assert os.listdir(store.temp_dir) == []
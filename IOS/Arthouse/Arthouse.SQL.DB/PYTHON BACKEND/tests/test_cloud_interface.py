@@ -0,0 +1,17 @@
+import threading
+
+import ArthouseGoogleCloudInterface as agci
+
+
+def test_client_is_made_once_on_first_use(monkeypatch):
+    made = []
+    monkeypatch.setattr(agci, "_client", None)
+    monkeypatch.setattr(agci.storage.Client, "from_service_account_json",
+                        lambda path: made.append(path) or object())
+    threads = [threading.Thread(target=agci.get_storage_client) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert made == [agci.SERVICE_ACCOUNT_FILE]
+    assert agci.get_storage_client() is agci.get_storage_client()
@@ -0,0 +1,81 @@
+import pytest
+
+import HashtagIndex
+from HashtagIndex import HashtagIndex as Index
+
+
+@pytest.fixture
+def table(monkeypatch):
+    rows = []       # the hashtag table, (hashtag, post_id)
+    monkeypatch.setattr(HashtagIndex, "run_read_stream", lambda query: iter(sorted(rows, key=lambda row: row[1])))
+    return rows
+
+
+def test_any_all_and_exclude(table):
+    table += [("art", 1), ("art", 2), ("film", 2), ("film", 3), ("art", 4), ("nsfw", 4)]
+    index = Index()
+    assert index.search(["art", "film"]) == ([4, 3, 2, 1], None)
+    assert index.search(["art", "film"], match="all") == ([2], None)
+    assert index.search(["art"], exclude=["nsfw"]) == ([2, 1], None)
+    assert index.search(["nothing"]) == ([], None)
+
+
+def test_cursor_walks_every_page(table):
+    table += [("art", post_id) for post_id in range(1, 8)]
+    index = Index()
+    pages, cursor = [], None
+    while True:
+        page, cursor = index.search(["art"], limit=3, cursor=cursor)
+        pages.append(page)
+        if cursor is None:
+            break
+    assert pages == [[7, 6, 5], [4, 3, 2], [1]]
+
+
+def test_writes_update_the_index(table):
+    table += [("art", 1)]
+    index = Index()
+    index.search(["art"])
+    index.set_post_hashtags(5, ["art", "film"])
+    index.set_post_hashtags(3, ["art"])         # older than the newest, goes in the middle
+    assert index.search(["art"]) == ([5, 3, 1], None)
+    index.set_post_hashtags(5, ["film"])
+    index.remove_post(3)
+    assert index.search(["art"]) == ([1], None)
+    assert index.search(["film"]) == ([5], None)
+
+
+def test_search_results_dont_pin_the_posting_lists(table):
+    # _ids hands out views of the arrays; appending would raise BufferError if one leaked
+    table += [("art", 1), ("art", 2)]
+    index = Index()
+    result = index.search(["art"], match="all")
+    index.set_post_hashtags(3, ["art"])
+    index.remove_post(1)
+    assert result == ([2, 1], None)
+    assert index.search(["art"]) == ([3, 2], None)
+
+
+def test_rebuild_picks_up_other_processes_writes(table):
+    table += [("art", 1)]
+    index = Index(rebuild_seconds=60)
+    assert index.search(["art"]) == ([1], None)
+    table.append(("art", 2))                    # written by another process
+    assert index.search(["art"]) == ([1], None)
+    index._built_at -= 61
+    assert index.search(["art"]) == ([2, 1], None)
+
+
+def test_writes_during_a_build_survive_it(monkeypatch):
+    index = Index()
+
+    def stream(query):
+        yield ("art", 1)
+        # lands after the build has read past it
+        index.set_post_hashtags(9, ["art"])
+        index.remove_post(1)
+        yield ("art", 2)
+
+    monkeypatch.setattr(HashtagIndex, "run_read_stream", stream)
+    index.build()
+    assert index.search(["art"]) == ([9, 2], None)
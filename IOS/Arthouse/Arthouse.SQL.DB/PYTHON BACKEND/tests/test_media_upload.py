@@ -0,0 +1,151 @@
+import contextlib
+import importlib
+import os
+import sys
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from ContentCache import ContentCache
+
+
+# stands in for the bucket: ArthouseGoogleCloudInterface needs service account
+# credentials just to be imported
+class FakeBucket:
+    def __init__(self):
+        self.objects = {}           # "folder/file" -> bytes
+        self.failing = set()        # file paths whose upload fails
+
+    def upload_via_signed_url(self, bucket_name, file_paths, destination_blob_folder, progress=None, file_names=None):
+        for file_path, file_name in zip(file_paths, file_names or [os.path.basename(path) for path in file_paths]):
+            if file_path in self.failing:
+                return False
+            with open(file_path, "rb") as f:
+                self.objects[f"{destination_blob_folder}/{file_name}"] = f.read()
+        return True
+
+    def delete_via_signed_url(self, bucket_name, file_paths, destination_blob_folder):
+        for file_path in file_paths:
+            self.objects.pop(f"{destination_blob_folder}/{os.path.basename(file_path)}", None)
+        return True
+
+
+@pytest.fixture
+def bucket():
+    return FakeBucket()
+
+
+@pytest.fixture
+def media(monkeypatch, tmp_path, bucket):
+    fake = types.ModuleType("ArthouseGoogleCloudInterface")
+    fake.upload_via_signed_url = bucket.upload_via_signed_url
+    fake.delete_via_signed_url = bucket.delete_via_signed_url
+    monkeypatch.setitem(sys.modules, "ArthouseGoogleCloudInterface", fake)
+    monkeypatch.delitem(sys.modules, "ArthouseDBSQLComands_MEDIA", raising=False)
+    module = importlib.import_module("ArthouseDBSQLComands_MEDIA")
+
+    monkeypatch.setattr(module, "content_cache", ContentCache(str(tmp_path / "content_cache")))
+    monkeypatch.setattr(module.MediaManager, "get_probe_pool", lambda: ThreadPoolExecutor(max_workers=2))
+    monkeypatch.setattr(module.MediaManager, "get_metadata", lambda file_path, media_type: (12, 128))
+    monkeypatch.setattr(module, "transaction", contextlib.nullcontext)
+    module.inserted = {}            # table -> rows given to run_bulk_insert
+
+    def run_bulk_insert(table, columns, rows, return_ids=True):
+        rows = list(rows)
+        table_rows = module.inserted.setdefault(table, [])
+        first_id = len(table_rows) + 1
+        table_rows.extend(rows)
+        return list(range(first_id, first_id + len(rows)))
+
+    monkeypatch.setattr(module, "run_bulk_insert", run_bulk_insert)
+    monkeypatch.setattr(module, "run_cud_query", lambda query, params: pytest.fail("no row should be written"))
+    return module
+
+
+def write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_failed_upload_returns_none(media, bucket, tmp_path):
+    song = write(tmp_path / "song.mp3", b"la la la")
+    bucket.failing.add(song)
+    assert media._upload_once(song, "audio", "digest") is None
+    assert bucket.objects == {}
+
+
+def test_create_media_writes_nothing_when_the_upload_fails(media, bucket, tmp_path):
+    song = write(tmp_path / "song.mp3", b"la la la")
+    bucket.failing.add(song)
+    assert media.create_media(1, song, "audio") is False
+
+
+def test_create_medias_leaves_out_failed_uploads(media, bucket, tmp_path):
+    good = write(tmp_path / "good.mp3", b"good")
+    bad = write(tmp_path / "bad.mp3", b"bad")
+    bucket.failing.add(bad)
+    assert media.create_medias(7, {good: "audio", bad: "audio"}) is True
+    assert len(media.inserted["media"]) == 1
+    assert len(media.inserted["audio"]) == 1
+    file_name = media.inserted["media"][0][1]
+    assert bucket.objects[f"audio/{file_name}"] == b"good"
+
+
+def test_create_medias_fails_when_nothing_uploaded(media, bucket, tmp_path):
+    bad = write(tmp_path / "bad.mp3", b"bad")
+    bucket.failing.add(bad)
+    assert media.create_medias(7, {bad: "audio"}) is False
+    assert "media" not in media.inserted
+
+
+def test_same_name_different_bytes_get_different_objects(media, bucket, tmp_path):
+    first = write(tmp_path / "a" / "IMG_0001.JPG", b"first photo")
+    second = write(tmp_path / "b" / "IMG_0001.JPG", b"second photo")
+    first_name = media._upload_once(first, "photo", media.file_digest(first))
+    second_name = media._upload_once(second, "photo", media.file_digest(second))
+    assert first_name == media.file_digest(first) + ".jpg"
+    assert first_name != second_name
+    # reposting the first file skips the upload and still points at its own bytes
+    assert media._upload_once(first, "photo", media.file_digest(first)) == first_name
+    assert bucket.objects[f"photo/{first_name}"] == b"first photo"
+    assert bucket.objects[f"photo/{second_name}"] == b"second photo"
+
+
+def test_same_bytes_are_uploaded_once(media, bucket, tmp_path):
+    first = write(tmp_path / "a" / "one.mp3", b"same song")
+    second = write(tmp_path / "b" / "two.mp3", b"same song")
+    uploads = []
+    upload = bucket.upload_via_signed_url
+    media.agci.upload_via_signed_url = lambda *args, **kwargs: uploads.append(args[1]) or upload(*args, **kwargs)
+    names = {media._upload_once(path, "audio", media.file_digest(path)) for path in (first, second)}
+    assert len(names) == 1
+    assert uploads == [[first]]
+
+
+def test_delete_media_removes_objects_only_after_commit(media, bucket, monkeypatch):
+    bucket.objects["photo/abc.jpg"] = b"photo"
+    bucket.objects["photo/abc_w320.webp"] = b"small"
+    deleted = []
+    pending = []
+    monkeypatch.setattr(media, "get_media_by_id", lambda media_id: (media_id, "abc.jpg", "jpg", "photo"))
+    monkeypatch.setattr(media, "_unused_variant_objects", lambda media_id: [("abc_w320.webp", "photo")])
+    monkeypatch.setattr(media, "run_read_single", lambda query, params: (0,))
+    monkeypatch.setattr(media, "run_cud_query", lambda query, params: deleted.append(params))
+    monkeypatch.setattr(media, "after_commit", pending.append)
+    assert media.delete_media(5) is True
+    assert deleted == [(5,)]
+    assert "photo/abc.jpg" in bucket.objects        # the rows aren't committed yet
+    pending[0]()
+    assert bucket.objects == {}
+
+
+def test_shared_objects_are_kept(media, bucket, monkeypatch):
+    bucket.objects["audio/abc.mp3"] = b"song"
+    monkeypatch.setattr(media, "get_media_by_id", lambda media_id: (media_id, "abc.mp3", "mp3", "audio"))
+    monkeypatch.setattr(media, "run_read_single", lambda query, params: (1,))
+    monkeypatch.setattr(media, "run_cud_query", lambda query, params: None)
+    monkeypatch.setattr(media, "after_commit", lambda callback: callback())
+    assert media.delete_media(5) is True
+    assert bucket.objects == {"audio/abc.mp3": b"song"}
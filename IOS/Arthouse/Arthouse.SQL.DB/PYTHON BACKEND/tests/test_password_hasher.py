@@ -0,0 +1,90 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import PasswordHasher
+from PasswordHasher import HasherBusy, PasswordHasher as Hasher, hash_rounds
+
+
+def test_hash_and_check():
+    hasher = Hasher(processes=1, rounds=4)
+    stored = hasher.hash_password("hunter2")
+    assert hash_rounds(stored) == 4
+    assert hasher.check_password("hunter2", stored) == (True, None)
+    assert hasher.check_password("hunter3", stored) == (False, None)
+
+
+def test_weak_hashes_are_upgraded_on_login():
+    stored = Hasher(processes=1, rounds=4).hash_password("hunter2")
+    matches, new_hash = Hasher(processes=1, rounds=5).check_password("hunter2", stored)
+    assert matches and hash_rounds(new_hash) == 5
+
+
+# a hasher whose checks hang until release is set, on threads instead of processes
+@pytest.fixture
+def stuck(monkeypatch):
+    release = threading.Event()
+
+    def check(password, stored_hash):
+        release.wait(5)
+        return True
+
+    monkeypatch.setattr(PasswordHasher, "_check", check)
+    hasher = Hasher(processes=1, queue_limit=2, rounds=4)
+    hasher._pool = ThreadPoolExecutor(max_workers=1)
+    yield hasher, release
+    release.set()
+    hasher._pool.shutdown(wait=True)
+
+
+def wait_for(condition):
+    for _ in range(500):
+        if condition():
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError("timed out")
+
+
+def test_sheds_load_past_the_queue_limit(stuck):
+    hasher, release = stuck
+    waiting = [threading.Thread(target=hasher.check_password, args=("pw", "$2b$04$x")) for _ in range(2)]
+    for thread in waiting:
+        thread.start()
+    wait_for(lambda: hasher.stats()["in_flight"] == 2)
+    with pytest.raises(HasherBusy):
+        hasher.check_password("pw", "$2b$04$x")
+    release.set()
+    for thread in waiting:
+        thread.join()
+    assert hasher.stats()["in_flight"] == 0
+    assert hasher.stats()["rejected"] == 1
+
+
+def test_timed_out_jobs_keep_their_slot(stuck, monkeypatch):
+    hasher, release = stuck
+    monkeypatch.setattr(PasswordHasher, "HASH_TIMEOUT_SECONDS", 0.05)
+    with pytest.raises(HasherBusy):
+        hasher.check_password("pw", "$2b$04$x")
+    # still running in the pool, so it still counts
+    assert hasher.stats()["in_flight"] == 1
+    # this one is still queued when it times out, so it's cancelled and gives its slot back
+    with pytest.raises(HasherBusy):
+        hasher.check_password("pw", "$2b$04$x")
+    assert hasher.stats()["in_flight"] == 1
+    hasher.queue_limit = 1
+    with pytest.raises(HasherBusy):
+        hasher.check_password("pw", "$2b$04$x")
+    assert hasher.stats()["rejected"] == 1 and hasher.stats()["timeouts"] == 2
+    release.set()
+    wait_for(lambda: hasher.stats()["in_flight"] == 0)
+
+
+def test_login_timeout_is_busy_not_a_wrong_password(stuck, monkeypatch):
+    import ArthouseDBSQLComands_USER as users
+    hasher, release = stuck
+    monkeypatch.setattr(PasswordHasher, "HASH_TIMEOUT_SECONDS", 0.05)
+    monkeypatch.setattr(users, "hasher", hasher)
+    monkeypatch.setattr(users, "run_read_single", lambda query, params: ("$2b$04$x",))
+    with pytest.raises(HasherBusy):
+        users.verify_user_login("ana", "pw")
@@ -0,0 +1,29 @@
+import importlib
+import sys
+import types
+
+import pytest
+
+
+@pytest.fixture
+def posts(monkeypatch):
+    # ArthouseGoogleCloudInterface needs service account credentials just to be imported
+    monkeypatch.setitem(sys.modules, "ArthouseGoogleCloudInterface", types.ModuleType("ArthouseGoogleCloudInterface"))
+    for name in ("ArthouseDBSQLComands_MEDIA", "ArthouseDBSQLComands_POSTS"):
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    return importlib.import_module("ArthouseDBSQLComands_POSTS")
+
+
+def test_posts_containing_hashtags_is_still_one_list(posts, monkeypatch):
+    pages = {None: ([(5,), (4,)], "a"), "a": ([(2,)], None)}
+    monkeypatch.setattr(posts, "search_by_hashtags", lambda hashtags, cursor=None, limit=20: pages[cursor])
+    assert posts.get_posts_containing_hashtags(["art"]) == [(5,), (4,), (2,)]
+
+
+def test_no_hashtags_no_posts(posts):
+    assert posts.get_posts_containing_hashtags([]) == []
+
+
+def test_posts_containing_hashtags_failure(posts, monkeypatch):
+    monkeypatch.setattr(posts, "search_by_hashtags", lambda hashtags, cursor=None, limit=20: (None, None))
+    assert posts.get_posts_containing_hashtags(["art"]) is None
@@ -0,0 +1,142 @@
+from datetime import datetime
+
+import pytest
+
+import queryHelper
+
+
+# just enough of a mysql.connector connection for the run_* helpers
+class FakeCursor:
+    def __init__(self, conn):
+        self._conn = conn
+        self.rowcount = 0
+        self.lastrowid = None
+
+    def execute(self, query, params=None):
+        if query.startswith("SELECT @@"):
+            self._result = self._conn.autoinc_settings
+            return
+        self._conn.executed.append((query, params))
+        self.rowcount = query.count("(%s")
+        self.lastrowid = self._conn.lastrowids.pop(0) if self._conn.lastrowids else None
+
+    def fetchone(self):
+        return self._result
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, lastrowids=(), autoinc_settings=(1, 1)):
+        self.autoinc_settings = autoinc_settings
+        self.lastrowids = list(lastrowids)
+        self.executed = []
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self, **kwargs):
+        return FakeCursor(self)
+
+    def start_transaction(self):
+        pass
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def connect(monkeypatch):
+    def use(lastrowids, autoinc_settings=(1, 1)):
+        conn = FakeConnection(lastrowids, autoinc_settings)
+        monkeypatch.setattr(queryHelper, "get_connection", lambda: conn)
+        monkeypatch.setattr(queryHelper, "_autoinc_settings", None)
+        return conn
+    return use
+
+
+def test_bulk_insert_ids_follow_the_rows(connect):
+    conn = connect([10, 50])
+    ids = queryHelper.run_bulk_insert("media", ("post_id", "file_name"), [(1, "a"), (1, "b"), (1, "c")], chunk_size=2)
+    assert ids == [10, 11, 50]
+    assert len(conn.executed) == 2 and conn.commits == 1
+
+
+def test_bulk_insert_ids_step_by_auto_increment_increment(connect):
+    connect([10, 50], autoinc_settings=(1, 2))
+    ids = queryHelper.run_bulk_insert("media", ("post_id", "file_name"), [(1, "a"), (1, "b"), (1, "c")], chunk_size=2)
+    assert ids == [10, 12, 50]
+
+
+def test_bulk_insert_goes_row_by_row_under_interleaved_lock_mode(connect):
+    conn = connect([10, 14, 15], autoinc_settings=(2, 1))
+    ids = queryHelper.run_bulk_insert("media", ("post_id", "file_name"), [(1, "a"), (1, "b"), (1, "c")])
+    assert ids == [10, 14, 15]
+    assert len(conn.executed) == 3 and conn.commits == 1
+
+
+def test_bulk_insert_without_ids_stays_multi_row(connect):
+    conn = connect([], autoinc_settings=(2, 1))
+    assert queryHelper.run_bulk_insert("photo", ("media_id", "resolution"), [(1, "a"), (2, "b")], return_ids=False) == []
+    assert len(conn.executed) == 1
+
+
+def test_bulk_insert_never_returns_a_partial_list(connect):
+    connect([10, 0])
+    assert queryHelper.run_bulk_insert("media", ("post_id", "file_name"), [(1, "a"), (1, "b"), (1, "c")], chunk_size=2) == []
+    connect([None, 20])
+    assert queryHelper.run_bulk_insert("media", ("post_id", "file_name"), [(1, "a"), (1, "b"), (1, "c")], chunk_size=2) == []
+
+
+def test_page_cursor_round_trip():
+    created_at = datetime(2025, 3, 1, 12, 30, 5)
+    token = queryHelper.encode_page_cursor(created_at, 42)
+    assert "=" not in token
+    assert queryHelper.decode_page_cursor(token) == (created_at, 42)
+
+
+@pytest.mark.parametrize("token", ["", "nonsense", "W10", queryHelper.encode_page_cursor("yesterday", 1)])
+def test_bad_page_cursors_are_rejected(token):
+    with pytest.raises(ValueError):
+        queryHelper.decode_page_cursor(token)
+
+
+def test_keyset_condition_pages_after_the_cursor():
+    created_at = datetime(2025, 3, 1)
+    condition, params = queryHelper.keyset_condition(queryHelper.encode_page_cursor(created_at, 7), "p.created_at", "p.post_id")
+    assert condition == "(p.created_at < %s OR (p.created_at = %s AND p.post_id < %s))"
+    assert params == (created_at, created_at, 7)
+
+
+def test_after_commit_waits_for_the_outermost_commit(connect):
+    conn = connect([])
+    ran = []
+    with queryHelper.transaction():
+        with queryHelper.transaction():
+            queryHelper.after_commit(lambda: ran.append(conn.commits))
+        assert ran == []
+    assert ran == [1]
+    queryHelper.after_commit(lambda: ran.append("now"))
+    assert ran == [1, "now"]
+
+
+def test_after_commit_is_dropped_on_rollback(connect):
+    connect([])
+    ran = []
+    with queryHelper.transaction():
+        queryHelper.after_commit(lambda: ran.append("kept"))
+        with pytest.raises(ValueError):
+            with queryHelper.transaction():
+                queryHelper.after_commit(lambda: ran.append("savepoint rolled back"))
+                raise ValueError
+    with pytest.raises(ValueError):
+        with queryHelper.transaction():
+            queryHelper.after_commit(lambda: ran.append("transaction rolled back"))
+            raise ValueError
+    assert ran == ["kept"]
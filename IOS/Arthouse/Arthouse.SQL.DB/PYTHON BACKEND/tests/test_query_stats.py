@@ -0,0 +1,61 @@
+import json
+import threading
+
+import pytest
+
+from QueryStats import QueryStats as Stats, fingerprint
+
+
+def test_fingerprint_collapses_values_and_lists():
+    assert fingerprint("SELECT * FROM post WHERE post_id IN (%s, %s, %s)") == "SELECT * FROM post WHERE post_id IN (...)"
+    assert fingerprint("SELECT * FROM post WHERE post_id IN (%s)") == "SELECT * FROM post WHERE post_id IN (...)"
+    assert fingerprint("INSERT INTO hashtag (hashtag, post_id) VALUES (%s, %s), (%s, %s)") == \
+        "INSERT INTO hashtag (hashtag, post_id) VALUES (...)"
+    assert fingerprint("SELECT  *\n FROM post -- newest\n WHERE username = 'ana' LIMIT 5") == \
+        "SELECT * FROM post WHERE username = ? LIMIT ?"
+
+
+def test_report_adds_up_calls(tmp_path):
+    stats = Stats(slow_ms=1000, log_path=str(tmp_path / "slow.log"))
+    for elapsed in (0.001, 0.003, 0.004):
+        stats.record("SELECT * FROM post WHERE post_id = %s", elapsed, rows=1, acquire=0.002)
+    stats.record("SELECT * FROM post WHERE post_id = 7", 0.2, error=True)
+    [row] = stats.report()
+    assert row["fingerprint"] == "SELECT * FROM post WHERE post_id = ?"
+    assert (row["calls"], row["errors"], row["rows"]) == (4, 1, 3)
+    assert row["p50_ms"] == 5 and row["p99_ms"] == 250 and row["max_ms"] == 200.0
+    assert sum(row["histogram"].values()) == 4
+    assert not (tmp_path / "slow.log").exists()
+
+
+def test_slow_queries_are_logged_without_params(tmp_path):
+    stats = Stats(slow_ms=10, log_path=str(tmp_path / "slow.log"))
+    stats.record("SELECT * FROM user WHERE email = %s", 0.05, rows=1, params=("ana@example.com",))
+    [line] = (tmp_path / "slow.log").read_text().splitlines()
+    entry = json.loads(line)
+    assert entry["fingerprint"] == "SELECT * FROM user WHERE email = ?"
+    assert entry["ms"] == 50.0
+    assert "ana@example.com" not in line
+
+
+def test_explain_runs_once_per_interval_on_one_thread(tmp_path):
+    stats = Stats(slow_ms=10, log_path=str(tmp_path / "slow.log"), explain=True)
+    explained = []
+    stats.set_explainer(lambda query, params: explained.append(threading.current_thread().name) or [{"type": "ALL"}])
+    threads = [threading.Thread(target=stats.record, args=("SELECT * FROM post WHERE post_id = %s", 0.05))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats.record("UPDATE post SET like_count = like_count + 1 WHERE post_id = %s", 0.05)
+    stats._explain_pool.shutdown(wait=True)
+    assert len(explained) == 1
+    assert any('"explain"' in line for line in (tmp_path / "slow.log").read_text().splitlines())
+
+
+def test_no_explain_pool_unless_asked_for(tmp_path):
+    stats = Stats(slow_ms=10, log_path=str(tmp_path / "slow.log"))
+    stats.set_explainer(lambda query, params: pytest.fail("EXPLAIN is off"))
+    stats.record("SELECT 1", 0.05)
+    assert stats._explain_pool is None
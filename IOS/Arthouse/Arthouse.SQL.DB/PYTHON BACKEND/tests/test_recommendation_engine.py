@@ -0,0 +1,66 @@
+import threading
+import time
+
+import pytest
+
+import RecommendationEngine
+from RecommendationEngine import RecommendationEngine as Engine
+
+
+@pytest.fixture
+def db(monkeypatch):
+    state = {"posts": [], "tags": [], "likes": [], "during_query": None}
+
+    def read(query, params=None):
+        if "FROM user_liked_relationships" in query:
+            return state["likes"]
+        if "FROM hashtag h" in query:
+            return state["tags"]
+        if state["during_query"]:
+            state["during_query"]()
+        return list(reversed(state["posts"]))
+
+    monkeypatch.setattr(RecommendationEngine, "run_read_multiple", read)
+    return state
+
+
+def test_build_does_not_hold_the_lock_while_querying(db):
+    engine = Engine()
+    engine.build()
+    held = []
+
+    def check():
+        # another thread can still take the lock while the build is querying
+        probe = threading.Thread(target=lambda: held.append(engine._lock.acquire(timeout=1) and engine._lock.release()))
+        probe.start()
+        probe.join()
+    db["during_query"] = check
+    engine.build()
+    assert held == [None]
+
+
+def test_writes_during_a_build_are_replayed(db):
+    now = time.time()
+    db["posts"] = [(1, "ana", now - 20), (2, "bo", now - 10)]
+    engine = Engine()
+
+    def write():
+        engine.add_post(3, "cy", now, ["art"])
+        engine.remove_post(1)
+    db["during_query"] = write
+    engine.build()
+    assert engine._post_count == 3
+    assert not engine._post_alive[engine._post_row[1]]
+    assert [post_id for post_id, _ in engine.recommend("dee")] == [3, 2]
+
+
+def test_unlike_moves_the_user_away_from_the_hashtags(db):
+    now = time.time()
+    db["posts"] = [(1, "ana", now - 20), (2, "bo", now - 10)]
+    db["tags"] = [(1, "art"), (2, "film")]
+    db["likes"] = [("art", 1)]
+    engine = Engine()
+    assert engine.recommend("dee") == [(1, 1), (2, 2)]
+    engine.record_like("dee", 1, -1)
+    assert not engine._user_vectors["dee"].any()
+    assert engine.recommend("dee") == [(2, 2), (1, 2)]
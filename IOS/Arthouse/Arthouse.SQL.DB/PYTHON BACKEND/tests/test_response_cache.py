@@ -0,0 +1,86 @@
+import pytest
+
+import ResponseCache
+from ResponseCache import MemoryStore, ResponseCache as Cache, SqliteStore
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def cache(request, tmp_path):
+    if request.param == "memory":
+        return Cache(MemoryStore(max_entries=3))
+    return Cache(SqliteStore(str(tmp_path / "cache.sqlite3"), max_entries=3))
+
+
+class Loader:
+    def __init__(self, value):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.value
+
+
+def test_second_read_is_a_hit(cache):
+    load = Loader({"posts": [1, 2]})
+    assert cache.get_or_load("posts", "page1", load) == {"posts": [1, 2]}
+    assert cache.get_or_load("posts", "page1", load) == {"posts": [1, 2]}
+    assert load.calls == 1
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_errors_are_not_cached(cache):
+    load = Loader(None)
+    cache.get_or_load("posts", "page1", load)
+    cache.get_or_load("posts", "page1", load)
+    assert load.calls == 2
+
+
+def test_invalidate_only_touches_its_namespace(cache):
+    feed, profile = Loader("feed"), Loader("profile")
+    for _ in range(2):
+        cache.get_or_load("posts", "page1", feed)
+        cache.get_or_load("profile:ana", "summary", profile)
+    cache.invalidate("posts")
+    cache.get_or_load("posts", "page1", feed)
+    cache.get_or_load("profile:ana", "summary", profile)
+    assert (feed.calls, profile.calls) == (2, 1)
+
+
+def test_entries_expire(cache, monkeypatch):
+    load = Loader("feed")
+    cache.get_or_load("posts", "page1", load, ttl=10)
+    now = ResponseCache.time.time() + 11
+    monotonic = ResponseCache.time.monotonic() + 11
+    monkeypatch.setattr(ResponseCache.time, "time", lambda: now)
+    monkeypatch.setattr(ResponseCache.time, "monotonic", lambda: monotonic)
+    cache.get_or_load("posts", "page1", load)
+    assert load.calls == 2
+
+
+def test_least_recently_used_go_first(cache, monkeypatch):
+    # a clock that always moves, so no two uses of the sqlite store tie
+    clock = iter(range(10 ** 9, 10 ** 10))
+    monkeypatch.setattr(ResponseCache.time, "time", lambda: next(clock))
+    loads = {key: Loader(key) for key in "abcd"}
+    for key in "abc":
+        cache.get_or_load("posts", key, loads[key])
+    cache.get_or_load("posts", "a", loads["a"])     # a is now the most recent
+    cache.get_or_load("posts", "d", loads["d"])     # pushes b out
+    cache.get_or_load("posts", "a", loads["a"])
+    cache.get_or_load("posts", "b", loads["b"])
+    assert loads["a"].calls == 1 and loads["b"].calls == 2
+
+
+def test_get_many_only_loads_the_missing_keys(cache):
+    asked = []
+
+    def load_many(ids):
+        asked.append(list(ids))
+        return {id: f"profile of {id}" for id in ids if id != "ghost"}
+
+    keys = {name: (f"profile:{name}", "summary") for name in ("ana", "bo")}
+    assert cache.get_many_or_load(keys, load_many) == {"ana": "profile of ana", "bo": "profile of bo"}
+    keys["ghost"] = ("profile:ghost", "summary")
+    assert cache.get_many_or_load(keys, load_many) == {"ana": "profile of ana", "bo": "profile of bo"}
+    assert asked == [["ana", "bo"], ["ghost"]]
@@ -0,0 +1,129 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import ArthouseGoogleCloudInterface as agci
+
+CHUNK = 256 * 1024
+
+
+# a local stand-in for the storage JSON API's resumable sessions:
+# POST opens a session, PUT with "bytes a-b/total" stores a chunk (308 + Range
+# until the last one), PUT with "bytes */total" asks how much it has
+class FakeStorage:
+    def __init__(self):
+        self.sessions = 0
+        self.data = bytearray()
+        self.requests = []          # (method, Content-Range)
+        self.fail_puts = set()      # numbers of the chunk PUTs (1 = first) that get a 503
+
+    def handler(self):
+        storage = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                storage.requests.append(("POST", self.headers.get("x-goog-resumable")))
+                storage.sessions += 1
+                self.send_response(200)
+                self.send_header("Location", f"http://127.0.0.1:{self.server.server_port}/session/{storage.sessions}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_PUT(self):
+                content_range = self.headers["Content-Range"]
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                storage.requests.append(("PUT", content_range))
+                span, total = content_range[len("bytes "):].split("/")
+                if span != "*":
+                    chunks = sum(1 for method, value in storage.requests if method == "PUT" and "*" not in value)
+                    if chunks in storage.fail_puts:
+                        return self.reply(503)
+                    start = int(span.split("-")[0])
+                    storage.data[start:] = body
+                if len(storage.data) == int(total):
+                    return self.reply(200)
+                self.reply(308, {"Range": f"bytes=0-{len(storage.data) - 1}"} if storage.data else {})
+
+            def reply(self, status, headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        return Handler
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    fake = FakeStorage()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), fake.handler())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    fake.start_url = f"http://127.0.0.1:{server.server_port}/start"
+    monkeypatch.setattr(agci, "UPLOAD_BACKOFF_SECONDS", 0)
+    monkeypatch.setattr(agci, "_exists_cache", {})
+    yield fake
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / "clip.mp4"
+    path.write_bytes(os.urandom(3 * CHUNK + 100))
+    return path
+
+
+def upload(storage, video, tmp_path):
+    return agci.resumable_upload("bucket", str(video), "video", chunk_size=CHUNK,
+                                 checkpoint_dir=str(tmp_path / "checkpoints"), start_url=storage.start_url)
+
+
+def test_uploads_in_chunks_and_removes_the_checkpoint(storage, video, tmp_path):
+    sent = []
+    assert agci.resumable_upload("bucket", str(video), "video", chunk_size=CHUNK,
+                                 checkpoint_dir=str(tmp_path / "checkpoints"), start_url=storage.start_url,
+                                 progress=lambda path, done, total: sent.append(done))
+    assert storage.requests[0] == ("POST", "start")
+    assert [value for method, value in storage.requests[1:]] == [
+        f"bytes 0-{CHUNK - 1}/{3 * CHUNK + 100}",
+        f"bytes {CHUNK}-{2 * CHUNK - 1}/{3 * CHUNK + 100}",
+        f"bytes {2 * CHUNK}-{3 * CHUNK - 1}/{3 * CHUNK + 100}",
+        f"bytes {3 * CHUNK}-{3 * CHUNK + 99}/{3 * CHUNK + 100}",
+    ]
+    assert sent == [CHUNK, 2 * CHUNK, 3 * CHUNK, 3 * CHUNK + 100]
+    assert bytes(storage.data) == video.read_bytes()
+    assert os.listdir(tmp_path / "checkpoints") == []
+
+
+def test_a_failed_chunk_is_retried_from_what_the_server_has(storage, video, tmp_path):
+    storage.fail_puts = {2}
+    assert upload(storage, video, tmp_path)
+    # the 503 is followed by a status query, then the same chunk again
+    assert ("PUT", f"bytes */{3 * CHUNK + 100}") in storage.requests
+    assert storage.sessions == 1
+    assert bytes(storage.data) == video.read_bytes()
+
+
+def test_an_interrupted_upload_resumes_from_its_checkpoint(storage, video, tmp_path, monkeypatch):
+    monkeypatch.setattr(agci, "UPLOAD_RETRIES", 1)
+    storage.fail_puts = {3, 4}
+    assert not upload(storage, video, tmp_path)
+    assert len(storage.data) == 2 * CHUNK
+    assert len(os.listdir(tmp_path / "checkpoints")) == 1
+
+    storage.fail_puts = set()
+    storage.requests.clear()
+    assert upload(storage, video, tmp_path)
+    # no new session: it asked the old one where it got to and carried on from there
+    assert storage.sessions == 1
+    assert storage.requests[0] == ("PUT", f"bytes */{3 * CHUNK + 100}")
+    assert storage.requests[1] == ("PUT", f"bytes {2 * CHUNK}-{3 * CHUNK - 1}/{3 * CHUNK + 100}")
+    assert bytes(storage.data) == video.read_bytes()
+    assert os.listdir(tmp_path / "checkpoints") == []
@@ -0,0 +1,84 @@
+import pytest
+
+import SessionTokens
+from SessionTokens import SessionTokens as Sessions
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_700_000_000.0]
+    monkeypatch.setattr(SessionTokens.time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def sessions(clock):
+    return Sessions(secret="test secret", ttl=60)
+
+
+def test_issued_tokens_verify(sessions, clock):
+    token, expires_at = sessions.issue("ana")
+    assert sessions.verify(token) == "ana"
+    assert expires_at == clock[0] + 60
+
+
+def test_tampered_or_foreign_tokens_are_rejected(sessions):
+    token, _ = sessions.issue("ana")
+    payload, signature = token.split(".")
+    forged, _ = Sessions(secret="someone else's secret").issue("ana")
+    other_payload = Sessions(secret="x").issue("bo")[0].split(".")[0]
+    for bad in [None, "", "garbage", token + "x", f"{other_payload}.{signature}", forged, f"{payload}.{signature}.x"]:
+        assert sessions.verify(bad) is None
+
+
+def test_tokens_expire(sessions, clock):
+    token, _ = sessions.issue("ana")
+    clock[0] += 61
+    assert sessions.verify(token) is None
+
+
+def test_logout_revokes_one_token(sessions):
+    first, _ = sessions.issue("ana")
+    second, _ = sessions.issue("ana")
+    assert sessions.revoke(first) is True
+    assert sessions.verify(first) is None
+    assert sessions.verify(second) == "ana"
+    assert sessions.revoke(first) is False
+
+
+def test_revoke_user_ends_every_earlier_session(sessions, clock):
+    old, _ = sessions.issue("ana")
+    other, _ = sessions.issue("bo")
+    clock[0] += 1
+    sessions.revoke_user("ana")
+    clock[0] += 1
+    new, _ = sessions.issue("ana")
+    assert sessions.verify(old) is None
+    assert sessions.verify(other) == "bo"
+    assert sessions.verify(new) == "ana"
+
+
+def test_revocations_are_forgotten_once_the_tokens_expire(sessions, clock):
+    token, _ = sessions.issue("ana")
+    sessions.revoke(token)
+    sessions.revoke_user("bo")
+    clock[0] += 61
+    sessions.revoke_user("cy")          # pruning happens on the next revocation
+    assert list(sessions._revoked) == []
+    assert list(sessions._not_before) == ["cy"]
+
+
+def test_random_secret_is_flagged(monkeypatch):
+    monkeypatch.delenv("SESSION_SECRET", raising=False)
+    assert Sessions().random_secret
+    assert not Sessions(secret="test secret").random_secret
+
+
+def test_deleting_a_user_ends_their_sessions(sessions, clock, monkeypatch):
+    import ArthouseDBSQLComands_USER as user_db
+    monkeypatch.setattr(user_db, "sessions", sessions)
+    monkeypatch.setattr(user_db, "run_cud_query", lambda query, params: None)
+    token, _ = sessions.issue("ana")
+    clock[0] += 1
+    assert user_db.delete_user("ana")
+    assert sessions.verify(token) is None
@@ -0,0 +1,33 @@
+import pytest
+
+import api_server
+
+ENDPOINTS = ["/api/stats/cache", "/api/stats/passwords", "/api/stats/queries"]
+
+
+@pytest.fixture
+def client():
+    return api_server.app.test_client()
+
+
+@pytest.mark.parametrize("path", ENDPOINTS)
+def test_hidden_without_a_metrics_token(client, monkeypatch, path):
+    monkeypatch.setattr(api_server, "METRICS_TOKEN", None)
+    assert client.get(path).status_code == 404
+
+
+@pytest.mark.parametrize("path", ENDPOINTS)
+def test_need_the_metrics_token(client, monkeypatch, path):
+    monkeypatch.setattr(api_server, "METRICS_TOKEN", "s3cret")
+    assert client.get(path).status_code == 401
+    assert client.get(path, headers={"Authorization": "Bearer wrong"}).status_code == 401
+    # a user's session token isn't enough either
+    session = api_server.sessions.issue("ana")[0]
+    assert client.get(path, headers={"Authorization": f"Bearer {session}"}).status_code == 401
+
+
+def test_served_with_the_metrics_token(client, monkeypatch):
+    monkeypatch.setattr(api_server, "METRICS_TOKEN", "s3cret")
+    response = client.get("/api/stats/cache", headers={"Authorization": "Bearer s3cret"})
+    assert response.status_code == 200
+    assert "hit_rate" in response.get_json()
@@ -0,0 +1,58 @@
+import pytest
+
+import ArthouseDBSQLComands_TIMELINE as timeline
+
+
+@pytest.fixture
+def db(monkeypatch):
+    calls = {"cud": [], "trims": [], "single": None}
+    monkeypatch.setattr(timeline, "run_read_single", lambda query, params=None: calls["single"])
+    monkeypatch.setattr(timeline, "run_cud_query",
+                        lambda query, params=None: calls["cud"].append((" ".join(query.split()), params)) or 1)
+    monkeypatch.setattr(timeline, "after_commit", lambda callback: callback())
+    monkeypatch.setattr(timeline, "run_cud_many",
+                        lambda query, rows: calls["cud"].append((" ".join(query.split()), rows[0])) or 5)
+    monkeypatch.setattr(timeline, "schedule_trim",
+                        lambda usernames=(), followers_of=None: calls["trims"].append((list(usernames), followers_of)))
+    return calls
+
+
+def test_post_is_fanned_out_below_the_celebrity_limit(db):
+    db["single"] = ("ana", 12)
+    assert timeline.fan_out_post(7)
+    queries = [query for query, _ in db["cud"]]
+    assert any("JOIN follower_relationships" in query for query in queries)
+    assert ("UPDATE post SET fanned_out = TRUE WHERE post_id = %s", (7,)) in db["cud"]
+    assert db["trims"] == [(["ana"], "ana")]
+
+
+def test_celebrity_post_only_reaches_the_author(db):
+    db["single"] = ("star", timeline.CELEBRITY_FOLLOWER_COUNT)
+    assert timeline.fan_out_post(7)
+    [(query, params)] = db["cud"]
+    assert "follower_relationships" not in query and params == (7,)
+    assert db["trims"] == [(["star"], None)]
+
+
+def test_missing_post_is_not_fanned_out(db):
+    assert not timeline.fan_out_post(7)
+    assert db["cud"] == [] and db["trims"] == []
+
+
+def test_trim_deletes_from_the_first_entry_past_the_limit(db):
+    assert timeline.trim_timeline("ana", 3) == 0
+    assert db["cud"] == []
+    db["single"] = ("2026-01-01 10:00:00", 42)
+    assert timeline.trim_timeline("ana", 3) == 5
+    [(query, params)] = db["cud"]
+    assert query.startswith("DELETE FROM home_timeline WHERE username = %s")
+    assert params == ("ana", "2026-01-01 10:00:00", "2026-01-01 10:00:00", 42)
+
+
+def test_pulled_posts_are_the_ones_not_fanned_out(monkeypatch):
+    seen = []
+    monkeypatch.setattr(timeline, "run_read_multiple", lambda query, params=None: seen.append((query, params)) or [])
+    assert timeline.get_home_timeline("ana", limit=5) == []
+    [(query, params)] = seen
+    assert "p.fanned_out = FALSE" in query and "follower_count" not in query
+    assert params == ("ana", 5, "ana", 5, 5)
@@ -0,0 +1,67 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+import api_server
+from BlobStore import BlobStore
+
+
+def png_bytes():
+    out = io.BytesIO()
+    Image.new("RGB", (4, 4), "red").save(out, "PNG")
+    return out.getvalue()
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = BlobStore(str(tmp_path / "uploads"), str(tmp_path / "refs.sqlite3"))
+    monkeypatch.setattr(api_server, "blob_store", store)
+    monkeypatch.setattr(api_server, "save_post",
+                        lambda username, caption, image_url, media_type: {"image_url": image_url})
+    return store
+
+
+@pytest.fixture
+def client():
+    return api_server.app.test_client()
+
+
+def test_extension_comes_from_the_bytes_not_the_client(client, store):
+    response = client.post("/api/posts/upload?username=ana", data=png_bytes(), content_type="image/svg+xml")
+    assert response.status_code == 200
+    assert response.get_json()["image_url"].endswith(".png")
+
+    response = client.post("/api/posts/upload", content_type="multipart/form-data",
+                           data={"username": "ana", "image": (io.BytesIO(png_bytes()), "cat.html")})
+    assert response.status_code == 200
+    assert response.get_json()["image_url"].endswith(".png")
+
+
+@pytest.mark.parametrize("body", [b"<html><script>alert(1)</script></html>",
+                                  b'<svg xmlns="http://www.w3.org/2000/svg"><script>alert(1)</script></svg>'])
+def test_anything_but_an_image_is_refused(client, store, body):
+    response = client.post("/api/posts/upload?username=ana", data=body, content_type="image/jpeg")
+    assert response.status_code == 415
+    response = client.post("/api/posts/upload", content_type="multipart/form-data",
+                           data={"username": "ana", "image": (io.BytesIO(body), "cat.jpg")})
+    assert response.status_code == 415
+    # nothing was kept
+    assert not [name for _, _, names in os.walk(store.root) for name in names]
+
+
+def test_uploads_are_served_with_nosniff(client, store):
+    image_url = client.post("/api/posts/upload?username=ana", data=png_bytes(),
+                            content_type="image/png").get_json()["image_url"]
+    response = client.get(image_url[len("http://localhost:5001"):])
+    assert response.status_code == 200
+    assert response.headers["X-Content-Type-Options"] == "nosniff"
+    assert response.mimetype == "image/png"
+
+
+def test_non_image_files_are_not_served(client, store):
+    os.makedirs(store.root, exist_ok=True)
+    with open(os.path.join(store.root, "page.html"), "w") as f:
+        f.write("<script>alert(1)</script>")
+    assert client.get("/uploads/page.html").status_code == 404